@@ -0,0 +1,225 @@
+"""
+Пакетный анализ: много фото × несколько стилей (лукбуки, каталоги)
+
+Запуск из папки backend:
+    python -m batch photos/ --styles casual,business --output lookbook.jsonl [--concurrency 4] [--image]
+    python -m batch manifest.jsonl --output lookbook.jsonl
+
+Вход - папка с фото (стили из --styles) или манифест:
+    .jsonl - строки {"image": "path.jpg", "styles": ["casual", "business"]} (styles необязателен);
+    .csv   - строки "path.jpg,style" (одна пара на строку).
+Пути в манифесте считаются от папки манифеста.
+
+Каждое фото декодируется один раз, и все его стили анализируются одним запросом к GPT-4o. Результаты
+дописываются в JSONL по мере готовности; этот же файл служит контрольной точкой -
+при повторном запуске успешно обработанные пары (фото, стиль) пропускаются.
+"""
+import os
+import csv
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
+
+# Пределы для POST /api/analyze/batch
+BATCH_MAX_PHOTOS = int(os.getenv("BATCH_MAX_PHOTOS", 50))
+BATCH_MAX_STYLES = int(os.getenv("BATCH_MAX_STYLES", 10))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+
+
+def parse_styles(value: str) -> list:
+    """
+    "casual, business,casual" -> ["casual", "business"] (порядок сохраняется, повторы убираются)
+    """
+    styles = []
+    for style in (value or "").split(","):
+        style = style.strip()
+        if style and style not in styles:
+            styles.append(style)
+    return styles
+
+
+def load_manifest(path: str, default_styles: list) -> list:
+    """
+    Папка или манифест -> [{"image": путь, "styles": [...]}] с объединенными стилями для одного фото
+    """
+    entries: dict = {}
+
+    def add(image_path: str, styles: list):
+        entry = entries.setdefault(image_path, {"image": image_path, "styles": []})
+        for style in styles:
+            if style not in entry["styles"]:
+                entry["styles"].append(style)
+
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                add(os.path.join(path, name), default_styles)
+    else:
+        base_dir = os.path.dirname(os.path.abspath(path))
+        with open(path, encoding="utf-8") as f:
+            if path.lower().endswith(".csv"):
+                for row in csv.reader(f):
+                    if len(row) >= 2 and row[0].strip() and not row[0].startswith("#"):
+                        add(os.path.join(base_dir, row[0].strip()), parse_styles(row[1]))
+            else:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    item = json.loads(line)
+                    styles = item.get("styles") or ([item["style"]] if item.get("style") else default_styles)
+                    add(os.path.join(base_dir, item["image"]), styles)
+
+    return [entry for entry in entries.values() if entry["styles"]]
+
+
+def load_checkpoint(output_path: str) -> set:
+    """
+    Пары (фото, стиль), уже успешно записанные в выходной JSONL
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Оборванная последняя строка после аварийной остановки
+                continue
+            if record.get("success"):
+                done.add((record.get("image"), record.get("style")))
+    return done
+
+
+async def run_batch(
+    entries: list,
+    load_image: Callable[[dict], Awaitable],
+    analyze: Callable[[object, list], Awaitable[dict]],
+    on_result: Callable[[dict], Awaitable],
+    concurrency: int = BATCH_CONCURRENCY,
+    done: Optional[set] = None,
+) -> dict:
+    """
+    Обрабатывает все пары (фото, стиль) с ограничением параллельности
+
+    load_image(entry) готовит фото один раз (PreparedImage); analyze(image, styles)
+    обрабатывает все еще не готовые стили фото и возвращает {стиль: результат или
+    исключение}; on_result(record) получает запись для каждой пары. Одновременно
+    обрабатывается (и хранится в памяти) не больше concurrency фото.
+    """
+    done = done or set()
+    slots = asyncio.Semaphore(concurrency)
+    summary = {"total": 0, "skipped": 0, "succeeded": 0, "failed": 0}
+
+    async def emit(entry: dict, style: str, elapsed: float, result) -> None:
+        record = {"image": entry["image"]}
+        if "index" in entry:
+            record["index"] = entry["index"]
+        if isinstance(result, BaseException):
+            record.update(style=style, success=False, error=_error_text(result))
+            summary["failed"] += 1
+        else:
+            record.update(style=style, success=True, result=result)
+            summary["succeeded"] += 1
+        record["elapsed"] = round(elapsed, 3)
+        await on_result(record)
+
+    async def run_image(entry: dict):
+        styles = [style for style in entry["styles"] if (entry["image"], style) not in done]
+        summary["total"] += len(entry["styles"])
+        summary["skipped"] += len(entry["styles"]) - len(styles)
+        if not styles:
+            return
+        async with slots:
+            started = time.perf_counter()
+            try:
+                image = await load_image(entry)
+                results = await analyze(image, styles)
+            except Exception as e:
+                results = {style: e for style in styles}
+            elapsed = time.perf_counter() - started
+            for style in styles:
+                await emit(entry, style, elapsed, results.get(style, RuntimeError("Нет результата")))
+
+    await asyncio.gather(*(run_image(entry) for entry in entries))
+    return summary
+
+
+def _error_text(error: BaseException) -> str:
+    return getattr(error, "detail", None) or str(error) or type(error).__name__
+
+
+class JsonlWriter:
+    """
+    Дописывает записи в JSONL; каждая строка сбрасывается на диск сразу (контрольная точка)
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    async def write(self, record: dict) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+async def _run_cli(args) -> dict:
+    # Конвейер, кэш и лимиты провайдеров - те же, что у сервера
+    import main as app_module
+    from imaging import prepare_image
+
+    entries = load_manifest(args.input, parse_styles(args.styles))
+    done = load_checkpoint(args.output)
+    logger.info("📚 Пакет: %s фото, уже готово пар: %s", len(entries), len(done))
+
+    async def load_image(entry: dict):
+        with open(entry["image"], "rb") as f:
+            return await app_module.run_in_image_executor(prepare_image, f)
+
+    async def analyze(image, styles: list) -> dict:
+        return await app_module.analyze_photo_styles(image, styles, generate_image=args.image)
+
+    writer = JsonlWriter(args.output)
+
+    async def on_result(record: dict):
+        await writer.write(record)
+        status = "✅" if record["success"] else "❌"
+        logger.info("%s %s [%s] за %.1f сек", status, os.path.basename(record["image"]), record["style"], record["elapsed"])
+
+    try:
+        async with app_module.app.router.lifespan_context(app_module.app):
+            return await run_batch(entries, load_image, analyze, on_result, concurrency=args.concurrency, done=done)
+    finally:
+        writer.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="папка с фото или манифест .jsonl/.csv")
+    parser.add_argument("--styles", default="", help="стили через запятую (для папки или строк манифеста без стилей)")
+    parser.add_argument("--output", required=True, help="JSONL с результатами (он же контрольная точка)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--image", action="store_true", help="генерировать изображение NanoBanana (платная задача на каждую пару)")
+    args = parser.parse_args(argv)
+
+    summary = asyncio.run(_run_cli(args))
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
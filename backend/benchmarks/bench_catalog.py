@@ -0,0 +1,99 @@
+"""
+Бенчмарк локального каталога: импорт, построение индекса и поиск для одного ответа
+
+Запуск из папки backend:
+    python -m benchmarks.bench_catalog [--products 100000] [--repeat 200] [--catalog data/catalog.sqlite3]
+
+Без --catalog создается синтетический каталог во временной папке. Поиск - один вызов
+search_many на 7 запросов (столько рекомендаций в ответе GPT-4o); печатает JSON с p50/p99.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+from catalog import ProductCatalog
+from benchmarks.load_test import percentile
+
+ITEMS = [
+    "пальто", "куртка", "пуховик", "тренч", "джинсы", "брюки", "юбка", "платье", "рубашка", "футболка",
+    "свитер", "худи", "кардиган", "пиджак", "жилет", "кроссовки", "кеды", "ботинки", "лоферы", "сапоги",
+    "ремень", "сумка", "шарф", "шапка", "кепка",
+]
+ADJECTIVES = [
+    "классическое", "оверсайз", "приталенное", "шерстяное", "льняное", "хлопковое", "кожаное", "джинсовое",
+    "утепленное", "укороченное", "прямое", "широкое", "базовое", "вязаное", "замшевое",
+]
+COLORS = ["черный", "белый", "серый", "синий", "бежевый", "коричневый", "зеленый", "красный", "розовый", "темно-синий"]
+GENDERS = ["женский", "мужской", "унисекс", "детский"]
+SHOPS = ["Lamoda", "Wildberries", "Ozon"]
+
+QUERIES = [
+    "черное пальто женское",
+    "синие прямые джинсы мужские",
+    "белая базовая футболка",
+    "бежевый тренч оверсайз",
+    "кожаный ремень мужской",
+    "белые кеды",
+    "серый вязаный кардиган женский",
+]
+
+
+def make_products(count: int):
+    random.seed(42)
+    for index in range(count):
+        item = random.choice(ITEMS)
+        color = random.choice(COLORS)
+        yield {
+            "id": f"sku-{index}",
+            "title": f"{item.capitalize()} {random.choice(ADJECTIVES)} {color}",
+            "url": f"https://shop.example/p/{index}",
+            "price": random.randrange(500, 30000),
+            "shop": random.choice(SHOPS),
+            "color": color,
+            "gender": random.choice(GENDERS),
+            "category": item,
+            "description": " ".join(random.sample(ADJECTIVES, 3)),
+        }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--catalog", default=None, help="готовый каталог вместо синтетического")
+    args = parser.parse_args(argv)
+
+    report = {"queries": len(QUERIES)}
+    with tempfile.TemporaryDirectory(prefix="odezda-catalog-") as workdir:
+        path = args.catalog or os.path.join(workdir, "catalog.sqlite3")
+        catalog = ProductCatalog(path)
+        if not args.catalog:
+            started = time.perf_counter()
+            report["imported"] = catalog.import_products(make_products(args.products), replace=True)
+            report["import_seconds"] = round(time.perf_counter() - started, 2)
+
+        catalog.load()
+        report["load_seconds"] = catalog.stats["load_seconds"]
+        report["products"] = catalog.stats["products"]
+
+        latencies = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results = catalog.search_many(QUERIES)
+            latencies.append((time.perf_counter() - started) * 1000)
+        report["search_many_ms"] = {
+            "p50": round(percentile(latencies, 0.50), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+        }
+        report["sample"] = {query: [item["title"] for item in items] for query, items in zip(QUERIES, results)}
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
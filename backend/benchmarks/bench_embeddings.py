@@ -0,0 +1,72 @@
+"""
+Бенчмарк векторного индекса: дописывание строк и поиск ближайших товаров для одного ответа
+
+Запуск из папки backend:
+    python -m benchmarks.bench_embeddings [--products 100000] [--dimensions 256] [--repeat 100]
+
+Векторы случайные (API не вызывается): измеряется только локальная часть - запись
+матрицы, загрузка memmap и search_many на 7 рекомендаций (одно умножение матриц
+и top-k на CPU), плюс дописывание 1% товаров и поиск после инкрементального обновления.
+"""
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from embeddings import VectorIndex, normalize_rows
+from benchmarks.load_test import percentile
+
+QUERIES = 7
+
+
+def measure(index: VectorIndex, queries, repeat: int) -> dict:
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        index.search_many(queries, 6)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {"p50": round(percentile(latencies, 0.50), 3), "p99": round(percentile(latencies, 0.99), 3)}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(42)
+    report = {"products": args.products, "dimensions": args.dimensions, "queries": QUERIES}
+    with tempfile.TemporaryDirectory(prefix="odezda-embeddings-") as workdir:
+        index = VectorIndex(workdir, reload_interval=0)
+        started = time.perf_counter()
+        for start in range(0, args.products, 10_000):
+            count = min(10_000, args.products - start)
+            vectors = normalize_rows(rng.standard_normal((count, args.dimensions), dtype=np.float32))
+            index.append([f"sku-{i}" for i in range(start, start + count)], ["0"] * count, vectors, "random")
+        report["build_seconds"] = round(time.perf_counter() - started, 2)
+
+        index.load()
+        report["load_seconds"] = index.stats["load_seconds"]
+        queries = normalize_rows(rng.standard_normal((QUERIES, args.dimensions), dtype=np.float32))
+        report["search_many_ms"] = measure(index, queries, args.repeat)
+
+        # Инкрементальное обновление: 1% товаров меняется, сервер подхватывает новую версию
+        count = max(1, args.products // 100)
+        started = time.perf_counter()
+        vectors = normalize_rows(rng.standard_normal((count, args.dimensions), dtype=np.float32))
+        index.append([f"sku-{i}" for i in range(count)], ["1"] * count, vectors, "random")
+        report["update_seconds"] = round(time.perf_counter() - started, 3)
+        index.search_many(queries, 6)
+        report["after_update"] = {"rows": index.stats["rows"], "alive": index.stats["alive"]}
+        report["search_many_ms_after_update"] = measure(index, queries, args.repeat)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
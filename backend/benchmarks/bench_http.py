@@ -0,0 +1,112 @@
+"""
+Бенчмарк пула соединений: новый клиент на каждый запрос против общего keep-alive клиента
+
+Запуск из папки backend:
+    python -m benchmarks.bench_http [--requests 200] [--concurrency 1]
+    python -m benchmarks.bench_http --url https://api.openai.com/v1/models
+
+Без --url поднимает benchmarks.fake_providers локально (HTTP без TLS - видна только
+стоимость TCP и создания клиента). С --url https://... измеряется и TLS-рукопожатие;
+статус ответа (например, 401 без ключа) не важен. Для каждого режима печатает задержку
+запроса p50/p95, процессорное время на запрос, число новых соединений и среднее время
+рукопожатия по фазам - то, что пул экономит на каждом вызове провайдера.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+from http_clients import PoolConfig, create_http_client, pool_config_from_env
+from metrics import HTTP_CONNECTIONS, HTTP_HANDSHAKE_SECONDS
+from benchmarks.load_test import BACKEND_DIR, percentile, wait_ready
+
+
+def handshake_avg_ms(provider: str, phase: str):
+    state = HTTP_HANDSHAKE_SECONDS._values.get((provider, phase))
+    if not state or not state[2]:
+        return None
+    return round(state[1] / state[2] * 1000, 2)
+
+
+async def run_mode(mode: str, url: str, total: int, concurrency: int, config: PoolConfig) -> dict:
+    shared = create_http_client(mode, config) if mode == "pooled" else None
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    async def worker():
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            if shared is not None:
+                await shared.get(url)
+            else:
+                # Как раньше: отдельный клиент (и соединение) на каждый вызов
+                async with create_http_client(mode, config) as client:
+                    await client.get(url)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    if shared is not None:
+        await shared.aclose()
+    return {
+        "requests": total,
+        "latency_ms_p50": round(percentile(latencies, 0.50), 2),
+        "latency_ms_p95": round(percentile(latencies, 0.95), 2),
+        "cpu_ms_per_request": round(cpu / total * 1000, 3),
+        "requests_per_second": round(total / elapsed, 1),
+        "new_connections": int(HTTP_CONNECTIONS.value(provider=mode)),
+        "tcp_handshake_ms_avg": handshake_avg_ms(mode, "tcp"),
+        "tls_handshake_ms_avg": handshake_avg_ms(mode, "tls"),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="адрес для GET (по умолчанию - локальные заглушки)")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--fake-port", type=int, default=9100)
+    args = parser.parse_args(argv)
+
+    config = pool_config_from_env("BENCH", max_connections=max(args.concurrency, 1))
+    process = None
+    url = args.url
+    try:
+        if url is None:
+            process = subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.fake_providers", "--port", str(args.fake_port)],
+                cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            url = f"http://127.0.0.1:{args.fake_port}/stats"
+            asyncio.run(wait_ready(url))
+        report = {
+            "url": url,
+            "http2": config.http2,
+            "concurrency": args.concurrency,
+            "fresh": asyncio.run(run_mode("fresh", url, args.requests, args.concurrency, config)),
+            "pooled": asyncio.run(run_mode("pooled", url, args.requests, args.concurrency, config)),
+        }
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=10)
+
+    fresh, pooled = report["fresh"], report["pooled"]
+    report["saved_per_request"] = {
+        "latency_ms_p50": round(fresh["latency_ms_p50"] - pooled["latency_ms_p50"], 2),
+        "cpu_ms": round(fresh["cpu_ms_per_request"] - pooled["cpu_ms_per_request"], 3),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Бенчмарк предобработки фото: старый путь (несколько декодирований/кодирований)
+против prepare_image (одно декодирование)
+
+Запуск из папки backend:
+    python -m benchmarks.bench_preprocess [photo.jpg ...] [--repeat 20]
+
+Каждый вариант выполняется в отдельном процессе, чтобы пиковая память (RSS)
+не смешивалась. Печатает JSON с CPU-временем и пиковой памятью на запрос.
+"""
+import io
+import sys
+import json
+import time
+import base64
+import argparse
+import resource
+import multiprocessing
+
+from PIL import Image, ImageOps
+
+from imaging import prepare_image
+
+
+def make_sample_photo(width: int = 4032, height: int = 3024) -> bytes:
+    """
+    Синтетическое "фото с телефона": крупный JPEG с EXIF-ориентацией 6
+    """
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=92, exif=exif)
+    return output.getvalue()
+
+
+def legacy_pipeline(raw: bytes) -> None:
+    """
+    Повторяет прежний путь: thumbnail + save, затем EXIF-поворот с quality=95
+    перед Imgur и base64 дважды (OpenAI и Imgur)
+    """
+    img = Image.open(io.BytesIO(raw))
+    image_data = raw
+    if img.width > 1024 or img.height > 1024:
+        img.thumbnail((1024, 1024))
+        buffer = io.BytesIO()
+        img.save(buffer, format=img.format or "JPEG")
+        image_data = buffer.getvalue()
+
+    base64.b64encode(image_data).decode("utf-8")
+
+    image = Image.open(io.BytesIO(image_data))
+    image = ImageOps.exif_transpose(image)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95, optimize=True)
+    base64.b64encode(output.getvalue()).decode("utf-8")
+
+
+def single_decode_pipeline(raw: bytes) -> None:
+    prepared = prepare_image(raw)
+    # base64 кэшируется в PreparedImage - второй доступ бесплатный
+    prepared.base64
+    prepared.base64
+
+
+VARIANTS = {
+    "legacy": legacy_pipeline,
+    "single_decode": single_decode_pipeline,
+}
+
+
+def _run_variant(name: str, photos: list, repeat: int, queue) -> None:
+    func = VARIANTS[name]
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(repeat):
+        for raw in photos:
+            func(raw)
+    requests_count = repeat * len(photos)
+    queue.put({
+        "variant": name,
+        "requests": requests_count,
+        "cpu_ms_per_request": round((time.process_time() - cpu_start) * 1000 / requests_count, 2),
+        "wall_ms_per_request": round((time.perf_counter() - wall_start) * 1000 / requests_count, 2),
+        # ru_maxrss в Linux - килобайты
+        "peak_rss_delta_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024, 1),
+    })
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("photos", nargs="*", help="JPEG/PNG файлы (по умолчанию - синтетическое фото 12 Мп)")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.photos:
+        photos = []
+        for path in args.photos:
+            with open(path, "rb") as f:
+                photos.append(f.read())
+    else:
+        photos = [make_sample_photo()]
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in VARIANTS:
+        queue = context.Queue()
+        process = context.Process(target=_run_variant, args=(name, photos, args.repeat, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+
+    print(json.dumps({"photos": len(photos), "results": results}, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Бенчмарк вариантов сгенерированного изображения: размер AVIF/WebP/JPEG по ширинам
+против прежнего одного JPEG quality=95 в полном размере
+
+Запуск из папки backend:
+    python -m benchmarks.bench_variants [result.jpg ...] [--repeat 3]
+
+Без аргументов используется синтетическое изображение 1024x1536 с шумом (похоже на
+фото по сжимаемости). Печатает JSON: байты каждого варианта, во сколько раз легче
+прежнего JPEG то, что скачает телефон (ширина 768), и время кодирования всех вариантов.
+"""
+import io
+import sys
+import json
+import time
+import argparse
+
+from PIL import Image
+
+from image_variants import render_variants, available_formats
+
+
+def make_sample_result(width: int = 1024, height: int = 1536) -> bytes:
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    image = Image.merge("RGB", (gradient, noise, Image.blend(gradient, noise, 0.5)))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def legacy_size(raw: bytes) -> int:
+    image = Image.open(io.BytesIO(raw)).rotate(-90, expand=True).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95, optimize=True)
+    return len(output.getvalue())
+
+
+def bench(raw: bytes, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = render_variants(raw, rotate=-90)
+        timings.append(time.perf_counter() - started)
+
+    legacy = legacy_size(raw)
+    sizes = {f"{v.content_type} {v.width}w": len(v.data) for v in result.variants}
+    mobile = min(
+        (v for v in result.variants if v.width <= 768),
+        key=lambda v: (-v.width, len(v.data)),
+    )
+    return {
+        "legacy_jpeg_bytes": legacy,
+        "variants": sizes,
+        "placeholder_bytes": len(result.placeholder),
+        "mobile": {"variant": f"{mobile.content_type} {mobile.width}w", "bytes": len(mobile.data), "smaller": round(legacy / len(mobile.data), 1)},
+        "render_seconds": round(min(timings), 3),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    samples = {path: open(path, "rb").read() for path in args.images} or {"synthetic": make_sample_result()}
+    report = {"formats": available_formats()}
+    for name, raw in samples.items():
+        report[name] = bench(raw, args.repeat)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
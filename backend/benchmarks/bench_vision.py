@@ -0,0 +1,219 @@
+"""
+Бенчмарк политик подготовки фото для GPT-4o: токены, байты, задержка и качество рекомендаций
+
+Запуск из папки backend:
+    python -m benchmarks.bench_vision photos/ [--policies original,auto,low,high]
+    python -m benchmarks.bench_vision photos/ --live --styles casual,business [--repeat 2]
+
+Без --live считается только локальная часть: размер JPEG для GPT-4o, оценка входных
+токенов изображения, выбранный detail/кадр и время подготовки. С --live каждый вариант
+отправляется в GPT-4o (OPENAI_API_KEY / OPENAI_BASE_URL из .env) тем же промптом, что
+и /api/analyze: фиксируются prompt_tokens из usage, задержка ответа и качество относительно
+первой политики в списке (эталон, по умолчанию original) - совпадение предметов
+рекомендаций (Jaccard по словам) и доля полных ответов (5-7 рекомендаций со всеми полями).
+
+Набор фото должен быть фиксированным, чтобы прогоны разных версий были сравнимы;
+результат сохраняется в benchmarks/results/vision-<время>.json.
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+from dataclasses import replace
+from datetime import datetime
+
+from imaging import prepare_image
+from vision import DETAIL_MODES, create_vision_policy
+from batch import IMAGE_EXTENSIONS, parse_styles
+from benchmarks.bench_preprocess import make_sample_photo
+from benchmarks.load_test import RESULTS_DIR, git_commit, percentile
+
+RECOMMENDATION_FIELDS = ("item", "description", "why", "search_query")
+_WORD = re.compile(r"\w+")
+
+
+def load_photos(paths: list) -> list:
+    """
+    [(имя, байты)] из файлов и папок; без аргументов - одно синтетическое фото
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+            ]
+        else:
+            files.append(path)
+    if not files:
+        return [("synthetic.jpg", make_sample_photo())]
+    photos = []
+    for path in files:
+        with open(path, "rb") as f:
+            photos.append((os.path.basename(path), f.read()))
+    return photos
+
+
+def item_words(result: dict) -> set:
+    words = set()
+    for recommendation in result.get("recommendations") or []:
+        if isinstance(recommendation, dict):
+            words.update(word.lower() for word in _WORD.findall(str(recommendation.get("item", ""))))
+    return words
+
+
+def is_complete(result: dict) -> bool:
+    recommendations = result.get("recommendations") or []
+    return 5 <= len(recommendations) <= 7 and all(
+        isinstance(item, dict) and all(item.get(field) for field in RECOMMENDATION_FIELDS)
+        for item in recommendations
+    )
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def prepare_variants(photos: list, policies: list) -> dict:
+    """
+    {политика: [(имя, PreparedImage, мс подготовки)]}
+    """
+    base = create_vision_policy()
+    variants = {}
+    for name in policies:
+        policy = replace(base, detail=name)
+        prepared = []
+        for photo_name, raw in photos:
+            started = time.perf_counter()
+            image = prepare_image(raw, vision_policy=policy)
+            prepared.append((photo_name, image, (time.perf_counter() - started) * 1000))
+        variants[name] = prepared
+    return variants
+
+
+def local_summary(prepared: list) -> dict:
+    visions = [image.vision for _, image, _ in prepared]
+    return {
+        "avg_bytes": round(sum(len(vision.jpeg) for vision in visions) / len(visions)),
+        "avg_estimated_tokens": round(sum(vision.tokens for vision in visions) / len(visions)),
+        "detail": {
+            detail: sum(1 for vision in visions if (vision.detail or "default") == detail)
+            for detail in sorted({vision.detail or "default" for vision in visions})
+        },
+        "cropped": sum(1 for vision in visions if vision.crop),
+        "faces_found": sum(1 for vision in visions if vision.face),
+        "prepare_ms_p50": round(percentile([ms for _, _, ms in prepared], 0.5), 1),
+    }
+
+
+async def run_live(variants: dict, styles: list, repeat: int) -> dict:
+    """
+    Отправляет каждый вариант в GPT-4o и сравнивает ответы с эталонной (первой) политикой
+    """
+    # Клиент и промпт - те же, что у сервера
+    import main as app_module
+
+    answers = {}
+    for name, prepared in variants.items():
+        runs = []
+        for photo_name, image, _ in prepared:
+            for style in styles:
+                for attempt in range(repeat):
+                    request = app_module.build_vision_request(image, app_module.build_style_prompt(style))
+                    started = time.perf_counter()
+                    try:
+                        response = await app_module.client.chat.completions.create(**request)
+                        result = json.loads(response.choices[0].message.content or "{}")
+                        usage = response.usage.prompt_tokens if response.usage else None
+                        error = None
+                    except Exception as e:
+                        result, usage, error = {}, None, str(e) or type(e).__name__
+                    runs.append({
+                        "photo": photo_name,
+                        "style": style,
+                        "attempt": attempt,
+                        "latency": time.perf_counter() - started,
+                        "prompt_tokens": usage,
+                        "result": result,
+                        "error": error,
+                    })
+                    print(f"  {name:<9} {photo_name} [{style}] {runs[-1]['latency']:.1f} сек, prompt_tokens={usage}", file=sys.stderr)
+        answers[name] = runs
+
+    reference_name = next(iter(variants))
+    reference = {
+        (run["photo"], run["style"], run["attempt"]): item_words(run["result"])
+        for run in answers[reference_name]
+    }
+    summary = {}
+    for name, runs in answers.items():
+        ok = [run for run in runs if not run["error"]]
+        tokens = [run["prompt_tokens"] for run in ok if run["prompt_tokens"] is not None]
+        latencies = [run["latency"] for run in ok]
+        summary[name] = {
+            "requests": len(runs),
+            "errors": len(runs) - len(ok),
+            "avg_prompt_tokens": round(sum(tokens) / len(tokens)) if tokens else None,
+            "latency_p50": round(percentile(latencies, 0.5), 2) if latencies else None,
+            "latency_p95": round(percentile(latencies, 0.95), 2) if latencies else None,
+            "complete_ratio": round(sum(1 for run in ok if is_complete(run["result"])) / len(ok), 3) if ok else None,
+            f"items_jaccard_vs_{reference_name}": round(
+                sum(jaccard(item_words(run["result"]), reference[(run["photo"], run["style"], run["attempt"])]) for run in ok) / len(ok), 3
+            ) if ok else None,
+        }
+    return summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("photos", nargs="*", help="фото или папки (по умолчанию - синтетическое фото 12 Мп)")
+    parser.add_argument("--policies", default="original,auto,low,high", help="значения VISION_DETAIL; первое - эталон")
+    parser.add_argument("--live", action="store_true", help="отправлять запросы в GPT-4o (платно)")
+    parser.add_argument("--styles", default="Casual (повседневный)")
+    parser.add_argument("--repeat", type=int, default=1, help="повторов каждого запроса в режиме --live")
+    parser.add_argument("--output", default=None, help="файл JSON с результатом")
+    args = parser.parse_args(argv)
+
+    policies = parse_styles(args.policies)
+    unknown = [name for name in policies if name not in DETAIL_MODES]
+    if unknown:
+        parser.error(f"неизвестные политики: {unknown} (доступны: {', '.join(DETAIL_MODES)})")
+
+    photos = load_photos(args.photos)
+    variants = prepare_variants(photos, policies)
+    results = {name: local_summary(prepared) for name, prepared in variants.items()}
+    if args.live:
+        live = asyncio.run(run_live(variants, parse_styles(args.styles), args.repeat))
+        for name, summary in live.items():
+            results[name]["live"] = summary
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": {
+            "photos": [name for name, _ in photos],
+            "policies": policies,
+            "live": args.live,
+            "styles": parse_styles(args.styles) if args.live else [],
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"vision-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"\n💾 Результат сохранен: {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""
+Локальные заглушки платных провайдеров для нагрузочных прогонов без затрат
+
+Один сервер имитирует:
+    POST /v1/chat/completions                 - OpenAI chat.completions (JSON mode, в т.ч. stream=True)
+    POST /v1/embeddings                       - OpenAI embeddings (векторы из хэшей слов)
+    POST /3/image                             - загрузка на Imgur
+    POST /api/v1/nanobanana/generate          - создание задачи NanoBanana
+    GET  /api/v1/nanobanana/record-info       - статус задачи NanoBanana
+    GET  /files/{name}                        - "сгенерированные" изображения
+
+Запуск из папки backend:
+    python -m benchmarks.fake_providers --port 9100 --latency openai=3,imgur=0.3,nanobanana=10 --errors openai=0.02
+
+Бэкенд направляется на заглушки переменными окружения:
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1
+    IMGUR_API_URL=http://127.0.0.1:9100/3/image
+    NANOBANANA_API_URL=http://127.0.0.1:9100/api/v1/nanobanana
+    STORAGE_BACKEND=imgur
+
+latency - средняя задержка ответа в секундах (для nanobanana - время генерации),
+к ней добавляется случайный разброс ±jitter (для stream=True ответ приходит
+кусками, равномерно за это время). errors - доля ответов с ошибкой
+(--error-status, по умолчанию 500; для 429 добавляется Retry-After).
+"""
+import io
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import hashlib
+import random
+import asyncio
+import argparse
+from array import array
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from PIL import Image
+
+PROVIDERS = ("openai", "imgur", "nanobanana")
+
+DEFAULT_LATENCY = {"openai": 2.0, "imgur": 0.3, "nanobanana": 8.0}
+
+FAKE_ANALYSIS = {
+    "analysis": "Тестовый анализ: прямоугольный тип фигуры, светлая кожа, темные волосы",
+    "person_description": "young adult, dark short hair, average build",
+    "outfit_description": "casual outfit with denim jacket, white t-shirt and jeans",
+    "recommendations": [
+        {
+            "item": item,
+            "description": "Тестовое описание",
+            "why": "Подходит к стилю",
+            "search_query": f"{item.lower()} мужская",
+        }
+        for item in ("Джинсовая куртка", "Белая футболка", "Прямые джинсы", "Белые кеды", "Кожаный ремень")
+    ],
+    "style_tips": ["Сочетайте базовые цвета", "Следите за посадкой", "Добавьте аксессуар"],
+}
+
+
+def fake_analysis(prompt: str) -> dict:
+    """
+    Ответ на одиночный промпт или на промпт с несколькими стилями ("styles": {...})
+    """
+    match = re.search(r"в каждом из стилей: (.+?)\.\n", prompt)
+    if not match:
+        return FAKE_ANALYSIS
+    styles = re.findall(r'"([^"]+)"', match.group(1))
+    per_style = {key: value for key, value in FAKE_ANALYSIS.items() if key not in ("analysis", "person_description")}
+    return {
+        "analysis": FAKE_ANALYSIS["analysis"],
+        "person_description": FAKE_ANALYSIS["person_description"],
+        "styles": {style: per_style for style in styles},
+    }
+
+
+def fake_embedding(text: str, dimensions: int) -> list:
+    """
+    Детерминированный вектор "мешка слов": у текстов с общими словами векторы близки
+    """
+    vector = [0.0] * dimensions
+    for word in re.findall(r"\w+", text.lower()):
+        # Первые 5 букв - грубая замена основы слова
+        digest = hashlib.md5(word[:5].encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % dimensions] += 1.0
+    return vector
+
+
+def parse_provider_values(value: str, defaults: dict = None) -> dict:
+    """
+    "openai=3,imgur=0.3" -> {"openai": 3.0, "imgur": 0.3, ...}; одно число - для всех провайдеров
+    """
+    result = dict(defaults or {name: 0.0 for name in PROVIDERS})
+    if not value:
+        return result
+    for part in value.split(","):
+        if "=" in part:
+            name, number = part.split("=", 1)
+            result[name.strip()] = float(number)
+        else:
+            result = {name: float(part) for name in PROVIDERS}
+    return result
+
+
+def make_result_image() -> bytes:
+    image = Image.linear_gradient("L").resize((768, 1024)).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+def create_app(latency: dict, errors: dict, jitter: float = 0.25, error_status: int = 500) -> FastAPI:
+    app = FastAPI(title="Odezda fake providers")
+    result_image = make_result_image()
+    # taskId -> время готовности
+    tasks: dict = {}
+    stats = {name: {"requests": 0, "errors": 0} for name in PROVIDERS}
+
+    def sample_latency(provider: str) -> float:
+        return max(0.0, latency.get(provider, 0.0) * random.uniform(1 - jitter, 1 + jitter))
+
+    async def simulate(provider: str, delay: bool = True):
+        """
+        Задержка ответа; возвращает ответ-ошибку, если сработала инъекция ошибок
+        """
+        stats[provider]["requests"] += 1
+        if delay:
+            await asyncio.sleep(sample_latency(provider))
+        if random.random() < errors.get(provider, 0.0):
+            stats[provider]["errors"] += 1
+            headers = {"Retry-After": "1"} if error_status == 429 else None
+            return JSONResponse({"error": {"message": "injected error"}}, status_code=error_status, headers=headers)
+        return None
+
+    def base_url(request: Request) -> str:
+        return str(request.base_url).rstrip("/")
+
+    async def stream_completion(model: str, text: str, duration: float, chunks: int = 50):
+        """
+        Ответ в формате SSE chat.completion.chunk, разбитый на куски за duration секунд
+        """
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        size = max(1, len(text) // chunks)
+        for start in range(0, len(text), size):
+            await asyncio.sleep(duration / chunks)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": text[start:start + size]}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        done = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        yield f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stream = bool(body.get("stream"))
+        # Поток начинается почти сразу, задержка распределяется между кусками ответа
+        error = await simulate("openai", delay=not stream)
+        if error:
+            return error
+        content = body["messages"][0]["content"]
+        prompt = content[0]["text"] if isinstance(content, list) else content
+        if stream:
+            text = json.dumps(fake_analysis(prompt), ensure_ascii=False)
+            return StreamingResponse(
+                stream_completion(body.get("model", "gpt-4o"), text, sample_latency("openai")),
+                media_type="text/event-stream",
+            )
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": json.dumps(fake_analysis(prompt), ensure_ascii=False)},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 1000, "completion_tokens": 500, "total_tokens": 1500},
+        }
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        # Эмбеддинги отвечают намного быстрее чата - без задержки
+        error = await simulate("openai", delay=False)
+        if error:
+            return error
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions") or 256
+        vectors = [fake_embedding(text, dimensions) for text in texts]
+        if body.get("encoding_format") == "base64":
+            vectors = [base64.b64encode(array("f", vector).tobytes()).decode() for vector in vectors]
+        return {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": index, "embedding": vector}
+                for index, vector in enumerate(vectors)
+            ],
+            "model": body.get("model", "text-embedding-3-small"),
+            "usage": {"prompt_tokens": 10 * len(texts), "total_tokens": 10 * len(texts)},
+        }
+
+    @app.post("/3/image")
+    async def imgur_upload(request: Request):
+        await request.body()
+        error = await simulate("imgur")
+        if error:
+            return error
+        return {"success": True, "status": 200, "data": {"link": f"{base_url(request)}/files/{uuid.uuid4().hex}.jpg"}}
+
+    @app.post("/api/v1/nanobanana/generate")
+    async def nanobanana_generate(request: Request):
+        await request.json()
+        stats["nanobanana"]["requests"] += 1
+        if random.random() < errors.get("nanobanana", 0.0):
+            stats["nanobanana"]["errors"] += 1
+            return JSONResponse({"code": error_status, "msg": "injected error"}, status_code=error_status)
+        task_id = uuid.uuid4().hex
+        tasks[task_id] = time.monotonic() + sample_latency("nanobanana")
+        return {"code": 200, "msg": "success", "data": {"taskId": task_id}}
+
+    @app.get("/api/v1/nanobanana/record-info")
+    async def nanobanana_record_info(request: Request, taskId: str):
+        ready_at = tasks.get(taskId)
+        if ready_at is None:
+            return {"code": 404, "msg": "task not found"}
+        if time.monotonic() < ready_at:
+            return {"code": 200, "data": {"taskId": taskId, "successFlag": 0}}
+        return {
+            "code": 200,
+            "data": {
+                "taskId": taskId,
+                "successFlag": 1,
+                "response": {"resultImageUrl": f"{base_url(request)}/files/{taskId}.jpg"},
+            },
+        }
+
+    @app.get("/files/{name}")
+    async def files(name: str):
+        return Response(result_image, media_type="image/jpeg")
+
+    @app.get("/stats")
+    async def get_stats():
+        return {"stats": stats, "tasks": len(tasks)}
+
+    return app
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="", help="задержка в секундах: openai=2,imgur=0.3,nanobanana=8")
+    parser.add_argument("--errors", default="", help="доля ошибок: openai=0.05,imgur=0,nanobanana=0")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--jitter", type=float, default=0.25, help="разброс задержки (доля от среднего)")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+
+    app = create_app(
+        latency=parse_provider_values(args.latency, DEFAULT_LATENCY),
+        errors=parse_provider_values(args.errors),
+        jitter=args.jitter,
+        error_status=args.error_status,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
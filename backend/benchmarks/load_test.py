@@ -0,0 +1,368 @@
+"""
+Нагрузочный прогон /api/analyze на локальных заглушках провайдеров
+
+Запуск из папки backend:
+    python -m benchmarks.load_test --users 20 --requests 200 [--latency openai=2,nanobanana=8]
+        [--errors openai=0.05] [--env IMGUR_RPS=0 ...] [--baseline benchmarks/results/old.json]
+
+Поднимает benchmarks.fake_providers и бэкенд (uvicorn main:app) в отдельных
+процессах, направляет бэкенд на заглушки через OPENAI_BASE_URL / IMGUR_API_URL /
+NANOBANANA_API_URL и гоняет N одновременных пользователей. Кэш и single-flight
+отключены, лимиты провайдеров - как в рабочей конфигурации (меняются через --env).
+
+Результат (пропускная способность, p50/p95/p99 запроса и каждой стадии по
+гистограммам /metrics, RSS процесса бэкенда) печатается и сохраняется в JSON
+(по умолчанию benchmarks/results/load-<время>.json) для сравнения между версиями.
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+import httpx
+from PIL import Image
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+
+STAGE_METRIC = "odezda_stage_duration_seconds"
+_SAMPLE = re.compile(r'^(?P<name>[a-z_]+)(?:\{(?P<labels>[^}]*)\})? (?P<value>\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def parse_metrics(text: str) -> dict:
+    """
+    Текст Prometheus -> {(имя, (метки...)): значение}
+    """
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = _SAMPLE.match(line)
+        if not match:
+            continue
+        labels = tuple(sorted(_LABEL.findall(match.group("labels") or "")))
+        samples[(match.group("name"), labels)] = float(match.group("value").replace("+Inf", "inf"))
+    return samples
+
+
+def histogram_quantile(q: float, buckets: list) -> float:
+    """
+    Квантиль по кумулятивным корзинам [(граница, счетчик)], как histogram_quantile в Prometheus
+    """
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    rank = q * buckets[-1][1]
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return previous_bound
+            if count == previous_count:
+                return bound
+            return previous_bound + (bound - previous_bound) * (rank - previous_count) / (count - previous_count)
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+def stage_summary(before: dict, after: dict) -> dict:
+    """
+    p50/p95/p99 каждой стадии за время прогона (разница снимков /metrics)
+    """
+    stages: dict = {}
+    for (name, labels), value in after.items():
+        if name != f"{STAGE_METRIC}_bucket":
+            continue
+        labels_dict = dict(labels)
+        delta = value - before.get((name, labels), 0.0)
+        stages.setdefault(labels_dict["stage"], []).append((float(labels_dict["le"]), delta))
+
+    summary = {}
+    for stage, buckets in sorted(stages.items()):
+        buckets.sort()
+        key = (("stage", stage),)
+        count = after.get((f"{STAGE_METRIC}_count", key), 0.0) - before.get((f"{STAGE_METRIC}_count", key), 0.0)
+        total = after.get((f"{STAGE_METRIC}_sum", key), 0.0) - before.get((f"{STAGE_METRIC}_sum", key), 0.0)
+        if count <= 0:
+            continue
+        summary[stage] = {
+            "count": int(count),
+            "mean": round(total / count, 4),
+            "p50": _round(histogram_quantile(0.50, buckets)),
+            "p95": _round(histogram_quantile(0.95, buckets)),
+            "p99": _round(histogram_quantile(0.99, buckets)),
+        }
+    return summary
+
+
+def counter_delta(before: dict, after: dict, metric: str) -> dict:
+    result = {}
+    for (name, labels), value in after.items():
+        if name == metric:
+            delta = value - before.get((name, labels), 0.0)
+            if delta:
+                result[",".join(f"{k}={v}" for k, v in labels)] = int(delta)
+    return result
+
+
+def _round(value):
+    return round(value, 4) if value is not None else None
+
+
+def make_photos(count: int, width: int = 1600, height: int = 1200) -> list:
+    """
+    Разные синтетические фото, чтобы запросы не совпадали по содержимому
+    """
+    photos = []
+    for index in range(count):
+        image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+        image.paste((random.randrange(256), random.randrange(256), 64 + index % 128), (0, 0, 64, 64))
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=90)
+        photos.append(output.getvalue())
+    return photos
+
+
+def read_rss_mb(pid: int) -> float:
+    """
+    Текущий RSS процесса из /proc (Linux); None, если недоступно
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=10,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(url, timeout=2)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Сервер не запустился: {url}")
+            await asyncio.sleep(0.2)
+
+
+async def run_load(base_url: str, app_pid: int, users: int, total: int, photos: list, style: str, timeout: float) -> dict:
+    latencies: list = []
+    status_codes: dict = {}
+    rss_samples: list = []
+    remaining = iter(range(total))
+
+    async def user(client: httpx.AsyncClient):
+        for index in remaining:
+            started = time.perf_counter()
+            try:
+                response = await client.post(
+                    f"{base_url}/api/analyze",
+                    files={"photo": ("photo.jpg", photos[index % len(photos)], "image/jpeg")},
+                    data={"style": style},
+                )
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            status_codes[status] = status_codes.get(status, 0) + 1
+
+    async def sample_rss():
+        while True:
+            rss = read_rss_mb(app_pid)
+            if rss is not None:
+                rss_samples.append(rss)
+            await asyncio.sleep(0.5)
+
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        before = parse_metrics((await client.get(f"{base_url}/metrics")).text)
+        sampler = asyncio.create_task(sample_rss())
+        started = time.perf_counter()
+        await asyncio.gather(*(user(client) for _ in range(users)))
+        duration = time.perf_counter() - started
+        sampler.cancel()
+        after = parse_metrics((await client.get(f"{base_url}/metrics")).text)
+
+    ok = status_codes.get("200", 0)
+    return {
+        "requests": len(latencies),
+        "ok": ok,
+        "status_codes": status_codes,
+        "duration_s": round(duration, 2),
+        "throughput_rps": round(ok / duration, 3) if duration else None,
+        "latency_s": {
+            "mean": _round(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": _round(percentile(latencies, 0.50)),
+            "p95": _round(percentile(latencies, 0.95)),
+            "p99": _round(percentile(latencies, 0.99)),
+            "max": _round(max(latencies)) if latencies else None,
+        },
+        "stages": stage_summary(before, after),
+        "provider_errors": counter_delta(before, after, "odezda_provider_errors_total"),
+        "rss_mb": {
+            "start": rss_samples[0] if rss_samples else None,
+            "peak": max(rss_samples) if rss_samples else None,
+            "end": read_rss_mb(app_pid),
+        },
+    }
+
+
+def compare(current: dict, baseline: dict) -> list:
+    """
+    Строки сравнения с прошлым прогоном: пропускная способность и p95
+    """
+    lines = []
+
+    def row(label, old, new):
+        if old is None or new is None:
+            return
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        lines.append(f"{label:<32} {old:>10} -> {new:<10} {change}")
+
+    old, new = baseline["results"], current["results"]
+    row("throughput_rps", old.get("throughput_rps"), new.get("throughput_rps"))
+    row("latency p95, s", old["latency_s"].get("p95"), new["latency_s"].get("p95"))
+    for stage, stats in new["stages"].items():
+        if stage in old.get("stages", {}):
+            row(f"{stage} p95, s", old["stages"][stage]["p95"], stats["p95"])
+    row("rss peak, MB", old["rss_mb"].get("peak"), new["rss_mb"].get("peak"))
+    return lines
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="одновременные пользователи")
+    parser.add_argument("--requests", type=int, default=None, help="всего запросов (по умолчанию users * 5)")
+    parser.add_argument("--style", default="casual")
+    parser.add_argument("--latency", default="", help="задержки заглушек, см. benchmarks.fake_providers")
+    parser.add_argument("--errors", default="", help="доля ошибок заглушек, см. benchmarks.fake_providers")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="переменные окружения бэкенда")
+    parser.add_argument("--app-port", type=int, default=8100)
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", default=None, help="файл JSON с результатом")
+    parser.add_argument("--baseline", default=None, help="прошлый JSON для сравнения")
+    args = parser.parse_args(argv)
+
+    total = args.requests or args.users * 5
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+
+    app_env = {
+        **os.environ,
+        "OPENAI_API_KEY": "fake-key",
+        "NANOBANANA_API_KEY": "fake-key",
+        "OPENAI_BASE_URL": f"{fake_url}/v1",
+        "IMGUR_API_URL": f"{fake_url}/3/image",
+        "NANOBANANA_API_URL": f"{fake_url}/api/v1/nanobanana",
+        "STORAGE_BACKEND": "imgur",
+        # Без вебхука - результаты забирает опросчик (заглушка колбэки не вызывает)
+        "PUBLIC_BASE_URL": "",
+        "NANOBANANA_CALLBACK_URL": "",
+        "CACHE_ENABLED": "0",
+        "SINGLEFLIGHT_PATH": "",
+        "JANITOR_ENABLED": "0",
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        app_env[key] = value
+
+    fake_cmd = [sys.executable, "-m", "benchmarks.fake_providers", "--port", str(args.fake_port)]
+    if args.latency:
+        fake_cmd += ["--latency", args.latency]
+    if args.errors:
+        fake_cmd += ["--errors", args.errors]
+    app_cmd = [
+        sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+        "--port", str(args.app_port), "--log-level", "warning",
+    ]
+
+    photos = make_photos(min(total, 16))
+    processes = []
+    # Бэкенд работает в отдельной папке, чтобы uploads/ и data/ не смешивались с рабочими
+    with tempfile.TemporaryDirectory(prefix="odezda-load-") as workdir:
+        try:
+            processes.append(subprocess.Popen(fake_cmd, cwd=BACKEND_DIR))
+            app_process = subprocess.Popen(
+                app_cmd, cwd=workdir, env=app_env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            processes.append(app_process)
+            asyncio.run(wait_ready(f"{fake_url}/stats"))
+            asyncio.run(wait_ready(f"{app_url}/api/health"))
+            results = asyncio.run(run_load(app_url, app_process.pid, args.users, total, photos, args.style, args.timeout))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": {
+            "users": args.users,
+            "requests": total,
+            "style": args.style,
+            "latency": args.latency,
+            "errors": args.errors,
+            "env": args.env,
+        },
+        "results": results,
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"\n💾 Результат сохранен: {output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n📊 Сравнение с {args.baseline} ({baseline.get('git_commit')}):")
+        for line in compare(report, baseline):
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import os
+import copy
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Optional
+
+from metrics import CACHE_EVENTS
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(namespace: str, fingerprint: str, style: str) -> str:
+    """
+    Ключ кэша: пространство имен + отпечаток изображения + нормализованный стиль
+    """
+    normalized_style = " ".join(style.lower().split())
+    digest = hashlib.sha256(f"{namespace}|{fingerprint}|{normalized_style}".encode("utf-8")).hexdigest()
+    return f"{namespace}:{digest}"
+
+
+def make_image_cache_key(fingerprint: str, style: str, recommendations: list) -> str:
+    """
+    Ключ сгенерированного изображения: фото + стиль + набор рекомендаций (вещь и описание)
+
+    Анализ и изображение вытесняются из кэша независимо - без рекомендаций в ключе новый
+    анализ получил бы изображение с одеждой из прежнего. В значении хранятся ссылки
+    хранилища (Storage.to_ref), а не URL с истекающей подписью.
+    """
+    outfit = json.dumps(
+        [[item.get("item"), item.get("description")] for item in recommendations if isinstance(item, dict)],
+        ensure_ascii=False,
+    )
+    outfit_digest = hashlib.sha256(outfit.encode("utf-8")).hexdigest()
+    return make_cache_key("image", fingerprint, f"{' '.join(style.split())}|{outfit_digest}")
+
+
+class MemoryCacheTier:
+    """
+    LRU кэш в памяти процесса с TTL
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.time():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._items[key] = (time.time() + (ttl or self.ttl), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SQLiteCacheTier:
+    """
+    Кэш на диске (SQLite) с TTL и LRU-вытеснением по времени последнего доступа
+    """
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at);
+            """)
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._db() as conn:
+            row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        with self._db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + (ttl or self.ttl), now),
+            )
+            self._writes += 1
+            # Вытесняем просроченные и самые давно использованные записи раз в 100 записей
+            if self._writes % 100 == 0:
+                conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN ("
+                    " SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+
+class ResultCache:
+    """
+    Двухуровневый кэш результатов анализа и сгенерированных изображений
+
+    Значения должны сериализоваться в JSON. Наружу всегда отдаются копии,
+    чтобы вызывающий код мог дополнять результат, не портя кэш.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl: float = 86400,
+        disk_path: Optional[str] = None,
+        disk_max_entries: int = 100000,
+        perceptual: bool = False,
+    ):
+        self.perceptual = perceptual
+        self.memory = MemoryCacheTier(max_entries, ttl)
+        self.disk = SQLiteCacheTier(disk_path, disk_max_entries, ttl) if disk_path else None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "sets": 0}
+
+    def _record(self, event: str) -> None:
+        self.stats[event] += 1
+        CACHE_EVENTS.inc(event=event)
+
+    async def get(self, key: str, record_stats: bool = True) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None:
+            if record_stats:
+                self._record("memory_hits")
+            return copy.deepcopy(value)
+
+        if self.disk:
+            try:
+                value = await asyncio.to_thread(self.disk.get, key)
+            except sqlite3.Error as e:
+                logger.warning("⚠️ Ошибка чтения дискового кэша: %s", e)
+                value = None
+            if value is not None:
+                if record_stats:
+                    self._record("disk_hits")
+                self.memory.set(key, value)
+                return copy.deepcopy(value)
+
+        if record_stats:
+            self._record("misses")
+        return None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._record("sets")
+        self.memory.set(key, copy.deepcopy(value), ttl)
+        if self.disk:
+            try:
+                await asyncio.to_thread(self.disk.set, key, value, ttl)
+            except sqlite3.Error as e:
+                logger.warning("⚠️ Ошибка записи дискового кэша: %s", e)
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        return {
+            **self.stats,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_enabled": self.disk is not None,
+            "perceptual": self.perceptual,
+        }
+
+
+def create_result_cache() -> Optional[ResultCache]:
+    """
+    Создает кэш по переменным окружения (CACHE_ENABLED=0 отключает кэш)
+    """
+    if os.getenv("CACHE_ENABLED", "1").lower() in ("0", "false", "no"):
+        logger.info("🗃️ Кэш результатов отключен")
+        return None
+    return ResultCache(
+        max_entries=int(os.getenv("CACHE_MAX_ENTRIES", 1000)),
+        ttl=float(os.getenv("CACHE_TTL", 86400)),
+        disk_path=os.getenv("CACHE_PATH", "data/cache.sqlite3") or None,
+        disk_max_entries=int(os.getenv("CACHE_DISK_MAX_ENTRIES", 100000)),
+        perceptual=os.getenv("CACHE_PERCEPTUAL_HASH", "0").lower() in ("1", "true", "yes"),
+    )
@@ -0,0 +1,579 @@
+"""
+Локальный каталог товаров для ссылок "Где купить"
+
+Фиды магазинов (CSV/JSONL) импортируются в SQLite; при импорте название, категория,
+бренд и описание приводятся к основам слов (стеммер Snowball для русского языка),
+поэтому "черное пальто женское" находит "Пальто черное, женская коллекция".
+
+Поиск идет по инвертированному индексу в памяти процесса, построенному из SQLite:
+для каждой основы - товары, упорядоченные по вкладу BM25 (готовый вес, без подсчета
+при запросе), причем списки заранее разложены по полу и цвету товара. Фильтр
+"черное ... женское" выбирает несколько коротких списков вместо проверки каждого
+товара, а по каждому списку просматриваются только самые весомые товары. Запросы
+для всех рекомендаций ответа обрабатываются одним вызовом search_many.
+
+Запуск из папки backend:
+    python -m catalog import feed.jsonl [--replace]
+    python -m catalog search "черное пальто женское" [--gender women] [--color черный]
+
+Поля фида (регистр не важен, есть синонимы): id/sku, title/name, url/link, price,
+currency, shop/vendor, image/picture, brand, color, gender, category, description.
+"""
+import os
+import re
+import csv
+import sys
+import json
+import time
+import heapq
+import sqlite3
+import logging
+import argparse
+import threading
+from array import array
+from contextlib import contextmanager
+from functools import lru_cache
+from math import log
+from typing import Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько товаров с наибольшим весом просматривается в каждом списке (основа, пол[, цвет])
+MAX_POSTINGS_PER_TERM = 40
+# Параметры BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Слова названия весят больше, чем описание
+TITLE_BOOST = 2
+
+
+# --- Нормализация русского текста ----------------------------------------------------------
+
+_PERFECTIVE_GERUND = re.compile(r"((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$")
+_REFLEXIVE = re.compile(r"(с[яь])$")
+_ADJECTIVE = re.compile(r"(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$")
+_PARTICIPLE = re.compile(r"((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$")
+_VERB = re.compile(
+    r"((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)"
+    r"|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$"
+)
+_NOUN = re.compile(
+    r"(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$"
+)
+_RV = re.compile(r"^(.*?[аеиоуыэюя])(.*)$")
+_DERIVATIONAL = re.compile(r".*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$")
+_WORD = re.compile(r"[0-9a-zа-яё]+")
+
+
+@lru_cache(maxsize=100_000)
+def stem(word: str) -> str:
+    """
+    Основа слова по алгоритму Snowball (Porter) для русского языка; латиница не меняется
+    """
+    word = word.lower().replace("ё", "е")
+    match = _RV.match(word)
+    if not match:
+        return word
+    prefix, rv = match.groups()
+
+    stripped = _PERFECTIVE_GERUND.sub("", rv, 1)
+    if stripped == rv:
+        rv = _REFLEXIVE.sub("", rv, 1)
+        stripped = _ADJECTIVE.sub("", rv, 1)
+        if stripped != rv:
+            rv = _PARTICIPLE.sub("", stripped, 1)
+        else:
+            stripped = _VERB.sub("", rv, 1)
+            rv = _NOUN.sub("", rv, 1) if stripped == rv else stripped
+    else:
+        rv = stripped
+
+    if rv.endswith("и"):
+        rv = rv[:-1]
+    if _DERIVATIONAL.match(rv):
+        rv = re.sub(r"ость?$", "", rv, 1)
+    if rv.endswith("ь"):
+        rv = rv[:-1]
+    else:
+        rv = re.sub(r"(ейше|ейш)$", "", rv, 1)
+        if rv.endswith("нн"):
+            rv = rv[:-1]
+    return prefix + rv
+
+
+def normalize(text: str) -> List[str]:
+    """
+    Текст -> основы слов (без слов короче двух букв)
+    """
+    return [stem(word) for word in _WORD.findall((text or "").lower()) if len(word) > 1]
+
+
+# Основы слов, задающих пол, и значения фильтра gender
+GENDER_STEMS = {
+    "женск": "women", "женщин": "women", "девушк": "women", "women": "women", "female": "women", "woman": "women",
+    "мужск": "men", "мужчин": "men", "men": "men", "male": "men", "man": "men",
+    "детск": "kids", "дет": "kids", "девочк": "kids", "мальчик": "kids", "kids": "kids",
+    "унисекс": "unisex", "unisex": "unisex",
+}
+GENDERS = ("women", "men", "kids", "unisex")
+
+# Основы цветов (значение фильтра color - основа)
+COLOR_STEMS = {
+    "черн", "бел", "сер", "красн", "син", "голуб", "зелен", "желт", "оранжев", "розов",
+    "фиолетов", "коричнев", "бежев", "хак", "бордов", "серебрист", "золот", "молочн",
+    "кремов", "бирюзов", "сиренев", "горчичн", "оливков", "графитов", "песочн",
+}
+
+
+def normalize_gender(value: Optional[str]) -> Optional[str]:
+    if not value:
+        return None
+    value = value.strip().lower()
+    if value in GENDERS:
+        return value
+    for term in normalize(value):
+        if term in GENDER_STEMS:
+            return GENDER_STEMS[term]
+    return None
+
+
+def normalize_color(value: Optional[str]) -> Optional[str]:
+    """
+    "Темно-синий" -> "син" (последний распознанный цвет); нераспознанный цвет - основа целиком
+    """
+    terms = normalize(value or "")
+    colors = [term for term in terms if term in COLOR_STEMS]
+    if colors:
+        return colors[-1]
+    return " ".join(terms) or None
+
+
+def normalize_category(value: Optional[str]) -> Optional[str]:
+    return " ".join(normalize(value or "")) or None
+
+
+def parse_query(text: str) -> tuple:
+    """
+    Поисковый запрос -> (основы для поиска, пол, цвет); слова пола уходят в фильтр
+    """
+    terms, gender, color = [], None, None
+    for term in normalize(text):
+        if term in GENDER_STEMS:
+            gender = gender or GENDER_STEMS[term]
+            continue
+        if term in COLOR_STEMS:
+            color = color or term
+        if term not in terms:
+            terms.append(term)
+    return terms, gender, color
+
+
+# --- Импорт фидов ---------------------------------------------------------------------------
+
+FIELD_ALIASES = {
+    "id": ("id", "sku", "offer_id", "article"),
+    "title": ("title", "name", "model"),
+    "url": ("url", "link"),
+    "price": ("price",),
+    "currency": ("currency", "currencyid"),
+    "shop": ("shop", "vendor_shop", "store", "marketplace"),
+    "image": ("image", "picture", "image_url"),
+    "brand": ("brand", "vendor"),
+    "color": ("color", "colour", "цвет"),
+    "gender": ("gender", "sex", "пол"),
+    "category": ("category", "category_name", "категория"),
+    "description": ("description", "desc"),
+}
+
+
+def _canonical(record: dict) -> Optional[dict]:
+    lowered = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+    product = {}
+    for field, aliases in FIELD_ALIASES.items():
+        for alias in aliases:
+            value = lowered.get(alias)
+            if value not in (None, ""):
+                product[field] = value
+                break
+    if not product.get("title") or not product.get("url"):
+        return None
+    product.setdefault("id", product["url"])
+    try:
+        product["price"] = float(str(product["price"]).replace(",", ".").replace(" ", "")) if "price" in product else None
+    except ValueError:
+        product["price"] = None
+    return product
+
+
+def read_feed(path: str) -> Iterator[dict]:
+    """
+    Товары из CSV (с заголовком) или JSONL; строки без названия или ссылки пропускаются
+    """
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            records: Iterable = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for record in records:
+            product = _canonical(record)
+            if product:
+                yield product
+
+
+# --- Каталог --------------------------------------------------------------------------------
+
+class ProductCatalog:
+    """
+    Товары в SQLite + инвертированный индекс в памяти
+
+    Индекс строится при первом поиске (или load()) и перестраивается, если каталог
+    был импортирован заново (проверка версии не чаще раза в reload_interval секунд).
+    """
+
+    def __init__(self, path: str, top_k: int = 3, reload_interval: float = 60):
+        self.path = path
+        self.top_k = top_k
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        # (term, код пола) и (term, код пола, цвет) -> (array doc_ids, array weights), по убыванию веса
+        self._postings: dict = {}
+        # id товара по номеру документа: карточки читаются по id, а не по rowid - после
+        # импорта (INSERT OR REPLACE, --replace) rowid указывает на другой товар
+        self._ids: list = []
+        self._categories: list = []
+        # Соединение для чтения карточек найденных товаров (открывается один раз)
+        self._reader: Optional[sqlite3.Connection] = None
+        self.stats = {"products": 0, "terms": 0, "searches": 0, "load_seconds": 0.0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS products (
+                    id TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    price REAL,
+                    currency TEXT,
+                    shop TEXT,
+                    image TEXT,
+                    brand TEXT,
+                    color TEXT,
+                    gender TEXT,
+                    category TEXT,
+                    description TEXT,
+                    title_terms TEXT NOT NULL,
+                    text_terms TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS catalog_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+            # Каталоги, импортированные до появления описаний (нужны для семантического поиска)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(products)")}
+            if "description" not in columns:
+                conn.execute("ALTER TABLE products ADD COLUMN description TEXT")
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # Импорт
+
+    def import_products(self, products: Iterable[dict], replace: bool = False) -> int:
+        """
+        Добавляет/обновляет товары (по id); replace=True - сначала очищает каталог
+        """
+        count = 0
+        with self._db() as conn:
+            if replace:
+                conn.execute("DELETE FROM products")
+            batch = []
+            for product in products:
+                batch.append(self._row(product))
+                if len(batch) >= 1000:
+                    count += self._insert(conn, batch)
+                    batch = []
+            count += self._insert(conn, batch)
+            conn.execute(
+                "INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('version', ?)",
+                (str(time.time()),),
+            )
+        self._checked_at = 0.0
+        return count
+
+    @staticmethod
+    def _row(product: dict) -> tuple:
+        text = " ".join(str(product.get(field) or "") for field in ("category", "brand", "description", "color"))
+        return (
+            str(product["id"]),
+            product["title"],
+            product["url"],
+            product.get("price"),
+            product.get("currency") or "RUB",
+            product.get("shop"),
+            product.get("image"),
+            product.get("brand"),
+            normalize_color(product.get("color")),
+            normalize_gender(product.get("gender")) or normalize_gender(product["title"]),
+            normalize_category(product.get("category")),
+            product.get("description"),
+            " ".join(normalize(product["title"])),
+            " ".join(normalize(text)),
+        )
+
+    @staticmethod
+    def _insert(conn, rows: list) -> int:
+        conn.executemany(
+            "INSERT OR REPLACE INTO products (id, title, url, price, currency, shop, image, brand,"
+            " color, gender, category, description, title_terms, text_terms)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        return len(rows)
+
+    # Индекс
+
+    def _current_version(self) -> Optional[str]:
+        with self._db() as conn:
+            row = conn.execute("SELECT value FROM catalog_meta WHERE key = 'version'").fetchone()
+        return row[0] if row else None
+
+    def ensure_loaded(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval and self._version is not None:
+            return
+        self._checked_at = now
+        version = self._current_version()
+        if version != self._version:
+            self.load(version)
+
+    def load(self, version: Optional[str] = None) -> None:
+        """
+        Строит индекс из SQLite (при старте - в пуле потоков, несколько секунд на 100 тыс. товаров)
+        """
+        started = time.perf_counter()
+        version = version or self._current_version()
+        postings: dict = {}
+        lengths = []
+        ids = []
+        genders = bytearray()
+        colors, categories = [], []
+        with self._db() as conn:
+            rows = conn.execute("SELECT id, gender, color, category, title_terms, text_terms FROM products")
+            for doc, (product_id, gender, color, category, title_terms, text_terms) in enumerate(rows):
+                ids.append(product_id)
+                genders.append(GENDERS.index(gender) + 1 if gender in GENDERS else 0)
+                colors.append(color)
+                categories.append(category)
+                counts: dict = {}
+                title_words = title_terms.split()
+                for term in title_words:
+                    counts[term] = counts.get(term, 0) + TITLE_BOOST
+                text_words = text_terms.split()
+                for term in text_words:
+                    counts[term] = counts.get(term, 0) + 1
+                lengths.append(TITLE_BOOST * len(title_words) + len(text_words))
+                for term, tf in counts.items():
+                    postings.setdefault(term, []).append((doc, tf))
+
+        total = len(ids)
+        avg_length = (sum(lengths) / total) if total else 1.0
+        buckets: dict = {}
+        for term, docs in postings.items():
+            idf = log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, tf in docs:
+                weight = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc] / avg_length))
+                gender = genders[doc]
+                buckets.setdefault((term, gender), []).append((weight, doc))
+                if colors[doc]:
+                    buckets.setdefault((term, gender, colors[doc]), []).append((weight, doc))
+        index = {}
+        for key, weighted in buckets.items():
+            weighted.sort(reverse=True)
+            index[key] = (array("I", (doc for _, doc in weighted)), array("f", (weight for weight, _ in weighted)))
+
+        with self._lock:
+            self._postings = index
+            self._ids = ids
+            self._categories = categories
+            self._version = version
+        self.stats.update(products=total, terms=len(postings), load_seconds=round(time.perf_counter() - started, 3))
+        logger.info("🛍️ Каталог загружен: %s товаров, %s основ за %.2f сек", total, len(postings), time.perf_counter() - started)
+
+    # Поиск
+
+    def _top_docs(self, terms: list, k: int, gender: Optional[str], color: Optional[str], category: Optional[str]) -> list:
+        if gender in GENDERS:
+            # Товары без пола и унисекс подходят под любой фильтр пола
+            allowed_genders = {0, GENDERS.index(gender) + 1, GENDERS.index("unisex") + 1}
+        else:
+            allowed_genders = range(len(GENDERS) + 1)
+        scores: dict = {}
+        for term in terms:
+            # Основа цвета при фильтре по цвету есть у всех кандидатов и порядок не меняет
+            if term == color and len(terms) > 1:
+                continue
+            for code in allowed_genders:
+                entry = self._postings.get((term, code, color) if color else (term, code))
+                if entry is None:
+                    continue
+                docs, weights = entry
+                for position in range(min(len(docs), MAX_POSTINGS_PER_TERM)):
+                    doc = docs[position]
+                    if category is not None and self._categories[doc] != category:
+                        continue
+                    scores[doc] = scores.get(doc, 0.0) + weights[position]
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def search_many(
+        self,
+        queries: List[str],
+        k: Optional[int] = None,
+        gender: Optional[str] = None,
+        color: Optional[str] = None,
+        category: Optional[str] = None,
+    ) -> List[list]:
+        """
+        Лучшие k товаров для каждого запроса - одним вызовом для всех рекомендаций ответа
+
+        Пол и цвет берутся из запроса ("черное пальто женское"), явные фильтры важнее.
+        Если с фильтром цвета товаров меньше k, список дополняется товарами без этого
+        фильтра. Возвращает списки словарей товара со score, в порядке запросов.
+        """
+        self.ensure_loaded()
+        k = k or self.top_k
+        gender = normalize_gender(gender)
+        color = normalize_color(color) if color else None
+        category = normalize_category(category)
+
+        matches = []
+        with self._lock:
+            for query in queries:
+                terms, query_gender, query_color = parse_query(query)
+                wanted_gender = gender or query_gender
+                wanted_color = color or query_color
+                top = self._top_docs(terms, k, wanted_gender, wanted_color, category)
+                if len(top) < k and wanted_color is not None:
+                    found = {doc for doc, _ in top}
+                    extra = self._top_docs(terms, k, wanted_gender, None, category)
+                    top += [item for item in extra if item[0] not in found][:k - len(top)]
+                matches.append([(self._ids[doc], score) for doc, score in top])
+            self.stats["searches"] += len(queries)
+
+            ids = {product_id for top in matches for product_id, _ in top}
+            products = self._fetch(ids) if ids else {}
+        return [
+            [{**products[product_id], "score": round(score, 3)} for product_id, score in top if product_id in products]
+            for top in matches
+        ]
+
+    def search(self, query: str, k: Optional[int] = None, **filters) -> list:
+        return self.search_many([query], k, **filters)[0]
+
+    def _fetch(self, ids: set) -> dict:
+        # Вызывается под self._lock; товары, удаленные после загрузки индекса, пропускаются
+        if self._reader is None:
+            self._reader = sqlite3.connect(self.path, check_same_thread=False)
+        placeholders = ",".join("?" * len(ids))
+        rows = self._reader.execute(
+            "SELECT id, title, url, price, currency, shop, image, brand, color, gender, category"
+            f" FROM products WHERE id IN ({placeholders})",
+            tuple(ids),
+        ).fetchall()
+        return {
+            row[0]: {
+                "id": row[0], "title": row[1], "url": row[2], "price": row[3], "currency": row[4],
+                "shop": row[5], "image": row[6], "brand": row[7], "color": row[8], "gender": row[9],
+                "category": row[10],
+            }
+            for row in rows
+        }
+
+    def get_products(self, ids: Iterable[str]) -> dict:
+        """
+        {id: товар} по id (для совпадений семантического поиска)
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+        with self._lock:
+            return self._fetch(set(ids))
+
+    def iter_texts(self) -> Iterator[tuple]:
+        """
+        (id, текст товара) для построения векторного индекса: название, бренд, описание
+        """
+        with self._db() as conn:
+            for product_id, title, brand, description in conn.execute(
+                "SELECT id, title, brand, description FROM products ORDER BY rowid"
+            ):
+                yield product_id, ". ".join(part for part in (title, brand, description) if part)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "path": self.path, "top_k": self.top_k}
+
+
+def create_catalog() -> Optional[ProductCatalog]:
+    """
+    Каталог из CATALOG_PATH; None, если файл каталога еще не импортирован
+    """
+    path = os.getenv("CATALOG_PATH", "data/catalog.sqlite3")
+    if not path or not os.path.exists(path):
+        logger.info("🛍️ Каталог товаров не найден (%s) - ссылки ведут на поиск маркетплейсов", path or "CATALOG_PATH пуст")
+        return None
+    return ProductCatalog(
+        path,
+        top_k=int(os.getenv("CATALOG_TOP_K", 3)),
+        reload_interval=float(os.getenv("CATALOG_RELOAD_INTERVAL", 60)),
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default=os.getenv("CATALOG_PATH", "data/catalog.sqlite3"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="импорт фида CSV/JSONL")
+    import_parser.add_argument("feeds", nargs="+")
+    import_parser.add_argument("--replace", action="store_true", help="очистить каталог перед импортом")
+    search_parser = commands.add_parser("search", help="проверка поиска")
+    search_parser.add_argument("queries", nargs="+")
+    search_parser.add_argument("-k", type=int, default=3)
+    search_parser.add_argument("--gender")
+    search_parser.add_argument("--color")
+    search_parser.add_argument("--category")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    catalog = ProductCatalog(args.path)
+    if args.command == "import":
+        total = 0
+        for index, feed in enumerate(args.feeds):
+            count = catalog.import_products(read_feed(feed), replace=args.replace and index == 0)
+            logger.info("✅ %s: %s товаров", feed, count)
+            total += count
+        print(json.dumps({"imported": total, "path": args.path}, ensure_ascii=False))
+        return 0
+
+    catalog.load()
+    started = time.perf_counter()
+    results = catalog.search_many(args.queries, args.k, gender=args.gender, color=args.color, category=args.category)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(json.dumps(
+        {"elapsed_ms": round(elapsed_ms, 3), "results": dict(zip(args.queries, results))},
+        ensure_ascii=False, indent=2,
+    ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
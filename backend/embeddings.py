@@ -0,0 +1,408 @@
+"""
+Семантический подбор товаров каталога к рекомендациям GPT-4o
+
+Тексты товаров каталога (название, бренд, описание) заранее переводятся в векторы
+(OpenAI embeddings) и хранятся на диске матрицей float32, которую сервер открывает
+через numpy.memmap: файл не читается в память целиком, ОС держит в кэше только
+используемые страницы. При ответе все рекомендации (item + description) переводятся
+в векторы одним запросом к API, а ближайшие товары для всех рекомендаций находятся
+одним умножением матриц на CPU (векторы нормированы - скалярное произведение
+равно косинусной близости).
+
+Индекс обновляется инкрементально: sync добавляет векторы новых и измененных товаров
+в конец файла и помечает удаленные, сервер подхватывает изменения без перезапуска
+(проверка раз в EMBEDDINGS_RELOAD_INTERVAL секунд). compact переписывает матрицу без
+удаленных строк в новый файл.
+
+Запуск из папки backend (нужны каталог - python -m catalog import - и OPENAI_API_KEY):
+    python -m embeddings sync [--batch 256]
+    python -m embeddings search "черное шерстяное пальто"
+    python -m embeddings compact
+
+Нужен numpy (необязательная зависимость); без него подбор идет только по тексту.
+"""
+import os
+import sys
+import json
+import base64
+import time
+import asyncio
+import hashlib
+import sqlite3
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_MODEL = "text-embedding-3-small"
+# Модели text-embedding-3 умеют укорачивать вектор: 256 измерений - 100 МБ на 100 тыс. товаров
+DEFAULT_DIMENSIONS = 256
+# Константа reciprocal rank fusion: чем больше, тем ровнее вклад нижних позиций
+RRF_K = 60
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+async def embed_texts(client, texts: List[str], model: str = DEFAULT_MODEL, dimensions: Optional[int] = DEFAULT_DIMENSIONS):
+    """
+    Векторы текстов одним запросом к OpenAI embeddings -> нормированная матрица float32
+    """
+    kwargs = {"dimensions": dimensions} if dimensions else {}
+    # base64 - сырые float32: меньше ответ и без разбора тысяч чисел из JSON
+    response = await client.embeddings.create(model=model, input=texts, encoding_format="base64", **kwargs)
+    data = sorted(response.data, key=lambda item: item.index)
+    return normalize_rows(np.stack([np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32) for item in data]))
+
+
+def recommendation_text(recommendation: dict) -> str:
+    return ". ".join(
+        str(recommendation.get(field) or "") for field in ("item", "description") if recommendation.get(field)
+    )
+
+
+def fuse_rankings(rankings: Iterable[list], k: int, key: str = "id") -> list:
+    """
+    Объединяет несколько упорядоченных списков товаров (reciprocal rank fusion)
+
+    Товар, найденный и по словам, и по смыслу, поднимается выше; шкалы BM25 и
+    косинусной близости несравнимы, поэтому учитываются только позиции.
+    """
+    scores: dict = {}
+    items: dict = {}
+    for ranking in rankings:
+        for position, item in enumerate(ranking):
+            scores[item[key]] = scores.get(item[key], 0.0) + 1.0 / (RRF_K + position + 1)
+            items.setdefault(item[key], item)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [items[item_id] for item_id in best]
+
+
+class VectorIndex:
+    """
+    Матрица векторов товаров (файл float32, строки дописываются в конец) + SQLite с
+    соответствием строк товарам и отметками удаления
+
+    Порядок записи: сначала векторы в файл, затем одной транзакцией строки и meta.rows.
+    Читатель берет из meta число готовых строк, поэтому недописанный хвост файла не виден.
+    """
+
+    def __init__(self, directory: str, reload_interval: float = 60):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        # (матрица memmap, id товаров по строкам, маска живых строк) - заменяется целиком
+        self._snapshot = None
+        # meta загруженного снимка: model и dimensions в запросах читаются отсюда, без SQLite
+        self._loaded_meta: Optional[dict] = None
+        self.stats = {"rows": 0, "alive": 0, "searches": 0, "load_seconds": 0.0}
+        os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS vector_rows (
+                    row INTEGER PRIMARY KEY,
+                    product_id TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    deleted INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS vector_rows_product ON vector_rows (product_id);
+                CREATE TABLE IF NOT EXISTS vector_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def meta(self) -> dict:
+        with self._db() as conn:
+            return dict(conn.execute("SELECT key, value FROM vector_meta"))
+
+    def _current_meta(self) -> dict:
+        return self._loaded_meta if self._loaded_meta is not None else self.meta()
+
+    @property
+    def model(self) -> str:
+        return self._current_meta().get("model", DEFAULT_MODEL)
+
+    @property
+    def dimensions(self) -> Optional[int]:
+        value = self._current_meta().get("dimensions")
+        return int(value) if value else None
+
+    # Запись (офлайн, один процесс sync/compact за раз)
+
+    def hashes(self) -> dict:
+        """
+        {id товара: хэш текста} для живых строк
+        """
+        with self._db() as conn:
+            return dict(conn.execute("SELECT product_id, text_hash FROM vector_rows WHERE deleted = 0"))
+
+    def append(self, product_ids: List[str], hashes: List[str], vectors, model: str) -> None:
+        """
+        Дописывает векторы товаров; прежние строки этих товаров помечаются удаленными
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        meta = self.meta()
+        if meta.get("dimensions") and int(meta["dimensions"]) != vectors.shape[1]:
+            raise ValueError(f"размерность {vectors.shape[1]} не совпадает с индексом ({meta['dimensions']})")
+        if meta.get("model") and meta["model"] != model:
+            raise ValueError(f"модель {model} не совпадает с индексом ({meta['model']}) - нужен новый индекс")
+        rows = int(meta.get("rows", 0))
+        filename = meta.get("file") or "vectors-0.f32"
+        with open(os.path.join(self.directory, filename), "r+b" if rows else "wb") as f:
+            f.seek(rows * vectors.shape[1] * 4)
+            f.write(vectors.tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self._db() as conn:
+            conn.executemany(
+                "UPDATE vector_rows SET deleted = 1 WHERE product_id = ? AND deleted = 0",
+                [(product_id,) for product_id in product_ids],
+            )
+            conn.executemany(
+                "INSERT INTO vector_rows (row, product_id, text_hash) VALUES (?, ?, ?)",
+                [(rows + offset, product_id, hash_) for offset, (product_id, hash_) in enumerate(zip(product_ids, hashes))],
+            )
+            self._write_meta(conn, rows=rows + len(product_ids), file=filename, model=model, dimensions=vectors.shape[1])
+
+    def delete(self, product_ids: Iterable[str]) -> int:
+        with self._db() as conn:
+            count = conn.executemany(
+                "UPDATE vector_rows SET deleted = 1 WHERE product_id = ? AND deleted = 0",
+                [(product_id,) for product_id in product_ids],
+            ).rowcount
+            self._write_meta(conn)
+        return count
+
+    def compact(self) -> int:
+        """
+        Переписывает матрицу без удаленных строк в новый файл; возвращает число строк
+
+        Сервер, который еще читает старый файл, продолжает работать со своим отображением
+        и переключается на новый файл при следующей проверке версии.
+        """
+        meta = self.meta()
+        rows = int(meta.get("rows", 0))
+        if not rows:
+            return 0
+        dimensions = int(meta["dimensions"])
+        old_file = meta["file"]
+        vectors = np.memmap(os.path.join(self.directory, old_file), dtype=np.float32, mode="r", shape=(rows, dimensions))
+        with self._db() as conn:
+            alive = conn.execute("SELECT row, product_id, text_hash FROM vector_rows WHERE deleted = 0 ORDER BY row").fetchall()
+        new_file = f"vectors-{int(time.time())}.f32"
+        with open(os.path.join(self.directory, new_file), "wb") as f:
+            for start in range(0, len(alive), 10000):
+                f.write(np.ascontiguousarray(vectors[[row for row, _, _ in alive[start:start + 10000]]]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        del vectors
+
+        with self._db() as conn:
+            conn.execute("DELETE FROM vector_rows")
+            conn.executemany(
+                "INSERT INTO vector_rows (row, product_id, text_hash) VALUES (?, ?, ?)",
+                [(row, product_id, hash_) for row, (_, product_id, hash_) in enumerate(alive)],
+            )
+            self._write_meta(conn, rows=len(alive), file=new_file)
+        if old_file != new_file:
+            os.remove(os.path.join(self.directory, old_file))
+        return len(alive)
+
+    @staticmethod
+    def _write_meta(conn, **values) -> None:
+        values["version"] = str(time.time())
+        conn.executemany(
+            "INSERT OR REPLACE INTO vector_meta (key, value) VALUES (?, ?)",
+            [(key, str(value)) for key, value in values.items()],
+        )
+
+    # Чтение (сервер)
+
+    def ensure_loaded(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval and self._snapshot is not None:
+            return
+        self._checked_at = now
+        meta = self.meta()
+        if meta.get("version") != self._version:
+            self.load(meta)
+
+    def load(self, meta: Optional[dict] = None) -> None:
+        started = time.perf_counter()
+        meta = meta or self.meta()
+        rows = int(meta.get("rows", 0))
+        dimensions = int(meta.get("dimensions", 0) or DEFAULT_DIMENSIONS)
+        ids: List[Optional[str]] = [None] * rows
+        alive = np.zeros(rows, dtype=bool)
+        with self._db() as conn:
+            for row, product_id, deleted in conn.execute(
+                "SELECT row, product_id, deleted FROM vector_rows WHERE row < ?", (rows,)
+            ):
+                ids[row] = product_id
+                alive[row] = not deleted
+        if rows:
+            vectors = np.memmap(os.path.join(self.directory, meta["file"]), dtype=np.float32, mode="r", shape=(rows, dimensions))
+        else:
+            vectors = np.zeros((0, dimensions), dtype=np.float32)
+
+        with self._lock:
+            self._snapshot = (vectors, ids, alive)
+            self._loaded_meta = meta
+            self._version = meta.get("version")
+        self.stats.update(rows=rows, alive=int(alive.sum()), load_seconds=round(time.perf_counter() - started, 3))
+        logger.info("🧭 Векторный индекс загружен: %s товаров (%s строк)", self.stats["alive"], rows)
+
+    def search_many(self, queries, k: int) -> List[list]:
+        """
+        [(id товара, близость)] - k ближайших товаров для каждой строки нормированной матрицы queries
+        """
+        self.ensure_loaded()
+        with self._lock:
+            vectors, ids, alive = self._snapshot
+            deleted = self.stats["alive"] < self.stats["rows"]
+            self.stats["searches"] += len(queries)
+        if not len(vectors) or not len(queries):
+            return [[] for _ in range(len(queries))]
+        # (строки индекса x запросы) одним умножением; удаленные строки не участвуют
+        scores = vectors @ np.asarray(queries, dtype=np.float32).T
+        if deleted:
+            scores[~alive] = -np.inf
+        k = min(k, len(vectors))
+        top = np.argpartition(-scores, k - 1, axis=0)[:k]
+        results = []
+        for column in range(scores.shape[1]):
+            rows = top[np.argsort(-scores[top[:, column], column]), column]
+            results.append([(ids[row], float(scores[row, column])) for row in rows if alive[row]])
+        return results
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "directory": self.directory, "version": self._version}
+
+
+def create_vector_index() -> Optional[VectorIndex]:
+    """
+    Индекс из EMBEDDINGS_PATH; None без numpy или если индекс еще не построен (python -m embeddings sync)
+    """
+    path = os.getenv("EMBEDDINGS_PATH", "data/embeddings")
+    if not path or os.getenv("EMBEDDINGS_ENABLED", "1") == "0":
+        return None
+    if np is None:
+        logger.info("🧭 numpy не установлен - товары подбираются только по тексту запроса")
+        return None
+    if not os.path.exists(os.path.join(path, "index.sqlite3")):
+        logger.info("🧭 Векторный индекс не найден (%s) - товары подбираются только по тексту запроса", path)
+        return None
+    return VectorIndex(path, reload_interval=float(os.getenv("EMBEDDINGS_RELOAD_INTERVAL", 60)))
+
+
+async def sync_index(index: VectorIndex, catalog, client, model: str, dimensions: Optional[int], batch: int = 256) -> dict:
+    """
+    Досчитывает векторы новых и измененных товаров каталога, помечает удаленные
+    """
+    known = index.hashes()
+    seen = set()
+    pending = []
+    for product_id, text in catalog.iter_texts():
+        seen.add(product_id)
+        hash_ = text_hash(text)
+        if known.get(product_id) != hash_:
+            pending.append((product_id, hash_, text))
+    removed = index.delete(set(known) - seen)
+
+    for start in range(0, len(pending), batch):
+        chunk = pending[start:start + batch]
+        vectors = await embed_texts(client, [text for _, _, text in chunk], model, dimensions)
+        index.append([product_id for product_id, _, _ in chunk], [hash_ for _, hash_, _ in chunk], vectors, model)
+        logger.info("🧭 Векторы: %s/%s", min(start + batch, len(pending)), len(pending))
+
+    return {
+        "added": sum(1 for product_id, _, _ in pending if product_id not in known),
+        "updated": sum(1 for product_id, _, _ in pending if product_id in known),
+        "removed": removed,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default=os.getenv("EMBEDDINGS_PATH", "data/embeddings"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    sync_parser = commands.add_parser("sync", help="досчитать векторы новых/измененных товаров каталога")
+    sync_parser.add_argument("--batch", type=int, default=256, help="текстов в одном запросе к API")
+    search_parser = commands.add_parser("search", help="проверка поиска")
+    search_parser.add_argument("queries", nargs="+")
+    search_parser.add_argument("-k", type=int, default=3)
+    commands.add_parser("compact", help="переписать матрицу без удаленных строк")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if np is None:
+        parser.error("нужен numpy: pip install numpy")
+
+    from dotenv import load_dotenv
+    from openai import AsyncOpenAI
+    from catalog import ProductCatalog
+
+    load_dotenv()
+    index = VectorIndex(args.path)
+    if args.command == "compact":
+        print(json.dumps({"rows": index.compact()}, ensure_ascii=False))
+        return 0
+
+    client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=os.getenv("OPENAI_BASE_URL") or None)
+    catalog = ProductCatalog(os.getenv("CATALOG_PATH", "data/catalog.sqlite3"))
+    if args.command == "sync":
+        model = os.getenv("EMBEDDINGS_MODEL", index.meta().get("model", DEFAULT_MODEL))
+        dimensions = int(os.getenv("EMBEDDINGS_DIMENSIONS", index.dimensions or DEFAULT_DIMENSIONS)) or None
+        result = asyncio.run(sync_index(index, catalog, client, model, dimensions, args.batch))
+        print(json.dumps(result, ensure_ascii=False))
+        return 0
+
+    started = time.perf_counter()
+    queries = asyncio.run(embed_texts(client, args.queries, index.model, index.dimensions))
+    hits = index.search_many(queries, args.k)
+    products = catalog.get_products(product_id for found in hits for product_id, _ in found)
+    print(json.dumps(
+        {
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            "results": {
+                query: [{"similarity": round(score, 3), **products.get(product_id, {"id": product_id})} for product_id, score in found]
+                for query, found in zip(args.queries, hits)
+            },
+        },
+        ensure_ascii=False, indent=2,
+    ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+"""
+История анализов: результаты, рекомендации, сгенерированные изображения и id задач провайдеров
+
+Каждый результат конвейера сохраняется в SQLite (WAL), чтобы вернувшийся пользователь
+и поддержка получали его за миллисекунды, не вызывая OpenAI и NanoBanana повторно:
+    GET /api/history           - анализы клиента (заголовок X-Client-Id), новые сначала
+    GET /api/analyses/{id}     - полный результат, как в /api/analyze
+
+Пагинация по курсору (created_at, id): страница - один проход по индексу
+(client_id, created_at, id) без OFFSET, поэтому дальние страницы не медленнее первых.
+
+Ссылки на изображения хранятся без срока действия (Storage.to_ref) и подписываются
+заново при чтении. Анализы старше max_age удаляются фоновым проходом - по умолчанию
+столько же, сколько уборщик хранит файлы в uploads.
+"""
+import os
+import re
+import json
+import time
+import base64
+import asyncio
+import sqlite3
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Анонимный id клиента (браузера) из заголовка X-Client-Id; фоновые задачи наследуют его из контекста
+client_id_var: ContextVar[Optional[str]] = ContextVar("client_id", default=None)
+
+CLIENT_HEADER = "x-client-id"
+_VALID_CLIENT_ID = re.compile(r"^[A-Za-z0-9-]{8,64}$")
+
+MAX_PAGE_SIZE = 100
+
+
+def current_client_id() -> Optional[str]:
+    return client_id_var.get()
+
+
+def valid_client_id(value: Optional[str]) -> Optional[str]:
+    return value if value and _VALID_CLIENT_ID.match(value) else None
+
+
+class ClientIdMiddleware:
+    """
+    ASGI middleware: кладет X-Client-Id запроса в контекст - с ним сохраняется история
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope.get("headers") or []).get(CLIENT_HEADER.encode(), b"").decode("latin-1")
+        token = client_id_var.set(valid_client_id(incoming))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            client_id_var.reset(token)
+
+
+def encode_cursor(created_at: float, analysis_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{created_at!r}:{analysis_id}".encode()).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Бросает ValueError для испорченного курсора
+    """
+    created_at, _, analysis_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode().partition(":")
+    return float(created_at), analysis_id
+
+
+class HistoryStore:
+    """
+    Хранилище истории в SQLite; синхронные методы выполняются в потоке (asyncio.to_thread)
+
+    analyses - одна строка на результат (без рекомендаций), recommendations - по строке
+    на рекомендацию (для списка истории читаются только названия вещей).
+    """
+
+    def __init__(self, path: str, max_age: Optional[float] = None, interval: float = 3600):
+        self.path = path
+        self.max_age = max_age
+        self.interval = interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS analyses (
+                    id TEXT PRIMARY KEY,
+                    client_id TEXT,
+                    style TEXT NOT NULL,
+                    photo_sha256 TEXT,
+                    trace_id TEXT,
+                    nanobanana_task_id TEXT,
+                    generated_image TEXT,
+                    placeholder TEXT,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS analyses_client_created ON analyses (client_id, created_at, id);
+                CREATE INDEX IF NOT EXISTS analyses_created ON analyses (created_at, id);
+                CREATE INDEX IF NOT EXISTS analyses_task ON analyses (nanobanana_task_id)
+                    WHERE nanobanana_task_id IS NOT NULL;
+                CREATE INDEX IF NOT EXISTS analyses_trace ON analyses (trace_id);
+                CREATE TABLE IF NOT EXISTS recommendations (
+                    analysis_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    item TEXT,
+                    search_query TEXT,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (analysis_id, position)
+                ) WITHOUT ROWID;
+            """)
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _run(self, func, *args):
+        return asyncio.to_thread(func, *args)
+
+    def _record_sync(self, entry: dict) -> None:
+        result = dict(entry["result"])
+        recommendations = result.pop("recommendations", None) or []
+        variants = result.get("generated_image_variants") or {}
+        with self._db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (id, client_id, style, photo_sha256, trace_id, nanobanana_task_id, "
+                "generated_image, placeholder, result, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry["id"], entry.get("client_id"), entry["style"], entry.get("photo_sha256"), entry.get("trace_id"),
+                 entry.get("nanobanana_task_id"), result.get("generated_image"), variants.get("placeholder"),
+                 json.dumps(result, ensure_ascii=False), entry.get("created_at") or time.time()),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO recommendations (analysis_id, position, item, search_query, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (entry["id"], position, item.get("item"), item.get("search_query"), json.dumps(item, ensure_ascii=False))
+                    for position, item in enumerate(recommendations)
+                    if isinstance(item, dict)
+                ],
+            )
+
+    def _get_sync(self, analysis_id: str) -> Optional[dict]:
+        with self._db() as conn:
+            row = conn.execute(
+                "SELECT id, style, nanobanana_task_id, trace_id, result, created_at FROM analyses WHERE id = ?",
+                (analysis_id,),
+            ).fetchone()
+            if not row:
+                return None
+            recommendations = conn.execute(
+                "SELECT data FROM recommendations WHERE analysis_id = ? ORDER BY position", (analysis_id,)
+            ).fetchall()
+        return {
+            "id": row[0],
+            "style": row[1],
+            "nanobanana_task_id": row[2],
+            "trace_id": row[3],
+            "created_at": row[5],
+            "result": {**json.loads(row[4]), "recommendations": [json.loads(data) for (data,) in recommendations]},
+        }
+
+    def _list_sync(self, client_id: Optional[str], limit: int, cursor: Optional[tuple], task_id: Optional[str]) -> dict:
+        conditions, params = [], []
+        if client_id is not None:
+            conditions.append("client_id = ?")
+            params.append(client_id)
+        if task_id:
+            conditions.append("nanobanana_task_id = ?")
+            params.append(task_id)
+        if cursor:
+            conditions.append("(created_at, id) < (?, ?)")
+            params.extend(cursor)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._db() as conn:
+            rows = conn.execute(
+                f"SELECT id, style, generated_image, placeholder, created_at FROM analyses {where} "
+                f"ORDER BY created_at DESC, id DESC LIMIT ?",
+                (*params, limit + 1),
+            ).fetchall()
+            page = rows[:limit]
+            items: dict = {row[0]: [] for row in page}
+            if items:
+                placeholders = ", ".join("?" for _ in items)
+                for analysis_id, item in conn.execute(
+                    f"SELECT analysis_id, item FROM recommendations WHERE analysis_id IN ({placeholders}) "
+                    f"ORDER BY analysis_id, position",
+                    tuple(items),
+                ):
+                    items[analysis_id].append(item)
+        return {
+            "items": [
+                {
+                    "id": row[0],
+                    "style": row[1],
+                    "generated_image": row[2],
+                    "placeholder": row[3],
+                    "created_at": row[4],
+                    "recommendations": items[row[0]],
+                }
+                for row in page
+            ],
+            "next_cursor": encode_cursor(page[-1][4], page[-1][0]) if len(rows) > limit else None,
+        }
+
+    def _prune_sync(self, older_than: float) -> int:
+        with self._db() as conn:
+            conn.execute(
+                "DELETE FROM recommendations WHERE analysis_id IN (SELECT id FROM analyses WHERE created_at < ?)",
+                (older_than,),
+            )
+            return conn.execute("DELETE FROM analyses WHERE created_at < ?", (older_than,)).rowcount
+
+    def _count_sync(self) -> int:
+        with self._db() as conn:
+            return conn.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+
+    async def record(self, entry: dict) -> None:
+        """
+        entry: id, style, result и необязательные client_id, photo_sha256, trace_id, nanobanana_task_id
+        """
+        await self._run(self._record_sync, entry)
+
+    async def get(self, analysis_id: str) -> Optional[dict]:
+        return await self._run(self._get_sync, analysis_id)
+
+    async def list(
+        self,
+        client_id: Optional[str],
+        limit: int = 20,
+        cursor: Optional[str] = None,
+        task_id: Optional[str] = None,
+    ) -> dict:
+        """
+        Страница истории: client_id=None - все клиенты (для поддержки). Бросает ValueError
+        для испорченного курсора.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        return await self._run(self._list_sync, client_id, limit, decode_cursor(cursor) if cursor else None, task_id)
+
+    async def prune(self) -> int:
+        """
+        Удаляет анализы старше max_age; возвращает их число
+        """
+        if not self.max_age:
+            return 0
+        deleted = await self._run(self._prune_sync, time.time() - self.max_age)
+        if deleted:
+            logger.info("🧹 История: удалено %s анализов старше %.0f ч", deleted, self.max_age / 3600)
+        return deleted
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Ошибка очистки истории: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def get_stats(self) -> dict:
+        return {
+            "path": self.path,
+            "max_age_hours": self.max_age / 3600 if self.max_age else None,
+            "analyses": await self._run(self._count_sync),
+        }
+
+
+def create_history_store() -> Optional[HistoryStore]:
+    """
+    HISTORY_ENABLED (по умолчанию 1), HISTORY_PATH и HISTORY_MAX_AGE_HOURS (по умолчанию -
+    UPLOADS_MAX_AGE_HOURS, срок хранения изображений; 0 - без ограничения)
+    """
+    if os.getenv("HISTORY_ENABLED", "1") != "1":
+        logger.info("📚 История анализов отключена (HISTORY_ENABLED=0)")
+        return None
+    path = os.getenv("HISTORY_PATH", "data/history.sqlite3")
+    max_age_hours = float(os.getenv("HISTORY_MAX_AGE_HOURS") or os.getenv("UPLOADS_MAX_AGE_HOURS", 168))
+    logger.info("📚 История анализов: SQLite (%s)", path)
+    return HistoryStore(path, max_age=max_age_hours * 3600 or None)
@@ -0,0 +1,157 @@
+"""
+HTTP-клиенты провайдеров: по одному пулу keep-alive соединений на провайдера
+
+Каждый провайдер (OpenAI, Imgur, NanoBanana) получает свой httpx.AsyncClient с
+настроенным пулом: соединения переиспользуются между запросами и опросами статуса,
+поэтому TCP+TLS рукопожатие выполняется один раз на соединение, а не на каждый
+запрос. HTTP/2 включается, если установлен пакет h2 (HTTP2=auto), - тогда запросы
+к одному хосту мультиплексируются в одном соединении.
+
+Новые соединения и длительность рукопожатий видны в метриках
+odezda_http_connections_total{provider} и odezda_http_handshake_seconds{provider,phase}:
+при работающем пуле соединений намного меньше, чем запросов (odezda_provider_requests_total).
+"""
+import os
+import time
+import logging
+from dataclasses import dataclass, asdict
+from typing import Dict
+
+import httpx
+
+from metrics import HTTP_CONNECTIONS, HTTP_HANDSHAKE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+@dataclass
+class PoolConfig:
+    """
+    max_connections - всего соединений к провайдеру (остальные запросы ждут свободное);
+    max_keepalive - сколько простаивающих соединений держать открытыми;
+    keepalive_expiry - через сколько секунд простоя закрывать соединение;
+    timeout - таймаут запроса по умолчанию (сек)
+    """
+    max_connections: int = 20
+    max_keepalive: int = 10
+    keepalive_expiry: float = 60
+    timeout: float = 30
+    http2: bool = False
+
+
+def pool_config_from_env(prefix: str, **defaults) -> PoolConfig:
+    """
+    <PREFIX>_POOL_SIZE, <PREFIX>_POOL_KEEPALIVE и общие HTTP_KEEPALIVE_EXPIRY, HTTP2 (auto | 1 | 0)
+    """
+    config = PoolConfig(**defaults)
+    config.max_connections = int(os.getenv(f"{prefix}_POOL_SIZE", config.max_connections))
+    config.max_keepalive = int(os.getenv(f"{prefix}_POOL_KEEPALIVE", config.max_keepalive))
+    config.keepalive_expiry = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", config.keepalive_expiry))
+    mode = os.getenv("HTTP2", "auto").lower()
+    if mode == "auto":
+        config.http2 = http2_available()
+    elif mode in ("1", "true", "yes"):
+        if http2_available():
+            config.http2 = True
+        else:
+            logger.warning("⚠️ HTTP2=%s, но пакет h2 не установлен - используется HTTP/1.1", mode)
+    return config
+
+
+def _trace_connections(provider: str):
+    """
+    Хук запроса: считает новые соединения и время TCP/TLS рукопожатия (события трассировки httpcore)
+    """
+    async def on_request(request: httpx.Request) -> None:
+        started: Dict[str, float] = {}
+
+        async def trace(event: str, info: dict) -> None:
+            if event == "connection.connect_tcp.started":
+                started["tcp"] = time.perf_counter()
+            elif event == "connection.connect_tcp.complete" and "tcp" in started:
+                HTTP_CONNECTIONS.inc(provider=provider)
+                HTTP_HANDSHAKE_SECONDS.observe(time.perf_counter() - started["tcp"], provider=provider, phase="tcp")
+            elif event == "connection.start_tls.started":
+                started["tls"] = time.perf_counter()
+            elif event == "connection.start_tls.complete" and "tls" in started:
+                HTTP_HANDSHAKE_SECONDS.observe(time.perf_counter() - started["tls"], provider=provider, phase="tls")
+
+        request.extensions["trace"] = trace
+
+    return on_request
+
+
+def create_http_client(provider: str, config: PoolConfig) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=config.timeout,
+        follow_redirects=True,
+        http2=config.http2,
+        limits=httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive,
+            keepalive_expiry=config.keepalive_expiry,
+        ),
+        event_hooks={"request": [_trace_connections(provider)]},
+    )
+
+
+class ProviderClients:
+    """
+    Клиенты провайдеров, привязанные к жизненному циклу приложения
+
+    get() создает клиент при первом обращении (и заново после aclose() - например,
+    при повторном запуске приложения в тестах), aclose() закрывает все пулы при остановке.
+    """
+
+    def __init__(self, configs: Dict[str, PoolConfig]):
+        self.configs = configs
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def get(self, provider: str) -> httpx.AsyncClient:
+        client = self._clients.get(provider)
+        if client is None or client.is_closed:
+            client = self._clients[provider] = create_http_client(provider, self.configs[provider])
+        return client
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def get_stats(self) -> dict:
+        return {
+            provider: {
+                **asdict(config),
+                "open": provider in self._clients and not self._clients[provider].is_closed,
+                "connections": HTTP_CONNECTIONS.value(provider=provider),
+            }
+            for provider, config in self.configs.items()
+        }
+
+
+def create_provider_clients() -> ProviderClients:
+    """
+    Пулы соединений OpenAI, Imgur и NanoBanana из переменных окружения
+    """
+    clients = ProviderClients({
+        # Длинные ответы GPT-4o (в т.ч. потоковые) - таймаут больше
+        "openai": pool_config_from_env("OPENAI", max_connections=32, max_keepalive=16, timeout=120),
+        "imgur": pool_config_from_env("IMGUR", max_connections=8, max_keepalive=4),
+        "nanobanana": pool_config_from_env("NANOBANANA", max_connections=16, max_keepalive=8),
+    })
+    logger.info(
+        "🔌 HTTP-клиенты провайдеров: %s",
+        ", ".join(
+            f"{name} (до {config.max_connections} соединений, {'HTTP/2' if config.http2 else 'HTTP/1.1'})"
+            for name, config in clients.configs.items()
+        ),
+    )
+    return clients
@@ -0,0 +1,162 @@
+"""
+Варианты сгенерированного изображения для адаптивной отдачи
+
+Результат NanoBanana декодируется один раз (с поворотом) и кодируется в AVIF (если
+Pillow собран с libavif), WebP и JPEG на нескольких ширинах (RESULT_IMAGE_WIDTHS).
+Браузер сам выбирает формат и ширину (<picture> + srcset), а /api/images/<имя> выбирает
+формат по заголовку Accept. Крошечный размытый плейсхолдер (LQIP) встраивается в JSON
+ответа как data URI и показывается, пока грузится изображение.
+"""
+import io
+import os
+import base64
+import hashlib
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional
+
+from PIL import Image, ImageFilter, features
+
+# Порядок предпочтения: первый формат, который принимает браузер, и отдается
+PREFERRED_FORMATS = ("image/avif", "image/webp", "image/jpeg")
+FALLBACK_FORMAT = "image/jpeg"
+
+# Качество подобрано так, чтобы форматы выглядели примерно одинаково
+QUALITY = {"image/avif": 55, "image/webp": 80, "image/jpeg": 85}
+PIL_FORMATS = {"image/avif": "AVIF", "image/webp": "WEBP", "image/jpeg": "JPEG"}
+ENCODE_OPTIONS = {
+    "image/avif": {"speed": 8},
+    "image/webp": {"method": 4},
+    "image/jpeg": {"optimize": True, "progressive": True},
+}
+
+PLACEHOLDER_WIDTH = 16
+
+
+def parse_widths(value: str) -> List[int]:
+    return sorted({int(width) for width in value.split(",") if width.strip()})
+
+
+RESULT_WIDTHS = parse_widths(os.getenv("RESULT_IMAGE_WIDTHS", "480,768,1200"))
+
+
+def available_formats() -> List[str]:
+    """
+    Форматы, которые умеет кодировать установленный Pillow (JPEG - всегда)
+    """
+    codecs = {"image/avif": "avif", "image/webp": "webp"}
+    return [
+        content_type for content_type in PREFERRED_FORMATS
+        if content_type not in codecs or features.check(codecs[content_type])
+    ]
+
+
+@dataclass
+class ImageVariant:
+    content_type: str
+    width: int
+    height: int
+    data: bytes
+
+
+@dataclass
+class ResultImage:
+    """
+    digest - sha256 исходного изображения (имя вариантов в хранилище);
+    placeholder - data URI размытой миниатюры ширины PLACEHOLDER_WIDTH
+    """
+    digest: str
+    width: int
+    height: int
+    placeholder: str
+    variants: List[ImageVariant] = field(default_factory=list, repr=False)
+
+    def variant_name(self, width: int) -> str:
+        return f"{self.digest}-{width}"
+
+    @property
+    def largest(self) -> ImageVariant:
+        return max(
+            (variant for variant in self.variants if variant.content_type == FALLBACK_FORMAT),
+            key=lambda variant: variant.width,
+        )
+
+
+def _encode(image: Image.Image, content_type: str) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format=PIL_FORMATS[content_type], quality=QUALITY[content_type], **ENCODE_OPTIONS[content_type])
+    return output.getvalue()
+
+
+def make_placeholder(image: Image.Image) -> str:
+    height = max(1, round(image.height * PLACEHOLDER_WIDTH / image.width))
+    tiny = image.resize((PLACEHOLDER_WIDTH, height), Image.Resampling.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+    output = io.BytesIO()
+    tiny.save(output, format="JPEG", quality=40)
+    return "data:image/jpeg;base64," + base64.b64encode(output.getvalue()).decode("ascii")
+
+
+def render_variants(
+    image_data: bytes,
+    rotate: int = 0,
+    widths: Optional[Iterable[int]] = None,
+    formats: Optional[Iterable[str]] = None,
+) -> ResultImage:
+    """
+    Декодирует изображение один раз и кодирует его во всех форматах на всех ширинах
+
+    Ширины больше исходной пропускаются, самая большая - не больше исходной и
+    max(widths). rotate - поворот в градусах против часовой стрелки (как Image.rotate).
+    CPU-тяжелая функция, вызывается в пуле потоков.
+    """
+    widths = sorted(widths or RESULT_WIDTHS)
+    formats = list(formats or available_formats())
+
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if rotate:
+        image = image.rotate(rotate, expand=True)
+
+    largest = min(image.width, widths[-1])
+    targets = [width for width in widths if width < largest] + [largest]
+
+    result = ResultImage(
+        digest=hashlib.sha256(image_data).hexdigest(),
+        width=largest,
+        height=round(image.height * largest / image.width),
+        placeholder=make_placeholder(image),
+    )
+    for width in targets:
+        height = round(image.height * width / image.width)
+        resized = image if width == image.width else image.resize((width, height), Image.Resampling.LANCZOS)
+        for content_type in formats:
+            result.variants.append(ImageVariant(content_type, width, height, _encode(resized, content_type)))
+    return result
+
+
+def negotiate(accept: Optional[str], available: Iterable[str]) -> str:
+    """
+    Выбирает формат по заголовку Accept
+
+    AVIF и WebP отдаются, только если браузер перечислил их явно (image/* в Accept
+    старых браузеров не означает поддержку новых форматов), иначе - JPEG.
+    """
+    accepted = {}
+    for part in (accept or "").split(","):
+        media_type, _, params = part.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type.strip().lower()] = quality
+
+    available = list(available)
+    for content_type in PREFERRED_FORMATS:
+        if content_type in available and content_type != FALLBACK_FORMAT and accepted.get(content_type, 0) > 0:
+            return content_type
+    return FALLBACK_FORMAT if FALLBACK_FORMAT in available else available[0]
@@ -0,0 +1,188 @@
+import io
+import os
+import time
+import base64
+import hashlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import BinaryIO, Optional, Union
+
+from PIL import Image, ImageOps
+
+from vision import VisionInput, VisionPolicy, build_vision_input, create_vision_policy
+
+# Максимальная сторона изображения, которое уходит в OpenAI и NanoBanana
+MAX_SIDE = 1024
+JPEG_QUALITY = 90
+
+# Браузер уменьшает фото до MAX_SIDE перед загрузкой (GET /api/upload-config); качество
+# чуть выше серверного, потому что сервер перекодирует фото еще раз
+CLIENT_FORMAT = "image/jpeg"
+CLIENT_QUALITY = float(os.getenv("CLIENT_UPLOAD_QUALITY", 0.92))
+
+# Защита от "декомпрессионных бомб": лимит пикселей проверяется по заголовку до декодирования
+MAX_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 40_000_000))
+ALLOWED_FORMATS = {"JPEG", "MPO", "PNG", "WEBP", "GIF", "BMP"}
+ACCEPTED_MIME_TYPES = ["image/jpeg", "image/png", "image/webp", "image/gif", "image/bmp"]
+Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+
+class ImageRejected(ValueError):
+    """
+    Загруженный файл не подходит для обработки (формат, размеры)
+    """
+
+
+@dataclass
+class PreparedImage:
+    """
+    Результат однократной предобработки загруженного фото
+
+    jpeg - повернутое по EXIF и уменьшенное изображение, закодированное один раз;
+    vision - вариант для GPT-4o (кадр, разрешение и detail по политике VISION_*);
+    base64 и sha256 считаются лениво и не пересчитываются;
+    timings - длительность стадий decode/resize/encode/vision в секундах.
+    """
+    jpeg: bytes
+    width: int
+    height: int
+    source_format: Optional[str]
+    source_size: tuple
+    dhash: str
+    timings: dict = field(default_factory=dict, repr=False, compare=False)
+    vision: Optional[VisionInput] = field(default=None, repr=False, compare=False)
+    _base64: Optional[str] = field(default=None, repr=False)
+    _vision_base64: Optional[str] = field(default=None, repr=False)
+    _sha256: Optional[str] = field(default=None, repr=False)
+
+    @property
+    def base64(self) -> str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.jpeg).decode("ascii")
+        return self._base64
+
+    @property
+    def vision_base64(self) -> str:
+        if self.vision is None:
+            return self.base64
+        if self._vision_base64 is None:
+            self._vision_base64 = base64.b64encode(self.vision.jpeg).decode("ascii")
+        return self._vision_base64
+
+    @property
+    def vision_detail(self) -> Optional[str]:
+        return self.vision.detail if self.vision else None
+
+    @property
+    def sha256(self) -> str:
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.jpeg).hexdigest()
+        return self._sha256
+
+    def fingerprint(self, perceptual: bool = False) -> str:
+        """
+        Отпечаток для ключа кэша: точный (sha256) или перцептивный (dHash)
+        """
+        return f"dhash:{self.dhash}" if perceptual else f"sha256:{self.sha256}"
+
+
+def difference_hash(image: Image.Image) -> str:
+    """
+    dHash 64 бита - устойчив к перекодированию и небольшому изменению размера
+    """
+    small = image.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            offset = row * 9 + col
+            bits = (bits << 1) | (1 if pixels[offset] > pixels[offset + 1] else 0)
+    return f"{bits:016x}"
+
+
+def sniff_image(source: Union[bytes, BinaryIO]) -> Image.Image:
+    """
+    Открывает изображение, читая только заголовок, и проверяет формат и размеры
+
+    Пиксели не декодируются - слишком большие изображения отклоняются до выделения памяти.
+    """
+    fp = io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+    try:
+        image = Image.open(fp)
+    except Image.DecompressionBombError:
+        raise ImageRejected("Слишком большое разрешение изображения")
+    if image.format not in ALLOWED_FORMATS:
+        raise ImageRejected(f"Неподдерживаемый формат изображения: {image.format}")
+    width, height = image.size
+    if width * height > MAX_PIXELS:
+        raise ImageRejected(f"Слишком большое разрешение изображения: {width}x{height}")
+    return image
+
+
+@lru_cache(maxsize=1)
+def default_vision_policy() -> VisionPolicy:
+    # Читается при первом использовании - после load_dotenv в main
+    return create_vision_policy()
+
+
+def prepare_image(
+    source: Union[bytes, BinaryIO],
+    max_side: int = MAX_SIDE,
+    quality: int = JPEG_QUALITY,
+    vision_policy: Optional[VisionPolicy] = None,
+) -> PreparedImage:
+    """
+    Декодирует фото один раз: EXIF-ориентация, уменьшение, одно JPEG-кодирование
+
+    source - байты или файловый объект (например, SpooledTemporaryFile загрузки),
+    который читается напрямую без копирования в bytes. Для JPEG используется
+    Image.draft - декодер сразу масштабирует в 2/4/8 раз, не распаковывая полное
+    разрешение. Из того же декодированного кадра готовится вариант для GPT-4o
+    (vision_policy, по умолчанию - из переменных окружения VISION_*). Бросает
+    ImageRejected или исключение Pillow для невалидных данных.
+    """
+    started = time.perf_counter()
+    image = sniff_image(source)
+    source_format = image.format
+    source_size = image.size
+
+    # draft выбирает масштаб не меньше запрошенного, окончательно уменьшаем через thumbnail
+    image.draft("RGB", (max_side, max_side))
+    image.load()
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    decoded = time.perf_counter()
+
+    if image.width > max_side or image.height > max_side:
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    resized = time.perf_counter()
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    jpeg = output.getvalue()
+    dhash = difference_hash(image)
+    encoded = time.perf_counter()
+
+    vision = build_vision_input(image, vision_policy or default_vision_policy(), jpeg)
+
+    return PreparedImage(
+        jpeg=jpeg,
+        width=image.width,
+        height=image.height,
+        source_format=source_format,
+        source_size=source_size,
+        dhash=dhash,
+        timings={
+            "decode": decoded - started,
+            "resize": resized - decoded,
+            "encode": encoded - resized,
+            "vision": time.perf_counter() - encoded,
+        },
+        vision=vision,
+    )
@@ -0,0 +1,118 @@
+import os
+import json
+import logging
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+# Максимальный размер загружаемого фото
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", 10)) * 1024 * 1024)
+# Запас на остальные поля multipart-формы
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+
+class _BodyTooLarge(HTTPException):
+    """
+    Поднимается из receive: FastAPI пропускает HTTPException при разборе формы как есть
+    """
+
+    def __init__(self, limit: int):
+        super().__init__(status_code=413, detail=f"Файл слишком большой (макс {limit // (1024 * 1024)}MB)")
+
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware: ограничивает размер тела запроса еще до разбора multipart
+
+    Запрос с Content-Length больше лимита отклоняется сразу (413), а тело без
+    Content-Length (chunked) считается по мере чтения и обрывается на лимите -
+    большая загрузка не успевает попасть ни в память, ни во временный файл целиком.
+    """
+
+    def __init__(self, app, max_body_size: int = MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES, limits: dict = None):
+        self.app = app
+        self.max_body_size = max_body_size
+        # Отдельные лимиты для путей (например, пакетная загрузка): {prefix: bytes}
+        self.limits = limits or {}
+
+    def _limit_for(self, path: str) -> int:
+        for prefix, limit in self.limits.items():
+            if path.startswith(prefix):
+                return limit
+        return self.max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT", "PATCH"):
+            await self.app(scope, receive, send)
+            return
+
+        limit = self._limit_for(scope["path"])
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None:
+            try:
+                declared = int(content_length)
+            except ValueError:
+                declared = 0
+            if declared > limit:
+                logger.error("❌ Запрос слишком большой: %s байт (лимит %s)", declared, limit)
+                await self._reject(send, limit)
+                return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    logger.error("❌ Загрузка прервана: превышен лимит %s байт", limit)
+                    raise _BodyTooLarge(limit)
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge:
+            # Исключение вылетело мимо обработчиков приложения (например, не из FastAPI-маршрута)
+            if not response_started:
+                await self._reject(send, limit)
+
+    @staticmethod
+    async def _reject(send, limit: int) -> None:
+        body = json.dumps(
+            {"detail": f"Файл слишком большой (макс {limit // (1024 * 1024)}MB)"},
+            ensure_ascii=False,
+        ).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def upload_size(photo) -> int:
+    """
+    Размер загруженного файла без чтения его в память
+    """
+    if photo.size is not None:
+        return photo.size
+    position = photo.file.tell()
+    photo.file.seek(0, os.SEEK_END)
+    size = photo.file.tell()
+    photo.file.seek(position)
+    return size
@@ -0,0 +1,203 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from typing import Optional
+
+from metrics import UPLOADS_RECLAIMED
+from singleflight import SQLiteLeases
+
+logger = logging.getLogger(__name__)
+
+
+# Файлы, которые уборщик никогда не трогает
+PROTECTED_NAMES = {".gitkeep"}
+# Незавершенные записи (*.tmp) удаляются только если старше этого времени
+TMP_GRACE_SECONDS = 3600
+
+
+class UploadsJanitor:
+    """
+    Фоновая очистка папки uploads по возрасту и общему объему
+
+    Сканирование идет в отдельном потоке, удаление - пачками с передачей
+    управления event loop между ними, поэтому запросы не блокируются.
+    При превышении квоты первыми удаляются файлы, к которым дольше всего
+    не обращались (время доступа или изменения - что позже).
+
+    Если задан leases (несколько воркеров), очищает только воркер, держащий
+    аренду "janitor:<root>"; остальные ждут и перехватывают ее, если он упал.
+    Статистика ненулевая только у очищающего воркера - суммы по воркерам верны.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_age: float,
+        max_bytes: int,
+        interval: float = 600,
+        batch_size: int = 200,
+        leases: Optional[SQLiteLeases] = None,
+    ):
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.batch_size = batch_size
+        self.leases = leases
+        self.stats = {
+            "sweeps": 0,
+            "files_deleted_total": 0,
+            "bytes_reclaimed_total": 0,
+            "current_files": 0,
+            "current_bytes": 0,
+            "last_sweep_at": None,
+            "last_sweep_seconds": None,
+        }
+
+    def _scan(self) -> list:
+        """
+        Возвращает [(last_access, size, path)] всех файлов под root
+        """
+        entries = []
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False) and entry.name not in PROTECTED_NAMES:
+                                stat = entry.stat(follow_symlinks=False)
+                                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+                        except FileNotFoundError:
+                            continue
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _delete_batch(self, batch: list) -> tuple:
+        deleted = 0
+        reclaimed = 0
+        directories = set()
+        for _, size, path in batch:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Файл уже удалил другой воркер
+                continue
+            except OSError as e:
+                logger.warning("⚠️ Не удалось удалить %s: %s", path, e)
+                continue
+            deleted += 1
+            reclaimed += size
+            directories.add(os.path.dirname(path))
+
+        # Удаляем опустевшие шард-папки (кроме корня)
+        for directory in directories:
+            while os.path.abspath(directory) != os.path.abspath(self.root):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+        return deleted, reclaimed
+
+    def _select_victims(self, entries: list, now: float) -> list:
+        victims = []
+        kept = []
+        for entry in entries:
+            last_access, _, path = entry
+            age = now - last_access
+            if age > self.max_age or (path.endswith(".tmp") and age > TMP_GRACE_SECONDS):
+                victims.append(entry)
+            else:
+                kept.append(entry)
+
+        total = sum(size for _, size, _ in kept)
+        if total > self.max_bytes:
+            # LRU: сначала самые давно использованные
+            kept.sort()
+            for entry in kept:
+                if total <= self.max_bytes:
+                    break
+                victims.append(entry)
+                total -= entry[1]
+        return victims
+
+    async def sweep(self) -> dict:
+        """
+        Один проход очистки; возвращает статистику прохода
+        """
+        started = time.monotonic()
+        entries = await asyncio.to_thread(self._scan)
+        victims = self._select_victims(entries, time.time())
+
+        deleted = 0
+        reclaimed = 0
+        for start in range(0, len(victims), self.batch_size):
+            batch_deleted, batch_reclaimed = await asyncio.to_thread(
+                self._delete_batch, victims[start:start + self.batch_size]
+            )
+            deleted += batch_deleted
+            reclaimed += batch_reclaimed
+
+        self.stats["sweeps"] += 1
+        self.stats["files_deleted_total"] += deleted
+        self.stats["bytes_reclaimed_total"] += reclaimed
+        UPLOADS_RECLAIMED.inc(deleted, measure="files")
+        UPLOADS_RECLAIMED.inc(reclaimed, measure="bytes")
+        self.stats["current_files"] = len(entries) - deleted
+        self.stats["current_bytes"] = sum(size for _, size, _ in entries) - reclaimed
+        self.stats["last_sweep_at"] = time.time()
+        self.stats["last_sweep_seconds"] = round(time.monotonic() - started, 3)
+
+        if deleted:
+            logger.info("🧹 Очистка uploads: удалено %s файлов, освобождено %s байт", deleted, reclaimed)
+        return {"deleted": deleted, "reclaimed": reclaimed}
+
+    async def _is_leader(self, owner: str) -> bool:
+        if not self.leases:
+            return True
+        return await asyncio.to_thread(self.leases.hold, f"janitor:{os.path.abspath(self.root)}", owner)
+
+    async def run(self) -> None:
+        # id владельца создается в воркере: уборщик создается до запуска воркеров
+        owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        while True:
+            try:
+                if await self._is_leader(owner):
+                    await self.sweep()
+                else:
+                    # Текущий объем показывает очищающий воркер
+                    self.stats["current_files"] = 0
+                    self.stats["current_bytes"] = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Ошибка очистки uploads: %s", e)
+            await asyncio.sleep(self.interval)
+
+
+def create_janitor(root: str = "uploads") -> Optional[UploadsJanitor]:
+    """
+    Создает уборщика по переменным окружения (JANITOR_ENABLED=0 отключает)
+
+    При заданном SHARED_STATE_PATH очищает только один воркер (аренда в SQLite).
+    """
+    if os.getenv("JANITOR_ENABLED", "1").lower() in ("0", "false", "no"):
+        return None
+    interval = float(os.getenv("JANITOR_INTERVAL", 600))
+    shared_path = os.getenv("SHARED_STATE_PATH", "")
+    # Аренда переживает паузу между проходами; упавшего владельца заменят через 3 интервала
+    leases = SQLiteLeases(shared_path, lease_seconds=interval * 3) if shared_path else None
+    return UploadsJanitor(
+        root,
+        max_age=float(os.getenv("UPLOADS_MAX_AGE_HOURS", 168)) * 3600,
+        max_bytes=int(float(os.getenv("UPLOADS_MAX_MB", 2048)) * 1024 * 1024),
+        interval=interval,
+        leases=leases,
+    )
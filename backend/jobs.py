@@ -0,0 +1,330 @@
+import os
+import copy
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Статусы задачи
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+FINISHED_STATUSES = (JOB_DONE, JOB_FAILED)
+
+
+def new_job(style: str) -> dict:
+    """
+    Создает описание новой задачи генерации образа
+    """
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "status": JOB_QUEUED,
+        "style": style,
+        "result": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+class JobStore:
+    """
+    Базовое хранилище задач и их событий (стадий конвейера)
+
+    События нумеруются с 1 внутри задачи - номер используется как id события в SSE.
+    Пока задача выполняется, воркер раз в heartbeat_interval обновляет ее updated_at;
+    задача без обновлений дольше трех интервалов брошена (воркер упал или перезапущен).
+    """
+
+    # Как часто перечитывать события, если уведомление может прийти из другого процесса
+    poll_interval = 15.0
+    # Как часто выполняющая задачу сторона отмечает, что она жива
+    heartbeat_interval = 10.0
+
+    def __init__(self):
+        # job_id -> множество Event подписанных потоков SSE
+        self._waiters: dict = {}
+
+    async def create(self, job: dict) -> dict:
+        raise NotImplementedError
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def update(self, job_id: str, **fields) -> None:
+        raise NotImplementedError
+
+    async def add_event(self, job_id: str, event_type: str, data: dict) -> int:
+        raise NotImplementedError
+
+    async def events_since(self, job_id: str, after: int = 0) -> list:
+        raise NotImplementedError
+
+    def is_abandoned(self, job: dict) -> bool:
+        """
+        Задача не завершена, но ее давно никто не выполняет
+        """
+        return (
+            job["status"] not in FINISHED_STATUSES
+            and time.time() - job["updated_at"] > 3 * self.heartbeat_interval
+        )
+
+    def _notify(self, job_id: str) -> None:
+        for event in self._waiters.pop(job_id, ()):
+            event.set()
+
+    async def next_events(self, job_id: str, after: int = 0) -> list:
+        """
+        Возвращает события после номера after, дожидаясь новых не дольше poll_interval
+        """
+        # Подписываемся до чтения, чтобы не пропустить событие между чтением и ожиданием
+        waiter = asyncio.Event()
+        self._waiters.setdefault(job_id, set()).add(waiter)
+        try:
+            events = await self.events_since(job_id, after)
+            if events:
+                return events
+            try:
+                await asyncio.wait_for(waiter.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            return await self.events_since(job_id, after)
+        finally:
+            # Подписка живет только на время ожидания - поток закрылся, записи не остается
+            waiters = self._waiters.get(job_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[job_id]
+
+
+class InMemoryJobStore(JobStore):
+    """
+    Хранилище задач в памяти процесса
+    """
+
+    def __init__(self, max_jobs: int = 1000):
+        super().__init__()
+        self.max_jobs = max_jobs
+        self._jobs: dict = {}
+        self._events: dict = {}
+
+    async def create(self, job: dict) -> dict:
+        # Удаляем самые старые задачи при переполнении (dict хранит порядок вставки)
+        while len(self._jobs) >= self.max_jobs:
+            old_id = next(iter(self._jobs))
+            self._jobs.pop(old_id, None)
+            self._events.pop(old_id, None)
+        self._jobs[job["id"]] = dict(job)
+        self._events[job["id"]] = []
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        job = self._jobs.get(job_id)
+        return copy.deepcopy(job) if job else None
+
+    async def update(self, job_id: str, **fields) -> None:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        job.update(copy.deepcopy(fields))
+        job["updated_at"] = time.time()
+
+    async def add_event(self, job_id: str, event_type: str, data: dict) -> int:
+        events = self._events.setdefault(job_id, [])
+        seq = len(events) + 1
+        events.append({"id": seq, "type": event_type, "data": copy.deepcopy(data), "created_at": time.time()})
+        self._notify(job_id)
+        return seq
+
+    async def events_since(self, job_id: str, after: int = 0) -> list:
+        return list(self._events.get(job_id, [])[after:])
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Хранилище задач в SQLite (переживает перезапуск, общее для нескольких процессов)
+
+    Задачи (с событиями), не обновлявшиеся дольше max_age секунд, удаляются при
+    создании новых - не чаще раза в PRUNE_INTERVAL.
+    """
+
+    # События могут записываться другими воркерами - перечитываем чаще
+    poll_interval = 1.0
+    PRUNE_INTERVAL = 300
+
+    def __init__(self, path: str, max_age: float = 24 * 3600):
+        super().__init__()
+        self.path = path
+        self.max_age = max_age
+        self._pruned_at = 0.0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    style TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS job_events (
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    type TEXT NOT NULL,
+                    data TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (job_id, seq)
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs (updated_at);
+            """)
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _run(self, func, *args):
+        return asyncio.to_thread(func, *args)
+
+    @staticmethod
+    def _row_to_job(row) -> dict:
+        return {
+            "id": row[0],
+            "status": row[1],
+            "style": row[2],
+            "result": json.loads(row[3]) if row[3] else None,
+            "error": row[4],
+            "created_at": row[5],
+            "updated_at": row[6],
+        }
+
+    def _create_sync(self, job: dict) -> None:
+        with self._db() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, style, result, error, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job["id"], job["status"], job["style"],
+                 json.dumps(job["result"], ensure_ascii=False) if job["result"] is not None else None,
+                 job["error"], job["created_at"], job["updated_at"]),
+            )
+
+    def _prune_sync(self, cutoff: float) -> int:
+        with self._db() as conn:
+            conn.execute("DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE updated_at < ?)", (cutoff,))
+            return conn.execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,)).rowcount
+
+    async def prune(self) -> int:
+        """
+        Удаляет задачи старше max_age вместе с событиями; возвращает число удаленных
+        """
+        self._pruned_at = time.time()
+        deleted = await self._run(self._prune_sync, self._pruned_at - self.max_age)
+        if deleted:
+            logger.info("🧹 Удалено старых задач: %s", deleted)
+        return deleted
+
+    def _get_sync(self, job_id: str) -> Optional[dict]:
+        with self._db() as conn:
+            row = conn.execute(
+                "SELECT id, status, style, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def _update_sync(self, job_id: str, fields: dict) -> None:
+        fields = dict(fields)
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False) if fields["result"] is not None else None
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._db() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def _add_event_sync(self, job_id: str, event_type: str, data: dict) -> int:
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM job_events WHERE job_id = ?", (job_id,)).fetchone()
+            seq = row[0] + 1
+            conn.execute(
+                "INSERT INTO job_events (job_id, seq, type, data, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, seq, event_type, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+        return seq
+
+    def _events_since_sync(self, job_id: str, after: int) -> list:
+        with self._db() as conn:
+            rows = conn.execute(
+                "SELECT seq, type, data, created_at FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after),
+            ).fetchall()
+        return [
+            {"id": row[0], "type": row[1], "data": json.loads(row[2]) if row[2] else None, "created_at": row[3]}
+            for row in rows
+        ]
+
+    async def create(self, job: dict) -> dict:
+        if time.time() - self._pruned_at > self.PRUNE_INTERVAL:
+            try:
+                await self.prune()
+            except sqlite3.Error as e:
+                logger.warning("⚠️ Не удалось удалить старые задачи: %s", e)
+        await self._run(self._create_sync, job)
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await self._run(self._get_sync, job_id)
+
+    async def update(self, job_id: str, **fields) -> None:
+        await self._run(self._update_sync, job_id, fields)
+
+    async def add_event(self, job_id: str, event_type: str, data: dict) -> int:
+        seq = await self._run(self._add_event_sync, job_id, event_type, data)
+        self._notify(job_id)
+        return seq
+
+    async def events_since(self, job_id: str, after: int = 0) -> list:
+        return await self._run(self._events_since_sync, job_id, after)
+
+
+def create_job_store() -> JobStore:
+    """
+    Создает хранилище задач по переменной окружения JOB_STORE (memory | sqlite)
+
+    JOB_STORE_MAX_AGE_HOURS - сколько хранить задачи в SQLite после последнего обновления
+    """
+    backend = os.getenv("JOB_STORE", "memory").lower()
+    if backend == "sqlite":
+        path = os.getenv("JOB_STORE_PATH", "data/jobs.sqlite3")
+        logger.info("🗄️ Хранилище задач: SQLite (%s)", path)
+        return SQLiteJobStore(path, max_age=float(os.getenv("JOB_STORE_MAX_AGE_HOURS", 24)) * 3600)
+    if backend != "memory":
+        logger.warning("⚠️ Неизвестный JOB_STORE=%s, используется memory", backend)
+    return InMemoryJobStore()
+
+
+def format_sse(event: dict) -> str:
+    """
+    Форматирует событие задачи для Server-Sent Events
+    """
+    payload = json.dumps(event["data"], ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {payload}\n\n"
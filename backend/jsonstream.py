@@ -0,0 +1,146 @@
+"""
+Инкрементальный разбор JSON-объекта, который модель присылает по кусочкам (stream=True)
+
+Парсер не строит дерево на каждый кусок: он один раз проходит по новым символам,
+отслеживая глубину вложенности и строки, и отдает события, как только значение
+закончилось:
+    ("field", ключ, значение)         - готово поле верхнего уровня;
+    ("item", ключ, индекс, значение)  - готов элемент массива из item_arrays
+                                        (например, очередная рекомендация).
+Итоговый ответ по-прежнему разбирается json.loads целиком - события нужны только
+для раннего показа.
+"""
+import json
+import logging
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Что ожидается на первом уровне объекта
+_EXPECT_KEY, _EXPECT_COLON, _EXPECT_VALUE, _IN_VALUE = range(4)
+
+_WHITESPACE = " \t\r\n"
+
+
+class JsonFieldStream:
+    """
+    parser = JsonFieldStream(item_arrays=("recommendations",))
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            ...
+    """
+
+    def __init__(self, item_arrays: Iterable[str] = ()):
+        self.item_arrays = set(item_arrays)
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._state = _EXPECT_KEY
+        self._key: Optional[str] = None
+        self._key_start = 0
+        self._value_start = 0
+        # Массив, элементы которого отдаются по одному
+        self._items = False
+        self._item_start: Optional[int] = None
+        self._item_index = 0
+
+    def feed(self, chunk: str) -> List[Tuple]:
+        """
+        Добавляет кусок ответа и возвращает события, завершенные этим куском
+        """
+        self._buffer += chunk
+        events: List[Tuple] = []
+        text = self._buffer
+        for i in range(self._pos, len(text)):
+            self._step(text, i, text[i], events)
+        self._pos = len(text)
+        return events
+
+    def _step(self, text: str, i: int, c: str, events: List[Tuple]) -> None:
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif c == "\\":
+                self._escape = True
+            elif c == '"':
+                self._in_string = False
+                if self._depth == 1 and self._state == _EXPECT_KEY:
+                    self._key = self._decode(text[self._key_start:i + 1])
+                    self._state = _EXPECT_COLON
+            return
+
+        depth = self._depth
+        if depth == 0:
+            if c == "{":
+                self._depth = 1
+            return
+
+        if depth == 1:
+            if self._state == _EXPECT_KEY:
+                if c == '"':
+                    self._in_string = True
+                    self._key_start = i
+                elif c == "}":
+                    self._depth = 0
+                return
+            if self._state == _EXPECT_COLON:
+                if c == ":":
+                    self._state = _EXPECT_VALUE
+                return
+            if self._state == _EXPECT_VALUE:
+                if c in _WHITESPACE:
+                    return
+                self._value_start = i
+                self._state = _IN_VALUE
+            elif c in ",}":
+                # Значение поля закончилось
+                self._emit_field(text[self._value_start:i], events)
+                self._state = _EXPECT_KEY
+                if c == "}":
+                    self._depth = 0
+                return
+
+        if depth == 2 and self._items and c not in _WHITESPACE:
+            if c in ",]":
+                if self._item_start is not None:
+                    self._emit_item(text[self._item_start:i], events)
+                    self._item_start = None
+            elif self._item_start is None:
+                self._item_start = i
+
+        if c == '"':
+            self._in_string = True
+        elif c in "{[":
+            self._depth += 1
+            if self._depth == 2:
+                self._items = c == "[" and self._key in self.item_arrays
+                self._item_start = None
+                self._item_index = 0
+        elif c in "}]":
+            self._depth -= 1
+
+    def _emit_field(self, raw: str, events: List[Tuple]) -> None:
+        value = self._decode(raw)
+        if value is not _INVALID:
+            events.append(("field", self._key, value))
+        self._items = False
+
+    def _emit_item(self, raw: str, events: List[Tuple]) -> None:
+        value = self._decode(raw)
+        if value is not _INVALID:
+            events.append(("item", self._key, self._item_index, value))
+        self._item_index += 1
+
+    @staticmethod
+    def _decode(raw: str):
+        try:
+            return json.loads(raw)
+        except ValueError:
+            # Битый фрагмент не прерывает поток - итоговый разбор ответа сообщит об ошибке
+            logger.debug("⚠️ Не удалось разобрать фрагмент JSON: %s", raw[:100])
+            return _INVALID
+
+
+_INVALID = object()
@@ -0,0 +1,346 @@
+import os
+import time
+import sqlite3
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+from contextlib import contextmanager
+from typing import Optional
+
+import httpx
+import openai
+from fastapi import HTTPException
+
+from metrics import PROVIDER_REQUESTS, PROVIDER_ERRORS, error_status
+
+logger = logging.getLogger(__name__)
+
+
+# Приоритеты очереди: меньше - раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_RETRY = 1
+PRIORITY_BACKGROUND = 2
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class ProviderBusy(HTTPException):
+    """
+    Очередь к провайдеру переполнена - клиенту отвечаем 503 с Retry-After
+
+    Наследуется от HTTPException, чтобы проходить через существующие
+    обработчики `except HTTPException: raise` без изменений.
+    """
+
+    def __init__(self, provider: str, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail=f"Сервис {provider} перегружен, попробуйте через {retry_after} сек",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class TransientHTTPError(Exception):
+    """
+    Ответ провайдера, который стоит повторить (429, 5xx)
+    """
+
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+
+def raise_for_transient(response: httpx.Response) -> httpx.Response:
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        raise TransientHTTPError(response)
+    return response
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Временная ошибка, после которой имеет смысл повторить запрос
+    """
+    if isinstance(error, TransientHTTPError):
+        return True
+    if isinstance(error, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)):
+        return True
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def retry_after_hint(error: Exception) -> Optional[float]:
+    """
+    Пауза из заголовка Retry-After ответа провайдера, если он есть
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """
+    Ограничение частоты: rate запросов в секунду с запасом burst
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SQLiteTokenBucket:
+    """
+    Token bucket в SQLite: один лимит частоты на все воркеры (процессы) сервера
+
+    Состояние (токены и время пополнения) читается и обновляется в одной транзакции
+    BEGIN IMMEDIATE, поэтому воркеры не берут один и тот же токен дважды.
+    """
+
+    def __init__(self, path: str, name: str, rate: float, burst: float):
+        self.path = path
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _take(self) -> float:
+        """
+        Берет токен; возвращает 0 или сколько секунд ждать до следующего токена
+        """
+        with self._db() as conn:
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE name = ?", (self.name,)).fetchone()
+            # Время общее для процессов - по часам системы, а не time.monotonic()
+            now = time.time()
+            tokens = self.burst if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                (self.name, tokens, now),
+            )
+        return wait
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            wait = await asyncio.to_thread(self._take)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+
+class ProviderLimiter:
+    """
+    Планировщик запросов к одному провайдеру
+
+    - не больше max_concurrency одновременных запросов (семафор с приоритетной очередью);
+    - не чаще rate запросов в секунду (token bucket);
+    - при очереди длиннее max_queue новые запросы сразу получают ProviderBusy (503);
+    - временные ошибки повторяются с экспоненциальной задержкой и джиттером,
+      повторы встают в очередь после интерактивных запросов.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = 8,
+        rate: float = 0,
+        burst: float = 0,
+        max_queue: int = 100,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        bucket=None,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.bucket = bucket or TokenBucket(rate, burst or rate)
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._active = 0
+        self._waiters: list = []
+        self._counter = itertools.count()
+        self.stats = {"calls": 0, "retries": 0, "rejected": 0, "errors": 0}
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def _retry_after(self) -> int:
+        # Грубая оценка: очередь рассасывается пачками по max_concurrency
+        return max(1, int(len(self._waiters) / max(self.max_concurrency, 1)) + 1)
+
+    async def _acquire(self, priority: int) -> None:
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return
+        if priority == PRIORITY_INTERACTIVE and self.queued >= self.max_queue:
+            self.stats["rejected"] += 1
+            PROVIDER_ERRORS.inc(provider=self.name, status="queue_full")
+            raise ProviderBusy(self.name, self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже передан нам - возвращаем его следующему
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # Передаем слот напрямую, счетчик активных не меняется
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        hint = retry_after_hint(error)
+        if hint is not None:
+            return min(hint, self.max_delay)
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        # "Full jitter" - повторы разных запросов не совпадают по времени
+        return random.uniform(0, delay)
+
+    async def call(self, func, *args, priority: int = PRIORITY_INTERACTIVE, max_retries: Optional[int] = None, **kwargs):
+        """
+        Выполняет await func(*args, **kwargs) с учетом лимитов и повторов
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        attempt = 0
+        while True:
+            await self._acquire(priority)
+            try:
+                await self.bucket.acquire()
+                self.stats["calls"] += 1
+                PROVIDER_REQUESTS.inc(provider=self.name)
+                result = await func(*args, **kwargs)
+                # Ответы с ошибкой, которые не бросают исключение (4xx httpx)
+                status_code = getattr(result, "status_code", None)
+                if isinstance(status_code, int) and status_code >= 400:
+                    PROVIDER_ERRORS.inc(provider=self.name, status=error_status(status_code=status_code))
+                return result
+            except Exception as e:
+                PROVIDER_ERRORS.inc(provider=self.name, status=error_status(e))
+                if attempt >= max_retries or not is_transient(e):
+                    self.stats["errors"] += 1
+                    raise
+                error = e
+            finally:
+                self._release()
+
+            delay = self._backoff(attempt, error)
+            attempt += 1
+            self.stats["retries"] += 1
+            logger.warning(
+                "🔁 %s: временная ошибка (%s), повтор %s/%s через %.1f сек",
+                self.name, str(error) or type(error).__name__, attempt, max_retries, delay,
+            )
+            await asyncio.sleep(delay)
+            if priority == PRIORITY_INTERACTIVE:
+                priority = PRIORITY_RETRY
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "shared_rate": isinstance(self.bucket, SQLiteTokenBucket),
+        }
+
+
+def limiter_from_env(name: str, prefix: str, max_concurrency: int, rate: float, max_queue: int = 100) -> ProviderLimiter:
+    """
+    Лимитер с настройками из переменных окружения <PREFIX>_MAX_CONCURRENCY, _RPS, _BURST, _MAX_QUEUE, _MAX_RETRIES
+
+    Лимиты задаются на весь сервер. При нескольких воркерах (WEB_CONCURRENCY) одновременные
+    запросы и очередь делятся между ними поровну, а частота (RPS) считается общим
+    token bucket в SHARED_STATE_PATH.
+    """
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+    rate = float(os.getenv(f"{prefix}_RPS", rate))
+    burst = float(os.getenv(f"{prefix}_BURST", 0)) or rate
+    shared_path = os.getenv("SHARED_STATE_PATH", "")
+    bucket = SQLiteTokenBucket(shared_path, name, rate, burst) if shared_path and rate > 0 else None
+    if workers > 1 and rate > 0 and bucket is None:
+        logger.warning("⚠️ %s: %s воркеров без SHARED_STATE_PATH - лимит %s RPS действует в каждом отдельно", name, workers, rate)
+    return ProviderLimiter(
+        name,
+        max_concurrency=max(1, int(os.getenv(f"{prefix}_MAX_CONCURRENCY", max_concurrency)) // workers),
+        rate=rate,
+        burst=burst,
+        max_queue=max(1, int(os.getenv(f"{prefix}_MAX_QUEUE", max_queue)) // workers),
+        max_retries=int(os.getenv(f"{prefix}_MAX_RETRIES", 3)),
+        bucket=bucket,
+    )
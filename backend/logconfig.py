@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+from tracing import TraceIdFilter
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s"
+
+# Стандартные атрибуты LogRecord - все остальные (из extra=) попадают в JSON как поля
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "trace_id"}
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна строка JSON на запись: время, уровень, логгер, trace_id, сообщение и поля из extra
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, "trace_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """
+    QueueHandler, который передает запись в поток записи почти без работы в event loop
+
+    Подставляются только аргументы сообщения (запись уже прошла проверку уровня,
+    а аргументы могут измениться после возврата); форматирование строки лога/JSON
+    и запись в поток вывода выполняет QueueListener. trace_id проставляется фильтром
+    этого обработчика, пока запись еще в контексте запроса.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Трассировку сохраняем текстом - объект исключения не передаем в другой поток
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogSampler:
+    """
+    Пропускает каждую N-ю запись по ключу - для повторяющихся логов опроса
+
+    if poll_log_sampler("nanobanana-poll"): logger.info(...)
+    """
+
+    def __init__(self, every: int):
+        self.every = max(1, every)
+        self._counters: dict = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, key: str) -> bool:
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = itertools.count()
+            return next(counter) % self.every == 0
+
+
+# LOG_SAMPLE_EVERY - писать каждую N-ю запись повторяющихся логов (1 = все)
+poll_log_sampler = LogSampler(int(os.getenv("LOG_SAMPLE_EVERY", 10)))
+
+
+def configure_logging() -> None:
+    """
+    Настраивает корневой логгер по переменным окружения
+
+    LOG_FORMAT - text (как раньше) или json;
+    LOG_LEVEL - уровень (DEBUG включает полные ответы провайдеров);
+    LOG_QUEUE - 1 = запись в stdout из отдельного потока через очередь (не блокирует event loop).
+    """
+    global _listener
+
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    json_format = os.getenv("LOG_FORMAT", "text").lower() == "json"
+    use_queue = os.getenv("LOG_QUEUE", "1") != "0"
+
+    stream_handler = logging.StreamHandler(sys.stdout if json_format else sys.stderr)
+    stream_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    # Строка "HTTP Request: ..." на каждый запрос к провайдерам - только в режиме DEBUG
+    logging.getLogger("httpx").setLevel(logging.DEBUG if level == "DEBUG" else logging.WARNING)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    stop_logging()
+
+    if use_queue:
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        queue_handler = _QueueHandler(log_queue)
+        queue_handler.addFilter(TraceIdFilter())
+        root.addHandler(queue_handler)
+        _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+    else:
+        stream_handler.addFilter(TraceIdFilter())
+        root.addHandler(stream_handler)
+
+
+def stop_logging() -> None:
+    """
+    Останавливает поток записи логов, дописав все, что осталось в очереди
+    """
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_after_fork() -> None:
+    # Поток записи не переживает fork (воркеры serve.py с предзагрузкой) - запускаем заново
+    global _listener
+    if _listener:
+        _listener = None
+        configure_logging()
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_after_fork)
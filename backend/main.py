@@ -1,31 +1,136 @@
+import io
 import os
-import base64
-import time
-import requests
+import hmac
 import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import re
 import traceback
 import logging
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+import httpx
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from dotenv import load_dotenv
-from openai import OpenAI
-from PIL import Image
-import io
-from typing import Optional
-
-# Настройка детального логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+from openai import AsyncOpenAI
+from typing import Awaitable, Callable, List, Optional
+from nanobanana import (
+    NanoBananaTaskTracker,
+    create_outcome_mailbox,
+    derive_callback_token,
+    is_allowed_result_url,
+    parse_task_outcome,
+)
+from cache import create_result_cache, make_cache_key, make_image_cache_key
+from imaging import (
+    PreparedImage, ImageRejected, prepare_image,
+    MAX_SIDE, CLIENT_FORMAT, CLIENT_QUALITY, ACCEPTED_MIME_TYPES,
+)
+from ingest import UploadSizeLimitMiddleware, MAX_UPLOAD_BYTES, FORM_OVERHEAD_BYTES, upload_size
+from storage import SignedStaticFiles, create_storage, immutable_file_response
+from image_variants import ResultImage, render_variants, negotiate, available_formats, FALLBACK_FORMAT
+from janitor import create_janitor
+from batch import run_batch, parse_styles, BATCH_MAX_PHOTOS, BATCH_MAX_STYLES, BATCH_CONCURRENCY
+from singleflight import create_single_flight
+from http_clients import create_provider_clients
+from catalog import create_catalog
+from embeddings import create_vector_index, embed_texts, recommendation_text, fuse_rankings
+from jsonstream import JsonFieldStream
+from stages import StageGraph
+from tracing import TraceIdMiddleware, current_trace_id
+from history import ClientIdMiddleware, create_history_store, current_client_id, valid_client_id
+from logconfig import configure_logging, poll_log_sampler
+from metrics import (
+    REGISTRY, IN_FLIGHT, QUEUE_DEPTH, UPLOADS_USAGE, VISION_IMAGE_TOKENS,
+    create_shared_metrics, observe_stage, stage_timer,
+)
+from limits import (
+    limiter_from_env, raise_for_transient,
+    PRIORITY_BACKGROUND,
+)
+from jobs import (
+    create_job_store, new_job, format_sse,
+    JOB_RUNNING, JOB_DONE, JOB_FAILED, FINISHED_STATUSES,
 )
-logger = logging.getLogger(__name__)
 
 # Загружаем переменные окружения
 load_dotenv()
 
-app = FastAPI(title="Odezda AI API")
+# Логирование: text/json (LOG_FORMAT), запись из отдельного потока, trace id запроса в каждой строке
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# Пул потоков для CPU-тяжелой работы с Pillow (не блокирует event loop)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 4))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+# Ограничение очереди задач в пуле, чтобы всплеск запросов не копил память
+image_slots = asyncio.Semaphore(IMAGE_WORKERS * 4)
+
+# Пулы keep-alive соединений к OpenAI, Imgur и NanoBanana (закрываются при остановке приложения)
+http_clients = create_provider_clients()
+
+# Хранилище фоновых задач генерации (JOB_STORE=memory | sqlite)
+job_store = create_job_store()
+# История анализов для GET /api/history и /api/analyses/{id} (None если отключена)
+history_store = create_history_store()
+# Ссылки на запущенные фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks: set = set()
+
+# Кэш результатов анализа и сгенерированных изображений (None если отключен)
+result_cache = create_result_cache()
+
+# Объединение одновременных одинаковых запросов (в процессе и между воркерами через SQLite)
+single_flight = create_single_flight()
+
+# Фоновая очистка uploads по возрасту и объему (None если отключена)
+uploads_janitor = create_janitor("uploads")
+
+# Снимки метрик воркеров для суммарного /metrics (None при одном процессе)
+shared_metrics = create_shared_metrics()
+
+# Локальный каталог товаров для ссылок "Где купить" (None - ссылки на поиск маркетплейсов)
+catalog = create_catalog()
+# Векторный индекс товаров каталога для подбора по смыслу рекомендации (None - только по тексту)
+vector_index = create_vector_index() if catalog else None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    if client.is_closed():
+        # Приложение запускается повторно (тесты) - пул прошлого запуска закрыт
+        client = create_openai_client()
+    janitor_task = asyncio.create_task(uploads_janitor.run()) if uploads_janitor else None
+    history_task = asyncio.create_task(history_store.run()) if history_store else None
+    metrics_task = asyncio.create_task(shared_metrics.run(REGISTRY.snapshot)) if shared_metrics else None
+    if catalog:
+        # Индекс строится заранее, чтобы первый запрос не ждал загрузки каталога
+        # (при запуске через serve.py он уже загружен до запуска воркеров)
+        await asyncio.to_thread(catalog.ensure_loaded)
+    if vector_index:
+        await asyncio.to_thread(vector_index.ensure_loaded)
+    try:
+        yield
+    finally:
+        if janitor_task:
+            janitor_task.cancel()
+        if history_task:
+            history_task.cancel()
+        if metrics_task:
+            metrics_task.cancel()
+        for task in list(background_tasks):
+            task.cancel()
+        await nanobanana_tasks.stop()
+        await http_clients.aclose()
+        image_executor.shutdown(wait=False)
+
+
+app = FastAPI(title="Odezda AI API", lifespan=lifespan)
 
 # Настройка CORS
 app.add_middleware(
@@ -34,32 +139,186 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
-# Инициализация OpenAI клиента
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Ограничение размера тела запроса до разбора multipart-формы (для пакета - по числу фото)
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    limits={"/api/analyze/batch": BATCH_MAX_PHOTOS * MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES},
+)
+
+# X-Request-ID: принимаем от клиента или создаем, пробрасываем в логи и ответ
+app.add_middleware(TraceIdMiddleware)
+# X-Client-Id: анонимный id браузера, с которым результаты сохраняются в историю
+app.add_middleware(ClientIdMiddleware)
+
+# Инициализация OpenAI клиента (повторы выполняет планировщик openai_limiter)
+# OPENAI_BASE_URL позволяет направить запросы на совместимый/тестовый сервер
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+
+def create_openai_client() -> AsyncOpenAI:
+    # Соединения - из общего пула провайдера openai (keep-alive, HTTP/2 при наличии h2)
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        base_url=OPENAI_BASE_URL,
+        max_retries=0,
+        http_client=http_clients.get("openai"),
+    )
+
+
+client = create_openai_client()
+
+# Массивы ответа, элементы которых при потоковом анализе отдаются клиенту по одному
+STREAMED_ARRAYS = ("recommendations",)
+
+# Лимиты одновременных запросов и частоты для каждого провайдера (см. env_example.txt)
+openai_limiter = limiter_from_env("openai", "OPENAI", max_concurrency=16, rate=0)
+imgur_limiter = limiter_from_env("imgur", "IMGUR", max_concurrency=4, rate=2)
+nanobanana_limiter = limiter_from_env("nanobanana", "NANOBANANA", max_concurrency=8, rate=5)
 
 # Создаем директорию для временных файлов
 os.makedirs("uploads", exist_ok=True)
 
-# Монтируем папку uploads для доступа к файлам
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Монтируем папку uploads для доступа к файлам (по подписанным URL, если задан STORAGE_SIGNING_KEY)
+app.mount(
+    "/uploads",
+    SignedStaticFiles(directory="uploads", signing_key=os.getenv("STORAGE_SIGNING_KEY") or None),
+    name="uploads",
+)
+
+# Хранилище загруженных и сгенерированных изображений (STORAGE_BACKEND=local | s3 | imgur)
+storage = create_storage(lambda: http_clients.get("imgur"), root="uploads", imgur_limiter=imgur_limiter)
 
 
-def analyze_image_and_style(image_data: bytes, style: str) -> dict:
+async def run_in_image_executor(func, *args):
     """
-    Анализирует фото пользователя и подбирает одежду в указанном стиле
+    Выполняет синхронную функцию обработки изображений в пуле потоков
+    """
+    loop = asyncio.get_running_loop()
+    async with image_slots:
+        return await loop.run_in_executor(image_executor, func, *args)
+
+
+def build_vision_request(image: PreparedImage, prompt: str, max_tokens: int = 2000) -> dict:
+    """
+    Параметры chat.completions.create для запроса с фото и промптом в режиме JSON
+    """
+    # Вариант фото для GPT-4o: кадр, разрешение и detail выбраны при подготовке (см. vision.py)
+    image_url = {"url": f"data:image/jpeg;base64,{image.vision_base64}"}
+    if image.vision_detail:
+        image_url["detail"] = image.vision_detail
+    return dict(
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": image_url}
+                ]
+            }
+        ],
+        max_tokens=max_tokens,
+        response_format={"type": "json_object"}
+    )
+
+
+async def stream_vision_content(request: dict, on_event: Callable[[tuple], Awaitable]) -> str:
+    """
+    Читает ответ OpenAI потоком и передает в on_event поля JSON, как только они готовы
+
+    Выполняется целиком внутри слота openai_limiter: слот занят, пока идет генерация,
+    а при повторе после временной ошибки разбор начинается заново (события повторяются
+    с теми же ключами и индексами).
+    """
+    started = time.perf_counter()
+    parser = JsonFieldStream(item_arrays=STREAMED_ARRAYS)
+    parts = []
+    first_event = True
+    stream = await client.chat.completions.create(**request, stream=True)
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        parts.append(delta)
+        for event in parser.feed(delta):
+            if first_event:
+                # Время до первого готового поля - то, сколько пользователь ждет первый контент
+                observe_stage("openai_first_field", time.perf_counter() - started)
+                first_event = False
+            await on_event(event)
+    return "".join(parts)
+
+
+async def request_vision_json(
+    image: PreparedImage,
+    prompt: str,
+    max_tokens: int = 2000,
+    on_event: Optional[Callable[[tuple], Awaitable]] = None,
+) -> dict:
     """
+    Один запрос к GPT-4o с фото и промптом в режиме JSON, возвращает разобранный ответ
+
+    on_event - необязательный async callback: ответ запрашивается потоком (stream=True),
+    и callback получает события JsonFieldStream (готовые поля и рекомендации) по мере генерации
+    """
+    request = build_vision_request(image, prompt, max_tokens)
+    if image.vision:
+        VISION_IMAGE_TOKENS.inc(image.vision.tokens, detail=image.vision_detail or "default")
+        logger.info(
+            "🖼️ Фото для GPT-4o: %sx%s, detail=%s, ~%s токенов, %s байт",
+            image.vision.width, image.vision.height, image.vision_detail or "default",
+            image.vision.tokens, len(image.vision.jpeg),
+        )
+    
+    # Отправляем запрос к OpenAI
+    logger.info("🚀 Отправка запроса к OpenAI API (модель: gpt-4o%s)...", ", поток" if on_event else "")
     try:
-        logger.info(f"🎨 analyze_image_and_style: начало анализа для стиля '{style}'")
-        
-        # Конвертируем изображение в base64
-        logger.info("🔄 Конвертация изображения в base64...")
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-        logger.info(f"✅ Base64 изображение готово (длина: {len(base64_image)} символов)")
-        
-        # Создаем промпт для анализа
-        prompt = f"""Проанализируй это фото человека и подбери одежду в стиле "{style}".
+        with stage_timer("openai"):
+            if on_event:
+                content = await openai_limiter.call(stream_vision_content, request, on_event)
+            else:
+                response = await openai_limiter.call(client.chat.completions.create, **request)
+                content = response.choices[0].message.content if response.choices else None
+        logger.info("✅ Ответ от OpenAI получен!")
+    except HTTPException:
+        raise
+    except Exception as openai_error:
+        logger.error("❌ Ошибка при запросе к OpenAI API: %s", openai_error)
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"Ошибка OpenAI API: {str(openai_error)}")
+    
+    # Парсим ответ
+    logger.debug("🔍 Парсинг ответа OpenAI...")
+    
+    # Проверяем что ответ не пустой
+    if not content:
+        logger.error("❌ OpenAI вернул пустой ответ")
+        raise HTTPException(status_code=500, detail="OpenAI вернул пустой ответ. Попробуйте еще раз.")
+    
+    logger.debug("✅ Получен контент (длина: %s символов)", len(content))
+    
+    try:
+        result = json.loads(content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("✅ JSON успешно распарсен, ключи: %s", list(result.keys()))
+    except json.JSONDecodeError as e:
+        logger.error("❌ Ошибка парсинга JSON: %s", e)
+        logger.error("📄 Контент от OpenAI: %s...", content[:500])
+        raise HTTPException(status_code=500, detail=f"Ошибка обработки ответа AI: {str(e)}")
+    
+    return result
+
+
+def build_style_prompt(style: str) -> str:
+    """
+    Промпт анализа фото и подбора одежды в одном стиле
+    """
+    return f"""Проанализируй это фото человека и подбери одежду в стиле "{style}".
 
 Верни ответ в формате JSON со следующими полями:
 1. "analysis": краткий анализ внешности человека (тип фигуры, цвет кожи, волос)
@@ -74,240 +333,354 @@ def analyze_image_and_style(image_data: bytes, style: str) -> dict:
 
 Стиль должен соответствовать: {style}"""
 
-        logger.info(f"📝 Промпт создан (длина: {len(prompt)} символов)")
-        
-        # Отправляем запрос к OpenAI
-        logger.info("🚀 Отправка запроса к OpenAI API (модель: gpt-4o)...")
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=2000,
-                response_format={"type": "json_object"}
-            )
-            logger.info("✅ Ответ от OpenAI получен!")
-        except Exception as openai_error:
-            logger.error(f"❌ Ошибка при запросе к OpenAI API: {str(openai_error)}")
-            logger.error(traceback.format_exc())
-            raise HTTPException(status_code=500, detail=f"Ошибка OpenAI API: {str(openai_error)}")
-        
-        # Парсим ответ
-        logger.info("🔍 Парсинг ответа OpenAI...")
-        
-        # Проверяем что ответ не пустой
-        if not response.choices or not response.choices[0].message.content:
-            logger.error("❌ OpenAI вернул пустой ответ")
-            raise HTTPException(status_code=500, detail="OpenAI вернул пустой ответ. Попробуйте еще раз.")
-        
-        content = response.choices[0].message.content
-        logger.info(f"✅ Получен контент (длина: {len(content)} символов)")
+
+async def analyze_image_and_style(
+    image: PreparedImage,
+    style: str,
+    on_event: Optional[Callable[[tuple], Awaitable]] = None,
+) -> dict:
+    """
+    Анализирует фото пользователя и подбирает одежду в указанном стиле
+
+    on_event - получает готовые поля ответа по мере генерации (см. request_vision_json)
+    """
+    try:
+        logger.info("🎨 analyze_image_and_style: начало анализа для стиля '%s'", style)
         
-        try:
-            result = json.loads(content)
-            logger.info(f"✅ JSON успешно распарсен, ключи: {list(result.keys())}")
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ Ошибка парсинга JSON: {str(e)}")
-            logger.error(f"📄 Контент от OpenAI: {content[:500]}...")
-            raise HTTPException(status_code=500, detail=f"Ошибка обработки ответа AI: {str(e)}")
+        prompt = build_style_prompt(style)
+
+        logger.debug("📝 Промпт создан (длина: %s символов)", len(prompt))
         
+        result = await request_vision_json(image, prompt, on_event=on_event)
         logger.info("✅ analyze_image_and_style: анализ завершен успешно")
         return result
         
     except HTTPException:
         raise
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error("=" * 80)
-        logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА В analyze_image_and_style")
-        logger.error("=" * 80)
-        logger.error(error_details)
-        logger.error("=" * 80)
+        logger.exception("❌ КРИТИЧЕСКАЯ ОШИБКА В analyze_image_and_style")
         raise HTTPException(status_code=500, detail=f"Ошибка анализа: {str(e)}")
 
 
-def fix_image_orientation(image_data: bytes) -> bytes:
+# Ответ на несколько стилей длиннее - лимит токенов растет со числом стилей
+MULTI_STYLE_TOKENS_PER_STYLE = 1800
+MULTI_STYLE_MAX_TOKENS = 16000
+
+
+async def analyze_image_multi_style(image: PreparedImage, styles: list) -> dict:
     """
-    Исправляет ориентацию изображения согласно EXIF данным
+    Анализирует фото один раз и подбирает одежду сразу для нескольких стилей
+
+    Фото уходит в GPT-4o одним запросом вместо запроса на каждый стиль. Возвращает
+    {стиль: результат} в том же формате, что analyze_image_and_style.
     """
     try:
-        from PIL import Image, ImageOps
-        import io
+        logger.info("🎨 analyze_image_multi_style: начало анализа для стилей %s", styles)
+        styles_list = ", ".join(f'"{style}"' for style in styles)
         
-        # Открываем изображение
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Проверяем EXIF данные
-        try:
-            # ImageOps.exif_transpose автоматически поворачивает изображение по EXIF
-            image = ImageOps.exif_transpose(image)
-            print("🔄 Исправлена ориентация изображения по EXIF")
-        except Exception as exif_error:
-            # Если нет EXIF или ошибка - оставляем как есть
-            print(f"ℹ️ EXIF ориентация не найдена или не требует исправления")
-        
-        # Конвертируем обратно в bytes
-        output = io.BytesIO()
-        # Сохраняем в JPEG с хорошим качеством, без EXIF данных
-        image.save(output, format='JPEG', quality=95, optimize=True)
-        output.seek(0)
+        prompt = f"""Проанализируй это фото человека и подбери одежду в каждом из стилей: {styles_list}.
+
+Верни ответ в формате JSON со следующими полями:
+1. "analysis": краткий анализ внешности человека (тип фигуры, цвет кожи, волос)
+2. "person_description": детальное описание внешности для генерации изображения (пол, возраст, цвет волос, телосложение, черты лица) - на английском
+3. "styles": объект, где ключ - название стиля ровно как в списке выше, а значение - объект с полями:
+   - "outfit_description": детальное описание полного образа одежды в этом стиле (на английском)
+   - "recommendations": массив из 5-7 рекомендаций одежды, каждая с полями:
+     - "item": название предмета одежды (на русском)
+     - "description": описание (цвет, материал, особенности)
+     - "why": почему это подходит человеку и стилю
+     - "search_query": поисковый запрос для поиска товара (НА РУССКОМ ЯЗЫКЕ! Например: "черное пальто женское", "синие джинсы мужские")
+   - "style_tips": 3-5 общих советов по стилю
+
+Каждый образ должен соответствовать своему стилю."""
+
+        max_tokens = min(MULTI_STYLE_MAX_TOKENS, MULTI_STYLE_TOKENS_PER_STYLE * len(styles))
+        result = await request_vision_json(image, prompt, max_tokens=max_tokens)
+        
+        per_style = result.get("styles") or {}
+        # Модель может слегка изменить регистр или пробелы в названии стиля
+        normalized = {str(key).strip().lower(): value for key, value in per_style.items()}
+        results = {}
+        for style in styles:
+            style_result = per_style.get(style) or normalized.get(style.strip().lower())
+            if not isinstance(style_result, dict):
+                logger.error("❌ В ответе нет стиля '%s' (получены: %s)", style, list(per_style.keys()))
+                raise HTTPException(status_code=500, detail=f"AI не вернул рекомендации для стиля '{style}'")
+            results[style] = {
+                "analysis": result.get("analysis", ""),
+                "person_description": result.get("person_description", ""),
+                **style_result,
+            }
         
-        return output.read()
+        logger.info("✅ analyze_image_multi_style: анализ завершен успешно")
+        return results
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"⚠️ Не удалось исправить ориентацию: {str(e)}, использую оригинал")
-        return image_data
+        logger.exception("❌ КРИТИЧЕСКАЯ ОШИБКА В analyze_image_multi_style")
+        raise HTTPException(status_code=500, detail=f"Ошибка анализа: {str(e)}")
+
+
+def render_result_image(image_data: bytes) -> ResultImage:
+    """
+    Поворачивает сгенерированное изображение на 90° вправо и готовит варианты (CPU, в пуле потоков)
+    """
+    # -90 = вправо; хранилища без вариантов (Imgur) получают только JPEG
+    formats = available_formats() if storage.supports_variants else [FALLBACK_FORMAT]
+    return render_variants(image_data, rotate=-90, formats=formats)
+
+
+async def publish_result_image(result: ResultImage) -> Optional[dict]:
+    """
+    Сохраняет варианты в хранилище: {"url": самый большой JPEG, "variants": srcset по форматам и LQIP}
+    """
+    if not storage.supports_variants:
+        largest = result.largest
+        url = await storage.save(largest.data, largest.content_type)
+        return {"url": url, "variants": {"width": result.width, "height": result.height, "placeholder": result.placeholder}} if url else None
+
+    urls = await asyncio.gather(*(
+        storage.save_variant(result.variant_name(variant.width), variant.data, variant.content_type)
+        for variant in result.variants
+    ))
+    if not all(urls):
+        return None
+    sources = {}
+    for variant, url in zip(result.variants, urls):
+        sources.setdefault(variant.content_type, []).append(f"{url} {variant.width}w")
+    largest_url = urls[result.variants.index(result.largest)]
+    return {
+        "url": largest_url,
+        "variants": {
+            "width": result.width,
+            "height": result.height,
+            "placeholder": result.placeholder,
+            # Формат по Accept выбирает сервер (локальное хранилище), иначе - самый большой JPEG
+            "src": storage.negotiated_url(result.variant_name(result.width)) if storage.name == "local" else largest_url,
+            "sources": [{"type": content_type, "srcset": ", ".join(srcset)} for content_type, srcset in sources.items()],
+        },
+    }
+
+
+def map_result_image_urls(result: dict, convert) -> dict:
+    """
+    Копия результата, в которой ссылки на сгенерированное изображение (URL и srcset)
+    пропущены через convert: storage.to_ref - для истории, storage.from_ref - при чтении из нее.
+    convert вернул None (файл удален уборщиком) - результат без изображения.
+    """
+    if not result.get("generated_image"):
+        return result
+    result = dict(result)
+    url = convert(result.pop("generated_image"))
+    variants = result.pop("generated_image_variants", None)
+    if not url:
+        return result
+    result["generated_image"] = url
+    if variants:
+        sources = []
+        for source in variants.get("sources") or []:
+            srcset = []
+            for candidate in source["srcset"].split(", "):
+                candidate_url, _, width = candidate.rpartition(" ")
+                candidate_url = convert(candidate_url)
+                if candidate_url:
+                    srcset.append(f"{candidate_url} {width}")
+            if srcset:
+                sources.append({**source, "srcset": ", ".join(srcset)})
+        result["generated_image_variants"] = {
+            **variants,
+            "src": (convert(variants["src"]) or url) if variants.get("src") else url,
+            "sources": sources,
+        }
+    return result
+
+
+def map_generated_image_urls(image: dict, convert) -> Optional[dict]:
+    """
+    То же для результата генерации ({"url", "variants", "task_id"}) - для кэша изображений;
+    None - файл удален уборщиком
+    """
+    mapped = map_result_image_urls(
+        {"generated_image": image["url"], "generated_image_variants": image.get("variants")}, convert
+    )
+    if not mapped.get("generated_image"):
+        return None
+    image = {**image, "url": mapped["generated_image"]}
+    if mapped.get("generated_image_variants"):
+        image["variants"] = mapped["generated_image_variants"]
+    return image
+
+
+def image_cache_value(image: dict) -> Optional[dict]:
+    """
+    Значение для кэша изображений: ссылки хранилища без срока действия. Ссылка NanoBanana
+    (не удалось сохранить повернутое изображение) временная - не кэшируется.
+    """
+    if image.get("provider_url"):
+        return None
+    return map_generated_image_urls(image, storage.to_ref)
+
+
+def image_from_cache(value: dict) -> Optional[dict]:
+    """
+    Изображение из кэша со свежими URL; None - файл удален (может обращаться к диску)
+    """
+    return map_generated_image_urls(value, storage.from_ref)
 
 
-def fix_result_image_orientation(image_url: str) -> str:
+async def fix_result_image_orientation(image_url: str) -> Optional[dict]:
     """
-    Скачивает сгенерированное изображение, поворачивает на 90° вправо и загружает обратно
+    Скачивает сгенерированное изображение, поворачивает на 90° вправо и сохраняет в
+    адаптивных вариантах (AVIF/WebP/JPEG на нескольких ширинах)
     """
     try:
-        from PIL import Image
-        import io
-        
-        print(f"📥 Скачиваю изображение с {image_url[:50]}...")
+        logger.info("📥 Скачиваю изображение с %s...", image_url[:50])
         
         # Скачиваем изображение
-        response = requests.get(image_url, timeout=30)
+        async def download():
+            return raise_for_transient(await http_clients.get("nanobanana").get(image_url, timeout=30))
+        
+        response = await nanobanana_limiter.call(download)
         if response.status_code != 200:
-            print(f"❌ Не удалось скачать изображение: HTTP {response.status_code}")
+            logger.error("❌ Не удалось скачать изображение: HTTP %s", response.status_code)
             return None
         
         image_data = response.content
-        print(f"✅ Изображение скачано ({len(image_data)} байт)")
-        
-        # Открываем изображение
-        image = Image.open(io.BytesIO(image_data))
-        
-        # ПОВОРАЧИВАЕМ НА 90° ВПРАВО (по часовой стрелке)
-        print(f"🔄 Поворачиваю изображение на 90° вправо...")
-        rotated_image = image.rotate(-90, expand=True)  # -90 = вправо, expand=True чтобы не обрезать
+        logger.debug("✅ Изображение скачано (%s байт)", len(image_data))
         
-        # Конвертируем в bytes
-        output = io.BytesIO()
-        rotated_image.save(output, format='JPEG', quality=95, optimize=True)
-        output.seek(0)
-        fixed_data = output.read()
+        # ПОВОРАЧИВАЕМ НА 90° ВПРАВО (по часовой стрелке) и кодируем варианты
+        with stage_timer("result_variants"):
+            result = await run_in_image_executor(render_result_image, image_data)
         
-        # Загружаем повернутое изображение на Imgur
-        print(f"📤 Загружаю повернутое изображение на Imgur...")
-        fixed_url = upload_image_to_imgur(fixed_data)
-        
-        if fixed_url:
-            return fixed_url
-        else:
-            return None
+        # Сохраняем варианты в хранилище
+        logger.info("📤 Сохраняю повернутое изображение (%s): %s вариантов", storage.name, len(result.variants))
+        return await publish_result_image(result)
             
     except Exception as e:
-        print(f"❌ Ошибка при повороте изображения: {str(e)}")
+        logger.error("❌ Ошибка при повороте изображения: %s", e)
         return None
 
 
-def upload_image_to_imgur(image_data: bytes) -> str:
+async def upload_image_temp(image: PreparedImage) -> str:
     """
-    Загружает изображение на Imgur и возвращает публичный URL
+    Сохраняет изображение в хранилище и возвращает публичный URL для NanoBanana
     """
     try:
-        import base64
-        
-        # ИСПРАВЛЯЕМ ОРИЕНТАЦИЮ перед загрузкой!
-        image_data = fix_image_orientation(image_data)
-        
-        # Imgur API (анонимная загрузка, без регистрации)
-        url = "https://api.imgur.com/3/image"
-        
-        headers = {
-            "Authorization": "Client-ID 546c25a59c58ad7"  # Публичный Client ID
-        }
-        
-        # Конвертируем в base64
-        image_b64 = base64.b64encode(image_data).decode('utf-8')
-        
-        data = {
-            "image": image_b64,
-            "type": "base64"
-        }
-        
-        print("📤 Загрузка изображения на Imgur...")
-        response = requests.post(url, headers=headers, data=data, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            if result.get("success"):
-                image_url = result["data"]["link"]
-                # ОБЯЗАТЕЛЬНО используем HTTPS для совместимости с мобильными браузерами!
-                if image_url.startswith("http://"):
-                    image_url = image_url.replace("http://", "https://", 1)
-                print(f"✅ Изображение загружено: {image_url[:60]}...")
-                return image_url
-            else:
-                print(f"❌ Imgur вернул ошибку: {result}")
-                return None
-        else:
-            print(f"❌ Ошибка загрузки на Imgur: {response.status_code}")
-            print(f"📄 Ответ: {response.text}")
-            return None
-            
+        with stage_timer("upload"):
+            public_url = await storage.save(image.jpeg, "image/jpeg", b64=image.base64)
+        if not public_url:
+            logger.error("❌ Не удалось сохранить изображение (%s)", storage.name)
+        return public_url
     except Exception as e:
-        print(f"❌ Ошибка загрузки на Imgur: {str(e)}")
+        logger.error("❌ Ошибка сохранения изображения: %s", e)
         return None
 
 
-def upload_image_temp(image_data: bytes) -> str:
+NANOBANANA_API_URL = os.getenv("NANOBANANA_API_URL") or "https://api.nanobananaapi.ai/api/v1/nanobanana"
+# Сколько ждать результата генерации (секунд)
+NANOBANANA_TIMEOUT = float(os.getenv("NANOBANANA_TIMEOUT", 180))
+# Хосты, с которых вебхук может прислать результат (сервер скачивает его сам)
+NANOBANANA_RESULT_HOSTS = [
+    host.strip().lower()
+    for host in os.getenv("NANOBANANA_RESULT_HOSTS", "nanobananaapi.ai,aiquickdraw.com").split(",")
+    if host.strip()
+]
+
+
+def nanobanana_callback_token() -> Optional[str]:
+    """
+    NANOBANANA_CALLBACK_TOKEN, иначе токен из NANOBANANA_API_KEY - вебхук всегда с токеном
+    """
+    token = os.getenv("NANOBANANA_CALLBACK_TOKEN")
+    if token:
+        return token
+    api_key = os.getenv("NANOBANANA_API_KEY")
+    return derive_callback_token(api_key) if api_key else None
+
+
+def nanobanana_callback_url() -> str:
+    """
+    URL вебхука для NanoBanana (NANOBANANA_CALLBACK_URL или PUBLIC_BASE_URL + путь)
+    """
+    callback_url = os.getenv("NANOBANANA_CALLBACK_URL")
+    if not callback_url and os.getenv("PUBLIC_BASE_URL"):
+        callback_url = os.getenv("PUBLIC_BASE_URL").rstrip("/") + "/api/callbacks/nanobanana"
+    if not callback_url:
+        # Параметр обязательный - без публичного адреса результат получит опросчик
+        return "https://nanobanana-callback.example.com/webhook"
+    token = nanobanana_callback_token()
+    if token:
+        callback_url += ("&" if "?" in callback_url else "?") + f"token={token}"
+    return callback_url
+
+
+async def fetch_nanobanana_status(task_id: str) -> Optional[dict]:
     """
-    Сохраняет изображение локально И загружает на Imgur для публичного доступа
+    Запрашивает статус задачи NanoBanana (record-info) для общего опросчика
     """
+    api_key = os.getenv("NANOBANANA_API_KEY")
     try:
-        # Сохраняем локально для резервной копии
-        timestamp = int(time.time())
-        filename = f"temp_{timestamp}.jpg"
-        filepath = f"uploads/{filename}"
-        
-        with open(filepath, 'wb') as f:
-            f.write(image_data)
-        
-        print(f"💾 Изображение сохранено локально: {filename}")
-        
-        # Загружаем на Imgur для публичного доступа
-        public_url = upload_image_to_imgur(image_data)
-        
-        if public_url:
-            return public_url
-        else:
-            print("⚠️ Не удалось загрузить на Imgur, используем localhost (может не работать)")
-            return f"http://localhost:8000/uploads/{filename}"
-            
-    except Exception as e:
-        print(f"❌ Ошибка сохранения изображения: {str(e)}")
+        # Без повторов: у опросчика своя адаптивная задержка
+        status_response = await nanobanana_limiter.call(
+            http_clients.get("nanobanana").get,
+            f"{NANOBANANA_API_URL}/record-info",
+            params={"taskId": task_id},
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=10,
+            priority=PRIORITY_BACKGROUND,
+            max_retries=0,
+        )
+    except httpx.TimeoutException:
+        # Опрос повторяется часто - пишем только каждую N-ю одинаковую запись
+        if poll_log_sampler("nanobanana-poll-timeout"):
+            logger.warning("⏱️ Таймаут при проверке статуса задачи %s, повторю позже...", task_id)
+        return None
+    
+    if status_response.status_code != 200:
+        if poll_log_sampler("nanobanana-poll-http"):
+            logger.error("❌ HTTP ошибка при проверке статуса: %s", status_response.status_code)
         return None
+    
+    status_data = status_response.json()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📦 Статус задачи %s: %s", task_id, json.dumps(status_data, ensure_ascii=False))
+    response_code = status_data.get("code")
+    if response_code == 404:
+        # Задача еще не найдена, продолжаем ждать
+        return None
+    elif response_code and response_code != 200:
+        error_msg = status_data.get("msg", "Unknown error")
+        logger.error("❌ API вернул ошибку при проверке статуса (code %s): %s", response_code, error_msg)
+        return {"successFlag": 2, "errorMessage": error_msg}
+    
+    return status_data.get("data") or {}
+
+
+# Общий трекер задач: завершаются вебхуком или одним фоновым опросчиком на процесс
+nanobanana_tasks = NanoBananaTaskTracker(
+    fetch_nanobanana_status,
+    # С настроенным вебхуком первый опрос откладываем - результат обычно придет сам
+    initial_delay=30.0 if (os.getenv("NANOBANANA_CALLBACK_URL") or os.getenv("PUBLIC_BASE_URL")) else 2.0,
+    # Итоги из вебхуков, принятых другими воркерами (SHARED_STATE_PATH)
+    mailbox=create_outcome_mailbox(),
+)
 
 
-def generate_outfit_image_nanobanana(image_url: str, recommendations: list, style: str) -> str:
+async def generate_outfit_image_nanobanana(image_url: str, recommendations: list, style: str) -> Optional[dict]:
     """
     Генерирует изображение с новой одеждой используя NanoBanana API
     Использует конкретные вещи из recommendations для точности
+
+    Возвращает {"url": ..., "variants": ..., "task_id": ...} (variants - нет, если повернуть не удалось)
     """
     try:
         api_key = os.getenv("NANOBANANA_API_KEY")
         if not api_key:
-            print("❌ NanoBanana API ключ не найден в .env")
+            logger.error("❌ NanoBanana API ключ не найден в .env")
             return None
         
-        url = "https://api.nanobananaapi.ai/api/v1/nanobanana/generate"
+        url = f"{NANOBANANA_API_URL}/generate"
         
         headers = {
             "Authorization": f"Bearer {api_key}",
@@ -335,194 +708,122 @@ Maintain photorealistic quality and natural lighting."""
             "imageUrls": [image_url],
             "numImages": 1,
             "image_size": "4:3",  # Горизонтальный формат
-            "callBackUrl": "https://nanobanana-callback.example.com/webhook"  # Обязательный параметр
+            "callBackUrl": nanobanana_callback_url()  # Обязательный параметр
         }
         
-        print(f"\n🚀 Отправка запроса в NanoBanana API...")
-        print(f"📷 URL изображения: {image_url}")
-        print(f"👕 Конкретные вещи из рекомендаций:")
-        for item in clothing_items:
-            print(f"   - {item}")
-        print(f"🎨 Стиль: {style}")
+        logger.info("🚀 Отправка запроса в NanoBanana API (стиль: %s, вещей: %s)...", style, len(clothing_items))
+        logger.debug("📷 URL изображения: %s; вещи: %s", image_url, clothing_list)
+        
+        async def create_task():
+            return raise_for_transient(await http_clients.get("nanobanana").post(url, headers=headers, json=data, timeout=30))
         
-        response = requests.post(url, headers=headers, json=data, timeout=30)
+        with stage_timer("nanobanana_create"):
+            response = await nanobanana_limiter.call(create_task)
         
         if response.status_code == 200:
             result = response.json()
-            print(f"📦 Полный ответ API: {result}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📦 Полный ответ API: %s", json.dumps(result, ensure_ascii=False))
             
             # Проверяем код ответа в теле
             response_code = result.get("code")
             if response_code != 200:
                 error_msg = result.get("msg", "Unknown error")
-                print(f"❌ API вернул ошибку (code {response_code}): {error_msg}")
+                logger.error("❌ API вернул ошибку (code %s): %s", response_code, error_msg)
                 return None
             
             task_id = result.get("data", {}).get("taskId")
             
             if not task_id:
-                print(f"❌ Не получен taskId: {result}")
+                logger.error("❌ Не получен taskId: %s", result)
                 return None
             
-            print(f"✅ Задача создана! ID: {task_id}")
-            print(f"⏳ Ожидание обработки (может занять до 3 минут)...")
-            print(f"🔗 Проверить статус можно на: https://nanobananaapi.ai/dashboard/tasks")
+            logger.info("✅ Задача создана! ID: %s, ожидание обработки (может занять до 3 минут)...", task_id)
             
-            # Polling результата - правильный endpoint!
-            max_attempts = 90  # 90 попыток по 2 секунды = 180 секунд (3 минуты)
-            for attempt in range(max_attempts):
-                time.sleep(2)
-                
-                # ПРАВИЛЬНЫЙ endpoint с query параметром!
-                status_url = f"https://api.nanobananaapi.ai/api/v1/nanobanana/record-info?taskId={task_id}"
-                
-                try:
-                    status_response = requests.get(
-                        status_url, 
-                        headers={"Authorization": f"Bearer {api_key}"},
-                        timeout=10
-                    )
-                except requests.exceptions.Timeout:
-                    print(f"⏱️ Таймаут при проверке статуса (попытка {attempt + 1}), повторяю...")
-                    continue
-                
-                if status_response.status_code == 200:
-                    status_data = status_response.json()
-                    
-                    # Логируем полный ответ каждые 30 секунд для отладки
-                    if attempt % 15 == 0 or attempt == 0:
-                        print(f"\n📊 Полный ответ статуса (попытка {attempt + 1}/{max_attempts}):")
-                        print(f"   {status_data}")
-                    
-                    # Проверяем код ответа в теле
-                    response_code = status_data.get("code")
-                    if response_code == 404:
-                        # Задача еще не найдена, продолжаем ждать
-                        if attempt % 10 == 0:
-                            print(f"⏳ Задача еще не найдена в системе, ожидаю...")
-                        continue
-                    elif response_code and response_code != 200:
-                        error_msg = status_data.get("msg", "Unknown error")
-                        print(f"❌ API вернул ошибку при проверке статуса (code {response_code}): {error_msg}")
-                        print(f"📄 Детали: {status_data}")
-                        return None
-                    
-                    # Получаем данные задачи
-                    task_data = status_data.get("data", {})
-                    
-                    # successFlag: 0-generating, 1-success, 2-create task failed, 3-generation failed
-                    success_flag = task_data.get("successFlag")
-                    error_message = task_data.get("errorMessage", "")
-                    
-                    # Выводим статус каждые 10 секунд
-                    if attempt % 5 == 0:
-                        status_text = {
-                            0: "GENERATING",
-                            1: "SUCCESS",
-                            2: "CREATE_TASK_FAILED",
-                            3: "GENERATION_FAILED"
-                        }.get(success_flag, f"UNKNOWN({success_flag})")
-                        print(f"⏳ Статус: {status_text} (попытка {attempt + 1}/{max_attempts}, {attempt * 2}сек)")
-                    
-                    # Проверяем статус по successFlag
-                    if success_flag == 1:  # SUCCESS
-                        # Получаем URL из response
-                        response_obj = task_data.get("response", {})
-                        result_url = response_obj.get("resultImageUrl") or response_obj.get("originImageUrl")
-                        
-                        if result_url:
-                            print(f"\n🎉 Изображение готово!")
-                            print(f"🔗 Оригинальный URL: {result_url[:60]}...")
-                            
-                            # ПОВОРАЧИВАЕМ изображение на 90° вправо!
-                            print(f"🔄 Скачиваю и поворачиваю изображение...")
-                            fixed_url = fix_result_image_orientation(result_url)
-                            
-                            if fixed_url:
-                                print(f"✅ Изображение повернуто!")
-                                print(f"🔗 Финальный URL: {fixed_url[:60]}...")
-                                return fixed_url
-                            else:
-                                print(f"⚠️ Не удалось повернуть, использую оригинал")
-                                return result_url
-                        else:
-                            print(f"\n❌ Задача завершена успешно но URL изображения не найден")
-                            print(f"📄 Полный ответ: {status_data}")
-                            return None
-                    
-                    elif success_flag == 2 or success_flag == 3:  # FAILED
-                        print(f"\n❌ Задача завершилась с ошибкой (flag={success_flag})")
-                        if error_message:
-                            print(f"💬 Сообщение: {error_message}")
-                        print(f"📄 Детали: {status_data}")
-                        return None
-                    
-                    elif success_flag == 0:  # GENERATING
-                        # Задача еще обрабатывается, продолжаем ждать
-                        continue
-                    
-                    else:
-                        # Неизвестный successFlag
-                        if attempt % 10 == 0:
-                            print(f"⚠️ Неизвестный successFlag: {success_flag}")
-                            print(f"📄 Продолжаю ждать... (попытка {attempt + 1}/{max_attempts})")
-                        continue
-                else:
-                    print(f"❌ HTTP ошибка при проверке статуса: {status_response.status_code}")
-                    if attempt % 10 == 0:
-                        print(f"📄 Ответ: {status_response.text[:200]}")
+            # Ждем вебхук или общий опросчик (без отдельного цикла на каждый запрос)
+            with stage_timer("nanobanana_result"):
+                outcome = await nanobanana_tasks.wait(task_id, timeout=NANOBANANA_TIMEOUT)
             
-            print(f"\n⏰ Превышено время ожидания ({max_attempts * 2} секунд)")
-            print(f"💡 Проверьте результат вручную: https://nanobananaapi.ai/dashboard/tasks")
-            print(f"🆔 Task ID: {task_id}")
-            return None
+            if outcome is None:
+                logger.warning(
+                    "⏰ Превышено время ожидания (%.0f секунд), задача %s - проверьте вручную: "
+                    "https://nanobananaapi.ai/dashboard/tasks",
+                    NANOBANANA_TIMEOUT, task_id,
+                )
+                return None
+            
+            if not outcome["success"]:
+                logger.error("❌ Задача завершилась с ошибкой: %s", outcome['error'])
+                return None
+            
+            result_url = outcome["url"]
+            logger.info("🎉 Изображение готово: %s...", result_url[:60])
+            
+            # ПОВОРАЧИВАЕМ изображение на 90° вправо!
+            with stage_timer("result_fix"):
+                fixed = await fix_result_image_orientation(result_url)
+            
+            if fixed:
+                logger.info("✅ Изображение повернуто: %s...", fixed["url"][:60])
+                return {**fixed, "task_id": task_id}
+            else:
+                logger.warning("⚠️ Не удалось повернуть, использую оригинал")
+                # Временная ссылка NanoBanana - в кэш не попадает
+                return {"url": result_url, "task_id": task_id, "provider_url": True}
         
         else:
-            print(f"❌ Ошибка NanoBanana API: {response.status_code}")
-            print(f"📄 Ответ: {response.text}")
+            logger.error("❌ Ошибка NanoBanana API: %s, ответ: %s", response.status_code, response.text[:500])
             return None
     
-    except requests.exceptions.Timeout:
-        print("❌ Превышено время ожидания запроса")
+    except httpx.TimeoutException:
+        logger.error("❌ Превышено время ожидания запроса")
         return None
     except Exception as e:
-        print(f"❌ Ошибка генерации через NanoBanana: {str(e)}")
+        logger.error("❌ Ошибка генерации через NanoBanana: %s", e)
         return None
 
 
-def generate_outfit_image(person_description: str, recommendations: list, style: str, original_image_data: bytes = None) -> str:
+async def generate_outfit_image(
+    person_description: str,
+    recommendations: list,
+    style: str,
+    original_image: Optional[PreparedImage] = None,
+    image_url: Optional[str] = None,
+) -> Optional[dict]:
     """
     Генерирует изображение человека в конкретных рекомендованных вещах используя NanoBanana API
+
+    image_url - фото, уже загруженное заранее (параллельно с анализом); иначе загружается здесь
     """
     try:
-        if not original_image_data:
-            print("⚠️ Оригинальное фото не передано")
+        if not original_image:
+            logger.warning("⚠️ Оригинальное фото не передано")
             return None
         
         if not recommendations:
-            print("⚠️ Рекомендации одежды отсутствуют")
+            logger.warning("⚠️ Рекомендации одежды отсутствуют")
             return None
         
-        # Загружаем оригинальное фото и получаем URL
-        print("📤 Загрузка оригинального изображения...")
-        image_url = upload_image_temp(original_image_data)
+        # Загружаем оригинальное фото и получаем URL (если не загружено заранее)
+        if not image_url:
+            logger.info("📤 Загрузка оригинального изображения...")
+            image_url = await upload_image_temp(original_image)
         
         if not image_url:
-            print("❌ Не удалось загрузить изображение")
+            logger.error("❌ Не удалось загрузить изображение")
             return None
         
         # Генерируем через NanoBanana используя конкретные рекомендации!
-        return generate_outfit_image_nanobanana(image_url, recommendations, style)
+        return await generate_outfit_image_nanobanana(image_url, recommendations, style)
         
     except Exception as e:
-        print(f"❌ Ошибка генерации: {str(e)}")
+        logger.error("❌ Ошибка генерации: %s", e)
         return None
 
 
-def search_products(search_query: str) -> list:
+def marketplace_links(search_query: str) -> list:
     """
-    Поиск товаров по запросу (заглушка для демонстрации)
-    В реальном проекте здесь будет интеграция с API магазинов
+    Ссылки на поиск маркетплейсов по запросу (когда в каталоге ничего не нашлось)
     """
     from urllib.parse import quote
     
@@ -543,11 +844,480 @@ def search_products(search_query: str) -> list:
     ]
 
 
+def product_link(product: dict) -> dict:
+    """
+    Товар каталога -> ссылка для фронтенда (name и url, как у ссылок на поиск, плюс карточка товара)
+    """
+    return {
+        "name": product.get("shop") or product["title"],
+        "url": product["url"],
+        "title": product["title"],
+        "price": product.get("price"),
+        "currency": product.get("currency"),
+        "image": product.get("image"),
+    }
+
+
+def search_products_many(search_queries: List[str], semantic_matches: Optional[List[list]] = None) -> List[list]:
+    """
+    Ссылки на товары для всех рекомендаций одним поиском по локальному каталогу
+
+    semantic_matches - товары, близкие по смыслу к каждой рекомендации (векторный индекс),
+    объединяются с найденными по словам. Для запросов без совпадений (и без каталога) -
+    ссылки на поиск маркетплейсов.
+    """
+    found: List[list] = [[] for _ in search_queries]
+    if catalog:
+        try:
+            found = catalog.search_many(search_queries)
+        except Exception as e:
+            logger.error("❌ Ошибка поиска по каталогу: %s", e)
+        if semantic_matches:
+            found = [
+                fuse_rankings((products, similar), catalog.top_k)
+                for products, similar in zip(found, semantic_matches)
+            ]
+    return [
+        [product_link(product) for product in products] or marketplace_links(search_query)
+        for search_query, products in zip(search_queries, found)
+    ]
+
+
+async def find_semantic_matches(recommendations: list) -> Optional[List[list]]:
+    """
+    Товары каталога, ближайшие по смыслу к item + description каждой рекомендации
+
+    Все рекомендации - один запрос к OpenAI embeddings и одно умножение матриц;
+    при ошибке возвращает None (остается поиск по словам).
+    """
+    if not vector_index or not recommendations:
+        return None
+    try:
+        with stage_timer("semantic_match"):
+            vectors = await openai_limiter.call(
+                embed_texts,
+                client,
+                [recommendation_text(recommendation) for recommendation in recommendations],
+                vector_index.model,
+                vector_index.dimensions,
+            )
+            # Берем с запасом: после объединения с поиском по словам останется top_k
+            hits = await asyncio.to_thread(vector_index.search_many, vectors, catalog.top_k * 2)
+            products = await asyncio.to_thread(
+                catalog.get_products, {product_id for found in hits for product_id, _ in found}
+            )
+    except Exception as e:
+        logger.warning("⚠️ Семантический подбор товаров недоступен: %s", e)
+        return None
+    return [
+        [{**products[product_id], "similarity": round(score, 3)} for product_id, score in found if product_id in products]
+        for found in hits
+    ]
+
+
+def search_products(search_query: str) -> list:
+    """
+    Поиск товаров по запросу: каталог, иначе поиск маркетплейсов
+    """
+    return search_products_many([search_query])[0]
+
+
+async def read_photo(photo: UploadFile) -> PreparedImage:
+    """
+    Читает загруженное фото, проверяет тип/размер и один раз готовит его для всех стадий
+    """
+    # Проверяем, что файл - изображение
+    if not photo.content_type or not photo.content_type.startswith("image/"):
+        logger.error("❌ Неверный тип файла: %s", photo.content_type)
+        raise HTTPException(status_code=400, detail="Файл должен быть изображением")
+    
+    # Проверяем размер (макс 10MB) - файл уже во временном файле, в память не читаем
+    size = upload_size(photo)
+    logger.info("✅ Получено %s байт", size)
+    if size > MAX_UPLOAD_BYTES:
+        logger.error("❌ Файл слишком большой: %s байт", size)
+        raise HTTPException(status_code=400, detail=f"Файл слишком большой (макс {MAX_UPLOAD_BYTES // (1024 * 1024)}MB)")
+    
+    # Проверяем заголовок и декодируем изображение прямо из временного файла
+    try:
+        logger.info("🖼️ Валидация изображения...")
+        await photo.seek(0)
+        image = await run_in_image_executor(prepare_image, photo.file)
+        for stage, seconds in image.timings.items():
+            observe_stage(stage, seconds)
+        logger.info("✅ Изображение: %s, формат: %s -> %sx%s, %s байт", image.source_size, image.source_format, image.width, image.height, len(image.jpeg))
+        return image
+    except ImageRejected as e:
+        logger.error("❌ Изображение отклонено: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error("❌ Невалидное изображение: %s", e)
+        raise HTTPException(status_code=400, detail="Невалидное изображение")
+
+
+async def should_prefetch_upload(
+    fingerprint: str,
+    style: str,
+    analysis_key: str,
+    analysis: Optional[dict] = None,
+) -> bool:
+    """
+    Загружать ли фото для NanoBanana заранее, параллельно с анализом GPT-4o
+
+    Не нужно без NanoBanana или если анализ уже известен (передан или в кэше), а изображение
+    для его рекомендаций - в кэше.
+    """
+    if not os.getenv("NANOBANANA_API_KEY"):
+        return False
+    if not result_cache:
+        return True
+    if analysis is None:
+        analysis = await result_cache.get(analysis_key, record_stats=False)
+    if analysis is None:
+        return True
+    image_key = make_image_cache_key(fingerprint, style, analysis.get("recommendations") or [])
+    value = await result_cache.get(image_key, record_stats=False)
+    return value is None or await asyncio.to_thread(image_from_cache, value) is None
+
+
+def observe_upload_wait(stages: StageGraph) -> None:
+    """
+    Сколько генерация изображения ждала загрузку фото после готовности рекомендаций
+    (0 - загрузка полностью спрятана за анализом)
+    """
+    upload, ready = stages.timeline.get("upload"), stages.timeline.get("recommendations")
+    if upload and ready and upload[1] is not None and ready[1] is not None:
+        observe_stage("upload_wait", max(0.0, upload[1] - ready[1]))
+
+
+async def cached_single_flight(key: str, compute, encode=None, decode=None):
+    """
+    Результат из кэша, иначе одно вычисление на все одновременные запросы с этим ключом
+
+    Успешный (не None) результат сохраняется в кэш; ожидающие в других воркерах
+    забирают его оттуда. encode - значение для кэша (None - не кэшировать),
+    decode - результат из значения кэша (в потоке; None - запись устарела).
+    """
+    async def load(record_stats: bool = True):
+        value = await result_cache.get(key, record_stats=record_stats)
+        if value is not None and decode:
+            value = await asyncio.to_thread(decode, value)
+        return value
+    
+    if result_cache:
+        value = await load()
+        if value is not None:
+            logger.info("🗃️ Найдено в кэше: %s", key.split(':')[0])
+            return value
+    
+    async def leader():
+        value = await compute()
+        if value is not None and result_cache:
+            cached = encode(value) if encode else value
+            if cached is not None:
+                await result_cache.set(key, cached)
+        return value
+    
+    lookup = partial(load, record_stats=False) if result_cache else None
+    return await single_flight.do(key, leader, lookup=lookup)
+
+
+async def analyze_styles(image: PreparedImage, styles: list) -> dict:
+    """
+    Анализ фото для нескольких стилей: каждый стиль - из кэша, недостающие - одним запросом
+
+    Результаты раскладываются по отдельным записям кэша (как у одиночного анализа),
+    поэтому следующий запрос с любым из этих стилей тоже попадет в кэш.
+    """
+    fingerprint = image.fingerprint(result_cache.perceptual if result_cache else False)
+    keys = {style: make_cache_key("analysis", fingerprint, style) for style in styles}
+    
+    results = {}
+    if result_cache:
+        for style, key in keys.items():
+            value = await result_cache.get(key)
+            if value is not None:
+                results[style] = value
+    missing = [style for style in styles if style not in results]
+    if not missing:
+        logger.info("🗃️ Найдено в кэше: анализ для %s стилей", len(styles))
+        return results
+    
+    async def compute():
+        if len(missing) == 1:
+            computed = {missing[0]: await analyze_image_and_style(image, missing[0])}
+        else:
+            computed = await analyze_image_multi_style(image, missing)
+        if result_cache:
+            for style, value in computed.items():
+                await result_cache.set(keys[style], value)
+        return computed
+    
+    async def lookup():
+        # Другой воркер уже посчитал - забираем, когда в кэше есть все стили
+        found = {}
+        for style in missing:
+            value = await result_cache.get(keys[style], record_stats=False)
+            if value is None:
+                return None
+            found[style] = value
+        return found
+    
+    flight_key = make_cache_key("analysis-multi", fingerprint, "\n".join(sorted(missing)))
+    results.update(await single_flight.do(flight_key, compute, lookup=lookup if result_cache else None))
+    return results
+
+
+async def analyze_photo_styles(image: PreparedImage, styles: list, generate_image: bool = False) -> dict:
+    """
+    Полный конвейер для нескольких стилей с одним запросом анализа на все стили
+
+    Возвращает {стиль: результат или исключение} - ошибка одного стиля не отменяет остальные.
+    """
+    try:
+        analyses = await analyze_styles(image, styles)
+    except Exception as e:
+        return {style: e for style in styles}
+    outcomes = await asyncio.gather(
+        *(
+            run_analysis_pipeline(image, style, analysis=analyses[style], generate_image=generate_image)
+            for style in styles
+        ),
+        return_exceptions=True,
+    )
+    return dict(zip(styles, outcomes))
+
+
+async def run_analysis_pipeline(
+    image: PreparedImage,
+    style: str,
+    emit=None,
+    generate_image: bool = True,
+    analysis: Optional[dict] = None,
+) -> dict:
+    """
+    Полный конвейер: анализ OpenAI -> ссылки на товары -> генерация изображения
+
+    emit - необязательный async callback(event_type, data), получает события готовности стадий,
+    а пока GPT-4o генерирует ответ - готовые поля (analysis_field) и рекомендации со ссылками
+    на товары (recommendation);
+    generate_image=False пропускает генерацию NanoBanana (например, для пакетной обработки);
+    analysis - уже готовый анализ (из общего запроса на несколько стилей)
+    """
+    with IN_FLIGHT.track(kind="pipeline"), stage_timer("pipeline"):
+        return await _run_analysis_pipeline(image, style, emit, generate_image, analysis)
+
+
+async def _run_analysis_pipeline(
+    image: PreparedImage,
+    style: str,
+    emit=None,
+    generate_image: bool = True,
+    analysis: Optional[dict] = None,
+) -> dict:
+    async def notify(event_type: str, data: dict):
+        if emit:
+            await emit(event_type, data)
+    
+    # Ключ анализа: отпечаток фото + стиль (ключ изображения - еще и по рекомендациям)
+    fingerprint = image.fingerprint(result_cache.perceptual if result_cache else False)
+    analysis_key = make_cache_key("analysis", fingerprint, style)
+    
+    # Поля из потока GPT-4o: генерация изображения стартует, как только готовы рекомендации,
+    # не дожидаясь остальных полей ответа (style_tips и т.д.)
+    streamed_fields: dict = {}
+    streamed_recommendations = asyncio.get_running_loop().create_future()
+    
+    # Частичные результаты: поля и рекомендации приходят до окончания генерации ответа
+    async def on_analysis_event(event: tuple):
+        if event[0] == "item":
+            _, key, index, item = event
+            if isinstance(item, dict):
+                shop_links = await asyncio.to_thread(search_products, item.get("search_query", ""))
+                item = {**item, "shop_links": shop_links}
+            await notify("recommendation", {"index": index, "recommendation": item})
+        elif event[1] not in STREAMED_ARRAYS:
+            streamed_fields[event[1]] = event[2]
+            await notify("analysis_field", {event[1]: event[2]})
+        elif not streamed_recommendations.done():
+            streamed_recommendations.set_result({**streamed_fields, event[1]: event[2]})
+    
+    # Анализируем фото и стиль
+    async def compute_analysis():
+        logger.info("🤖 Запуск анализа OpenAI (стиль: %s)...", style)
+        result = await analyze_image_and_style(image, style, on_event=on_analysis_event if emit else None)
+        logger.info("✅ Анализ OpenAI завершен успешно")
+        return result
+    
+    async def run_analysis():
+        result = analysis if analysis is not None else await cached_single_flight(analysis_key, compute_analysis)
+        await notify("analysis", result)
+        return result
+    
+    async def wait_recommendations() -> dict:
+        # Что раньше: рекомендации из потока или весь ответ (без потока, из кэша)
+        await asyncio.wait({streamed_recommendations, analysis_task}, return_when=asyncio.FIRST_COMPLETED)
+        if streamed_recommendations.done():
+            return streamed_recommendations.result()
+        return analysis_task.result()
+    
+    # Добавляем ссылки на товары для каждой рекомендации
+    async def add_shop_links(analysis_result: dict):
+        logger.info("🔗 Добавление ссылок на товары...")
+        recommendations = analysis_result.get("recommendations", [])
+        # Все запросы одним вызовом (в потоке: каталог может перечитываться после импорта);
+        # рекомендации, отправленные потоком раньше, получили ссылки только по словам запроса
+        semantic_matches = await find_semantic_matches(recommendations)
+        shop_links = await asyncio.to_thread(
+            search_products_many,
+            [recommendation.get("search_query", "") for recommendation in recommendations],
+            semantic_matches,
+        )
+        for recommendation, links in zip(recommendations, shop_links):
+            recommendation["shop_links"] = links
+        logger.info("✅ Добавлено ссылок для %s рекомендаций", len(recommendations))
+        await notify("shop_links", {"recommendations": recommendations})
+    
+    # Генерируем изображение с одеждой используя NanoBanana (сохраняет ваше лицо!)
+    async def generate_image_stage(ready: dict, image_url: Optional[str] = None):
+        if not ready.get("recommendations"):
+            return None
+        logger.info("🎨 ЗАПУСК ГЕНЕРАЦИИ ИЗОБРАЖЕНИЯ С NANOBANANA API")
+        
+        async def compute_image():
+            return await generate_outfit_image(
+                ready.get("person_description", ""),
+                ready["recommendations"],  # Передаем конкретные рекомендации!
+                style,
+                original_image=image,  # Передаем оригинальное фото!
+                image_url=image_url,
+            )
+        
+        image_key = make_image_cache_key(fingerprint, style, ready["recommendations"])
+        return await cached_single_flight(image_key, compute_image, encode=image_cache_value, decode=image_from_cache)
+    
+    # Изображение строилось по рекомендациям из потока; если поток оборвался и повтор запроса
+    # к OpenAI вернул другие рекомендации, изображение для итогового анализа генерируется заново
+    async def match_image_stage(generated: Optional[dict], ready: dict, analysis_result: dict, image_url: Optional[str] = None):
+        outfit = make_image_cache_key(fingerprint, style, ready.get("recommendations") or [])
+        if outfit == make_image_cache_key(fingerprint, style, analysis_result.get("recommendations") or []):
+            return generated
+        logger.warning("⚠️ Итоговые рекомендации отличаются от рекомендаций из потока - изображение генерируется заново")
+        return await generate_image_stage(analysis_result, image_url)
+    
+    # Стадии: анализ GPT-4o и загрузка фото для NanoBanana идут параллельно, генерация
+    # изображения - как только есть рекомендации и ссылка на фото, ссылки на товары - после анализа
+    async with StageGraph() as stages:
+        analysis_task = stages.add("analysis", run_analysis)
+        stages.add("recommendations", wait_recommendations)
+        stages.add("shop_links", add_shop_links, "analysis")
+        if generate_image:
+            image_deps = ["recommendations"]
+            # Загрузка фото не нужна, если изображение уже в кэше или NanoBanana не настроен
+            if await should_prefetch_upload(fingerprint, style, analysis_key, analysis):
+                stages.add("upload", partial(upload_image_temp, image), speculative=True)
+                image_deps.append("upload")
+            stages.add("image", generate_image_stage, *image_deps)
+            stages.add("image_match", match_image_stage, "image", "recommendations", "analysis", *image_deps[1:])
+        analysis_result = await stages.result("analysis")
+        await stages.result("shop_links")
+        generated_image = await stages.result("image_match") if generate_image else None
+    observe_upload_wait(stages)
+    logger.info("⏱️ Стадии: %s", stages.summary())
+    
+    generated_image_url = generated_image["url"] if generated_image else None
+    if generated_image_url:
+        analysis_result["generated_image"] = generated_image_url
+        # srcset по форматам и размытый плейсхолдер (в кэше прежних версий их нет)
+        generated_image_variants = generated_image.get("variants")
+        if generated_image_variants:
+            analysis_result["generated_image_variants"] = generated_image_variants
+        logger.info("✅ УСПЕХ! Изображение добавлено в результаты: %s", generated_image_url)
+    elif generate_image and analysis_result.get("recommendations"):
+        logger.warning(
+            "⚠️ Изображение не было получено (таймаут, ошибка обработки или недостаточно кредитов), "
+            "анализ одежды продолжается без изображения"
+        )
+    await notify("image", {
+        "generated_image": generated_image_url,
+        "generated_image_variants": analysis_result.get("generated_image_variants"),
+    })
+    
+    if history_store:
+        analysis_id = uuid.uuid4().hex
+        try:
+            await history_store.record({
+                "id": analysis_id,
+                "client_id": current_client_id(),
+                "style": style,
+                # Ссылки на изображение - без срока действия, подписываются заново при чтении
+                "result": map_result_image_urls(analysis_result, storage.to_ref),
+                "photo_sha256": image.sha256,
+                "trace_id": current_trace_id(),
+                "nanobanana_task_id": generated_image.get("task_id") if generated_image else None,
+            })
+            # Копия: analysis_result может быть общим объектом из кэша
+            analysis_result = {**analysis_result, "analysis_id": analysis_id}
+        except Exception as e:
+            logger.warning("⚠️ Не удалось сохранить анализ в историю: %s", e)
+    
+    return analysis_result
+
+
 @app.get("/")
 async def root():
     return {"message": "Odezda AI API работает!"}
 
 
+@app.get("/api/images/{name}")
+async def result_image(
+    name: str,
+    request: Request,
+    expires: Optional[str] = None,
+    sig: Optional[str] = None,
+):
+    """
+    Вариант сгенерированного изображения в лучшем формате, который принимает браузер (Accept)
+
+    name - <sha256>-<ширина>; файлы не меняются, поэтому строгий ETag и бессрочное кэширование.
+    """
+    if storage.name != "local" or not re.fullmatch(r"[0-9a-f]{64}-\d+", name):
+        raise HTTPException(status_code=404, detail="Изображение не найдено")
+    if not storage.verify(f"images/{name}", expires, sig):
+        raise HTTPException(status_code=403, detail="Ссылка недействительна или устарела")
+
+    available = {
+        content_type: path
+        for content_type in available_formats()
+        if os.path.isfile(path := os.path.join(storage.root, storage.variant_path(name, content_type)))
+    }
+    if not available:
+        raise HTTPException(status_code=404, detail="Изображение не найдено")
+    content_type = negotiate(request.headers.get("accept"), available)
+    return immutable_file_response(
+        available[content_type], request.scope, media_type=content_type, headers={"Vary": "Accept"},
+    )
+
+
+@app.get("/api/upload-config")
+async def upload_config():
+    """
+    Параметры подготовки фото в браузере: до какой стороны уменьшать и в чем кодировать
+
+    Больше MAX_SIDE сервер все равно не использует - фото крупнее только дольше загружается.
+    """
+    return JSONResponse(
+        {
+            "max_side": MAX_SIDE,
+            "format": CLIENT_FORMAT,
+            "quality": CLIENT_QUALITY,
+            "max_upload_bytes": MAX_UPLOAD_BYTES,
+            "accepted_types": ACCEPTED_MIME_TYPES,
+        },
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
+
+
 @app.post("/api/analyze")
 async def analyze_photo(
     photo: UploadFile = File(...),
@@ -557,81 +1327,10 @@ async def analyze_photo(
     Анализирует фото и подбирает одежду в указанном стиле
     """
     try:
-        logger.info(f"📥 Получен запрос /api/analyze: файл={photo.filename}, стиль={style}")
-        
-        # Проверяем, что файл - изображение
-        if not photo.content_type.startswith("image/"):
-            logger.error(f"❌ Неверный тип файла: {photo.content_type}")
-            raise HTTPException(status_code=400, detail="Файл должен быть изображением")
-        
-        # Читаем файл
-        logger.info("📖 Чтение файла...")
-        image_data = await photo.read()
-        logger.info(f"✅ Прочитано {len(image_data)} байт")
-        
-        # Проверяем размер (макс 10MB)
-        if len(image_data) > 10 * 1024 * 1024:
-            logger.error(f"❌ Файл слишком большой: {len(image_data)} байт")
-            raise HTTPException(status_code=400, detail="Файл слишком большой (макс 10MB)")
-        
-        # Проверяем, что это валидное изображение
-        try:
-            logger.info("🖼️ Валидация изображения...")
-            img = Image.open(io.BytesIO(image_data))
-            logger.info(f"✅ Изображение: {img.size}, формат: {img.format}")
-            # Оптимизируем размер если нужно
-            if img.width > 1024 or img.height > 1024:
-                logger.info("📐 Оптимизация размера...")
-                img.thumbnail((1024, 1024))
-                buffer = io.BytesIO()
-                img.save(buffer, format=img.format or "JPEG")
-                image_data = buffer.getvalue()
-                logger.info(f"✅ Оптимизировано до {len(image_data)} байт")
-        except Exception as e:
-            logger.error(f"❌ Невалидное изображение: {str(e)}")
-            raise HTTPException(status_code=400, detail="Невалидное изображение")
-        
-        # Анализируем фото и стиль
-        logger.info(f"🤖 Запуск анализа OpenAI (стиль: {style})...")
-        analysis_result = analyze_image_and_style(image_data, style)
-        logger.info("✅ Анализ OpenAI завершен успешно")
+        logger.info("📥 Получен запрос /api/analyze: файл=%s, стиль=%s", photo.filename, style)
         
-        # Добавляем ссылки на товары для каждой рекомендации
-        logger.info("🔗 Добавление ссылок на товары...")
-        for recommendation in analysis_result.get("recommendations", []):
-            search_query = recommendation.get("search_query", "")
-            recommendation["shop_links"] = search_products(search_query)
-        logger.info(f"✅ Добавлено ссылок для {len(analysis_result.get('recommendations', []))} рекомендаций")
-        
-        # Генерируем изображение с одеждой используя NanoBanana (сохраняет ваше лицо!)
-        generated_image_url = None
-        if "recommendations" in analysis_result and analysis_result["recommendations"]:
-            logger.info("\n" + "="*80)
-            logger.info("🎨 ЗАПУСК ГЕНЕРАЦИИ ИЗОБРАЖЕНИЯ С NANOBANANA API")
-            logger.info("="*80)
-            
-            generated_image_url = generate_outfit_image(
-                analysis_result.get("person_description", ""),
-                analysis_result["recommendations"],  # Передаем конкретные рекомендации!
-                style,
-                original_image_data=image_data  # Передаем оригинальное фото!
-            )
-            
-            if generated_image_url:
-                analysis_result["generated_image"] = generated_image_url
-                logger.info("\n" + "="*80)
-                logger.info("✅ УСПЕХ! Изображение добавлено в результаты")
-                logger.info(f"🔗 URL: {generated_image_url}")
-                logger.info("="*80 + "\n")
-            else:
-                logger.warning("\n" + "="*80)
-                logger.warning("⚠️ ПРЕДУПРЕЖДЕНИЕ: Изображение не было получено")
-                logger.warning("💡 Возможные причины:")
-                logger.warning("   - Превышено время ожидания (проверьте вручную на сайте)")
-                logger.warning("   - Ошибка при обработке")
-                logger.warning("   - Недостаточно кредитов")
-                logger.warning("📊 Анализ одежды продолжается без изображения...")
-                logger.warning("="*80 + "\n")
+        image = await read_photo(photo)
+        analysis_result = await run_analysis_pipeline(image, style)
         
         logger.info("✅ Запрос обработан успешно!")
         return JSONResponse(content={
@@ -640,18 +1339,412 @@ async def analyze_photo(
         })
         
     except HTTPException as he:
-        logger.error(f"❌ HTTP Exception: {he.status_code} - {he.detail}")
+        logger.error("❌ HTTP Exception: %s - %s", he.status_code, he.detail)
         raise he
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error("=" * 80)
-        logger.error("❌ КРИТИЧЕСКАЯ ОШИБКА В /api/analyze")
-        logger.error("=" * 80)
-        logger.error(error_details)
-        logger.error("=" * 80)
+        logger.exception("❌ КРИТИЧЕСКАЯ ОШИБКА В /api/analyze")
         raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
 
 
+@app.post("/api/analyze/stream")
+async def analyze_photo_stream(
+    photo: UploadFile = File(...),
+    style: str = Form(...)
+):
+    """
+    То же, что /api/analyze, но результат приходит частями (NDJSON) по мере готовности
+
+    Каждая строка - {"event": тип, "data": ...}: analysis_field и recommendation (пока
+    генерируется ответ GPT-4o), analysis, shop_links, image и последняя - done (полный
+    результат) или error.
+    """
+    logger.info("📥 Получен запрос /api/analyze/stream: файл=%s, стиль=%s", photo.filename, style)
+    # Фото готовим до начала ответа: ошибки валидации возвращаются обычным HTTP-статусом
+    image = await read_photo(photo)
+    
+    events: asyncio.Queue = asyncio.Queue()
+    
+    async def emit(event_type: str, data: dict):
+        await events.put({"event": event_type, "data": data})
+    
+    async def produce():
+        try:
+            result = await run_analysis_pipeline(image, style, emit=emit)
+            await emit("done", result)
+        except Exception as e:
+            error = e.detail if isinstance(e, HTTPException) else f"Ошибка сервера: {str(e)}"
+            logger.error("❌ Ошибка потокового анализа: %s", error)
+            await emit("error", {"error": error})
+        finally:
+            await events.put(None)
+    
+    task = asyncio.create_task(produce())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    
+    async def event_stream():
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        finally:
+            # Клиент отключился - генерацию не продолжаем
+            task.cancel()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/api/analyze/styles")
+async def analyze_photo_multi_style(
+    photo: UploadFile = File(...),
+    styles: str = Form(...),
+    generate_image: bool = Form(False),
+):
+    """
+    Подбор одежды сразу в нескольких стилях одним запросом к GPT-4o
+    """
+    style_list = parse_styles(styles)
+    if not style_list:
+        raise HTTPException(status_code=400, detail="Не указаны стили")
+    if len(style_list) > BATCH_MAX_STYLES:
+        raise HTTPException(status_code=400, detail=f"Слишком много стилей (макс {BATCH_MAX_STYLES})")
+    logger.info("📥 Получен запрос /api/analyze/styles: файл=%s, стили=%s", photo.filename, style_list)
+    
+    image = await read_photo(photo)
+    outcomes = await analyze_photo_styles(image, style_list, generate_image=generate_image)
+    for outcome in outcomes.values():
+        if isinstance(outcome, HTTPException):
+            raise outcome
+        if isinstance(outcome, Exception):
+            logger.error("❌ Ошибка мультистилевого анализа: %s", outcome)
+            raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(outcome)}")
+    
+    return JSONResponse(content={
+        "success": True,
+        "data": {"styles": outcomes}
+    })
+
+
+@app.post("/api/analyze/batch")
+async def analyze_batch(
+    photos: List[UploadFile] = File(...),
+    styles: str = Form(...),
+    generate_image: bool = Form(False),
+):
+    """
+    Пакетный анализ: каждое фото в каждом стиле, результаты в NDJSON по мере готовности
+
+    Каждое фото декодируется один раз, все его стили анализируются одним запросом;
+    последняя строка - {"summary": ...}
+    """
+    style_list = parse_styles(styles)
+    if not style_list:
+        raise HTTPException(status_code=400, detail="Не указаны стили")
+    if len(style_list) > BATCH_MAX_STYLES:
+        raise HTTPException(status_code=400, detail=f"Слишком много стилей (макс {BATCH_MAX_STYLES})")
+    if len(photos) > BATCH_MAX_PHOTOS:
+        raise HTTPException(status_code=400, detail=f"Слишком много фото (макс {BATCH_MAX_PHOTOS})")
+    logger.info("📥 Получен запрос /api/analyze/batch: фото=%s, стили=%s", len(photos), style_list)
+    
+    # Загрузки закрываются вместе с запросом (в новых версиях FastAPI - до отправки потока),
+    # поэтому их временные файлы забираем себе и декодируем фото лениво в load_image: в памяти
+    # не больше BATCH_CONCURRENCY декодированных фото. Невалидное фото не прерывает пакет -
+    # его пары получают запись с ошибкой.
+    uploads: dict = {}
+    entries = []
+    for index, photo in enumerate(photos):
+        uploads[index] = UploadFile(photo.file, size=photo.size, filename=photo.filename, headers=photo.headers)
+        photo.file = io.BytesIO()
+        entries.append({"image": photo.filename or f"photo-{index}", "index": index, "styles": style_list})
+    
+    async def load_image(entry: dict) -> PreparedImage:
+        upload = uploads.pop(entry["index"])
+        try:
+            return await read_photo(upload)
+        finally:
+            await upload.close()
+    
+    async def analyze(image: PreparedImage, styles: list) -> dict:
+        return await analyze_photo_styles(image, styles, generate_image=generate_image)
+    
+    results: asyncio.Queue = asyncio.Queue()
+    
+    async def produce():
+        try:
+            summary = await run_batch(entries, load_image, analyze, results.put, concurrency=BATCH_CONCURRENCY)
+            await results.put({"summary": summary})
+        finally:
+            # Фото, до которых не дошла очередь (клиент отключился)
+            for upload in uploads.values():
+                await upload.close()
+            await results.put(None)
+    
+    task = asyncio.create_task(produce())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    
+    async def result_stream():
+        try:
+            while True:
+                record = await results.get()
+                if record is None:
+                    break
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+        finally:
+            # Клиент отключился - остальные пары не считаем
+            task.cancel()
+    
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+
+async def run_job(job_id: str, image: PreparedImage, style: str):
+    """
+    Выполняет конвейер в фоне, сохраняя промежуточные результаты и события задачи
+    """
+    partial_result: dict = {}
+    
+    async def emit(event_type: str, data: dict):
+        if event_type == "recommendation":
+            # Рекомендации по одной, пока идет генерация ответа; событие analysis заменит весь список
+            items = partial_result.setdefault("recommendations", [])
+            items[data["index"]:data["index"] + 1] = [data["recommendation"]]
+        else:
+            partial_result.update(data)
+        await job_store.update(job_id, result=partial_result)
+        await job_store.add_event(job_id, event_type, data)
+    
+    # Отметка, что задача выполняется: без нее задачу упавшего воркера сочтут брошенной
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(job_store.heartbeat_interval)
+            try:
+                await job_store.update(job_id)
+            except sqlite3.Error as e:
+                logger.warning("⚠️ Не удалось обновить задачу %s: %s", job_id, e)
+    
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        await job_store.update(job_id, status=JOB_RUNNING)
+        with IN_FLIGHT.track(kind="job"):
+            result = await run_analysis_pipeline(image, style, emit=emit)
+        await job_store.update(job_id, status=JOB_DONE, result=result)
+        await job_store.add_event(job_id, "done", {"status": JOB_DONE})
+        logger.info("✅ Задача %s завершена", job_id)
+    except asyncio.CancelledError:
+        await job_store.update(job_id, status=JOB_FAILED, error="Задача отменена")
+        raise
+    except Exception as e:
+        error = e.detail if isinstance(e, HTTPException) else f"Ошибка сервера: {str(e)}"
+        logger.error("❌ Задача %s завершилась с ошибкой: %s", job_id, error)
+        logger.error(traceback.format_exc())
+        await job_store.update(job_id, status=JOB_FAILED, error=error)
+        await job_store.add_event(job_id, "error", {"status": JOB_FAILED, "error": error})
+    finally:
+        heartbeat_task.cancel()
+
+
+async def fail_abandoned_job(job: dict) -> dict:
+    """
+    Задачу, которую никто не выполняет (воркер упал или перезапущен), помечает ошибкой,
+    чтобы клиент не ждал ее вечно
+    """
+    if not job_store.is_abandoned(job):
+        return job
+    error = "Задача прервана перезапуском сервера, отправьте фото еще раз"
+    logger.warning("⚠️ Задача %s брошена воркером - помечена как ошибка", job["id"])
+    await job_store.update(job["id"], status=JOB_FAILED, error=error)
+    await job_store.add_event(job["id"], "error", {"status": JOB_FAILED, "error": error})
+    return {**job, "status": JOB_FAILED, "error": error}
+
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(
+    photo: UploadFile = File(...),
+    style: str = Form(...)
+):
+    """
+    Ставит анализ фото в очередь и сразу возвращает id задачи
+    """
+    logger.info("📥 Получен запрос /api/jobs: файл=%s, стиль=%s", photo.filename, style)
+    image = await read_photo(photo)
+    
+    job = await job_store.create(new_job(style))
+    task = asyncio.create_task(run_job(job["id"], image, style))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    
+    logger.info("🆔 Задача создана: %s", job['id'])
+    return {
+        "success": True,
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/api/jobs/{job['id']}",
+        "events_url": f"/api/jobs/{job['id']}/events",
+    }
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Текущее состояние задачи и уже готовые части результата
+    """
+    job = await job_store.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return {"success": True, "job": await fail_abandoned_job(job)}
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(
+    job_id: str,
+    request: Request,
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    Поток событий задачи (Server-Sent Events): analysis_field, recommendation, analysis,
+    shop_links, image, done/error
+    """
+    job = await job_store.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    
+    try:
+        after = int(last_event_id or 0)
+    except ValueError:
+        after = 0
+    
+    async def event_stream():
+        nonlocal after
+        while not await request.is_disconnected():
+            events = await job_store.next_events(job_id, after)
+            for event in events:
+                after = event["id"]
+                yield format_sse(event)
+                if event["type"] in ("done", "error"):
+                    return
+            if not events:
+                current = await job_store.get(job_id)
+                if current and job_store.is_abandoned(current):
+                    # Событие error придет следующим чтением
+                    await fail_abandoned_job(current)
+                    continue
+                if not current or current["status"] in FINISHED_STATUSES:
+                    return
+                # Комментарий-пинг, чтобы прокси не закрывали соединение
+                yield ": keep-alive\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/history")
+async def get_history(
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    task_id: Optional[str] = None,
+    x_client_id: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    Анализы клиента (X-Client-Id), новые сначала; next_cursor - курсор следующей страницы
+
+    С X-Admin-Token = HISTORY_ADMIN_TOKEN (поддержка) - анализы всех клиентов;
+    task_id - поиск по id задачи NanoBanana.
+    """
+    if not history_store:
+        raise HTTPException(status_code=404, detail="История анализов отключена")
+    expected_token = os.getenv("HISTORY_ADMIN_TOKEN")
+    admin = bool(expected_token) and x_admin_token == expected_token
+    client_id = valid_client_id(x_client_id)
+    if not client_id and not admin:
+        raise HTTPException(status_code=400, detail="Нужен заголовок X-Client-Id")
+    try:
+        page = await history_store.list(client_id, limit=limit, cursor=cursor, task_id=task_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный cursor")
+    
+    def resolve_images():
+        for item in page["items"]:
+            if item["generated_image"]:
+                item["generated_image"] = storage.from_ref(item["generated_image"])
+    
+    await asyncio.to_thread(resolve_images)
+    return page
+
+
+@app.get("/api/analyses/{analysis_id}")
+async def get_analysis(analysis_id: str):
+    """
+    Сохраненный результат анализа (как data в /api/analyze) без повторных запросов к провайдерам
+    """
+    entry = await history_store.get(analysis_id) if history_store else None
+    if not entry:
+        raise HTTPException(status_code=404, detail="Анализ не найден")
+    result = await asyncio.to_thread(map_result_image_urls, entry["result"], storage.from_ref)
+    return {
+        "success": True,
+        "data": {**result, "analysis_id": entry["id"]},
+        "style": entry["style"],
+        "created_at": entry["created_at"],
+        # Для поддержки: задача в панели NanoBanana и trace id в логах
+        "nanobanana_task_id": entry["nanobanana_task_id"],
+        "trace_id": entry["trace_id"],
+    }
+
+
+@app.post("/api/callbacks/nanobanana")
+async def nanobanana_callback(request: Request, token: Optional[str] = None):
+    """
+    Вебхук NanoBanana: завершает ожидающую задачу по taskId
+
+    Токен обязателен (NANOBANANA_CALLBACK_TOKEN или выведенный из ключа API), а URL
+    результата принимается только с хостов NANOBANANA_RESULT_HOSTS - иначе задачу
+    завершит опросчик по данным API.
+    """
+    expected_token = nanobanana_callback_token()
+    if not expected_token or not hmac.compare_digest(token or "", expected_token):
+        raise HTTPException(status_code=403, detail="Неверный токен")
+    
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Ожидается JSON")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Ожидается JSON-объект")
+    
+    task_data = payload.get("data") or {}
+    if not isinstance(task_data, dict):
+        raise HTTPException(status_code=400, detail="Поле data должно быть объектом")
+    task_id = task_data.get("taskId")
+    if not task_id or not isinstance(task_id, str):
+        raise HTTPException(status_code=400, detail="Не указан taskId")
+    
+    outcome = parse_task_outcome(task_data)
+    if outcome and outcome["url"] and not is_allowed_result_url(outcome["url"], NANOBANANA_RESULT_HOSTS):
+        logger.warning("⚠️ Вебхук NanoBanana: URL результата с чужого хоста отклонен (задача %s)", task_id)
+        raise HTTPException(status_code=400, detail="URL результата не от NanoBanana")
+    if outcome is None and payload.get("code") not in (None, 200):
+        outcome = {"success": False, "url": None, "error": payload.get("msg", "Unknown error")}
+    if outcome is None:
+        return {"success": True, "status": "pending"}
+    
+    matched = nanobanana_tasks.complete(task_id, outcome)
+    if not matched and nanobanana_tasks.mailbox:
+        # Задачу может ждать другой воркер - он заберет итог из общего ящика
+        await asyncio.to_thread(nanobanana_tasks.mailbox.put, task_id, outcome)
+    logger.info("📬 Вебхук NanoBanana: задача %s, ожидалась=%s", task_id, matched)
+    return {"success": True, "matched": matched}
+
+
 @app.get("/api/health")
 async def health_check():
     """Проверка работоспособности API"""
@@ -661,6 +1754,35 @@ async def health_check():
     }
 
 
+def collect_runtime_metrics():
+    """
+    Переносит текущее состояние лимитеров, NanoBanana и uploads в gauge метрик
+    (счетчики кэша и уборщика увеличиваются сразу в cache.py и janitor.py)
+    """
+    for limiter in (openai_limiter, imgur_limiter, nanobanana_limiter):
+        QUEUE_DEPTH.set(limiter.queued, provider=limiter.name)
+    IN_FLIGHT.set(nanobanana_tasks.pending_count, kind="nanobanana_task")
+    if uploads_janitor:
+        for measure in ("current_files", "current_bytes"):
+            UPLOADS_USAGE.set(uploads_janitor.stats[measure], measure=measure)
+
+
+REGISTRY.add_collector(collect_runtime_metrics)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus: длительность стадий, ошибки провайдеров, очереди"""
+    if shared_metrics:
+        # Сумма по всем воркерам, а не только по принявшему запрос
+        try:
+            snapshots = await asyncio.to_thread(shared_metrics.exchange, REGISTRY.snapshot())
+            return PlainTextResponse(REGISTRY.render(snapshots), media_type="text/plain; version=0.0.4")
+        except sqlite3.Error as e:
+            logger.warning("⚠️ Метрики других воркеров недоступны: %s", e)
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/debug/env")
 async def debug_env():
     """🔍 Диагностика: Проверка переменных окружения"""
@@ -668,7 +1790,8 @@ async def debug_env():
         "OPENAI_API_KEY": "✅ Установлен" if os.getenv("OPENAI_API_KEY") else "❌ НЕ УСТАНОВЛЕН",
         "OPENAI_KEY_PREFIX": os.getenv("OPENAI_API_KEY", "")[:20] + "..." if os.getenv("OPENAI_API_KEY") else "N/A",
         "NANOBANANA_API_KEY": "✅ Установлен" if os.getenv("NANOBANANA_API_KEY") else "❌ НЕ УСТАНОВЛЕН",
-        "IMGUR_CLIENT_ID": "✅ Установлен" if os.getenv("IMGUR_CLIENT_ID") else "⚠️ Используется публичный",
+        "IMGUR_CLIENT_ID": "✅ Установлен" if os.getenv("IMGUR_CLIENT_ID") else "❌ НЕ УСТАНОВЛЕН (нужен для STORAGE_BACKEND=imgur)",
+        "STORAGE_BACKEND": storage.name,
         "ALLOWED_ORIGINS": os.getenv("ALLOWED_ORIGINS", "не установлен"),
         "HOST": os.getenv("HOST", "0.0.0.0"),
         "PORT": os.getenv("PORT", "8000"),
@@ -687,11 +1810,8 @@ async def debug_openai():
                 "solution": "Добавьте OPENAI_API_KEY в Railway Variables"
             }
         
-        # Пробуем создать клиента
-        test_client = OpenAI(api_key=api_key)
-        
-        # Пробуем простой запрос
-        response = test_client.chat.completions.create(
+        # Простой запрос через общий клиент (тот же пул соединений, что у анализа)
+        response = await client.chat.completions.create(
             model="gpt-4o",
             messages=[{"role": "user", "content": "Say 'OK'"}],
             max_tokens=5
@@ -707,7 +1827,7 @@ async def debug_openai():
         
     except Exception as e:
         error_details = traceback.format_exc()
-        logger.error(f"❌ OpenAI API Error: {error_details}")
+        logger.error("❌ OpenAI API Error: %s", error_details)
         return {
             "status": "error",
             "message": f"❌ Ошибка OpenAI API: {str(e)}",
@@ -717,6 +1837,56 @@ async def debug_openai():
         }
 
 
+@app.get("/api/debug/cache")
+async def debug_cache():
+    """🔍 Диагностика: статистика кэша результатов и объединения запросов"""
+    if not result_cache:
+        return {"enabled": False, "single_flight": single_flight.stats}
+    return {"enabled": True, **result_cache.get_stats(), "single_flight": single_flight.stats}
+
+
+@app.get("/api/debug/limits")
+async def debug_limits():
+    """🔍 Диагностика: очереди и счетчики лимитов провайдеров"""
+    return {
+        limiter.name: limiter.get_stats()
+        for limiter in (openai_limiter, imgur_limiter, nanobanana_limiter)
+    }
+
+
+@app.get("/api/debug/storage")
+async def debug_storage():
+    """🔍 Диагностика: хранилище изображений и очистка uploads"""
+    return {
+        "backend": storage.name,
+        "janitor": uploads_janitor.stats if uploads_janitor else None,
+        "history": await history_store.get_stats() if history_store else None,
+    }
+
+
+@app.get("/api/debug/http")
+async def debug_http():
+    """🔍 Диагностика: пулы соединений к провайдерам и число новых соединений"""
+    return http_clients.get_stats()
+
+
+@app.get("/api/debug/catalog")
+async def debug_catalog(q: Optional[str] = None):
+    """🔍 Диагностика: каталог товаров и проверка поиска (?q=черное пальто женское)"""
+    if not catalog:
+        return {"enabled": False}
+    result = {
+        "enabled": True,
+        **catalog.get_stats(),
+        "vector_index": vector_index.get_stats() if vector_index else None,
+    }
+    if q:
+        started = time.perf_counter()
+        result["results"] = await asyncio.to_thread(catalog.search, q)
+        result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    return result
+
+
 @app.post("/api/debug/test-analyze")
 async def debug_test_analyze(
     photo: UploadFile = File(...),
@@ -729,47 +1899,24 @@ async def debug_test_analyze(
         logger.info("=" * 80)
         
         # Шаг 1: Проверка файла
-        logger.info(f"📄 Получен файл: {photo.filename}")
-        logger.info(f"📄 Content-Type: {photo.content_type}")
+        logger.info("📄 Получен файл: %s", photo.filename)
+        logger.info("📄 Content-Type: %s", photo.content_type)
         
-        if not photo.content_type.startswith("image/"):
-            raise HTTPException(status_code=400, detail="Файл должен быть изображением")
-        
-        # Шаг 2: Чтение файла
-        logger.info("📥 Чтение данных изображения...")
-        image_data = await photo.read()
-        logger.info(f"✅ Прочитано {len(image_data)} байт")
-        
-        # Шаг 3: Проверка размера
-        if len(image_data) > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="Файл слишком большой (макс 10MB)")
-        
-        # Шаг 4: Валидация изображения
-        logger.info("🖼️ Валидация изображения...")
-        try:
-            img = Image.open(io.BytesIO(image_data))
-            logger.info(f"✅ Изображение валидно: {img.size}, формат: {img.format}")
-            
-            if img.width > 1024 or img.height > 1024:
-                logger.info("📐 Оптимизация размера...")
-                img.thumbnail((1024, 1024))
-                buffer = io.BytesIO()
-                img.save(buffer, format=img.format or "JPEG")
-                image_data = buffer.getvalue()
-                logger.info(f"✅ Оптимизировано до {len(image_data)} байт")
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Невалидное изображение: {str(e)}")
+        # Шаги 2-4: Размер, заголовок и декодирование (без чтения файла в память)
+        logger.info("📥 Проверка и подготовка изображения...")
+        image = await read_photo(photo)
+        logger.info("✅ Изображение валидно: %s, формат: %s", image.source_size, image.source_format)
         
         # Шаг 5: Проверка OpenAI
         logger.info("🤖 Проверка OpenAI API...")
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise HTTPException(status_code=500, detail="OPENAI_API_KEY не установлен!")
-        logger.info(f"✅ API ключ найден: {api_key[:20]}...")
+        logger.info("✅ API ключ найден: %s...", api_key[:20])
         
         # Шаг 6: Анализ
-        logger.info(f"🎨 Запуск анализа в стиле: {style}")
-        analysis_result = analyze_image_and_style(image_data, style)
+        logger.info("🎨 Запуск анализа в стиле: %s", style)
+        analysis_result = await analyze_image_and_style(image, style)
         logger.info("✅ Анализ завершен успешно!")
         
         logger.info("=" * 80)
@@ -783,7 +1930,7 @@ async def debug_test_analyze(
         }
         
     except HTTPException as he:
-        logger.error(f"❌ HTTP Exception: {he.detail}")
+        logger.error("❌ HTTP Exception: %s", he.detail)
         raise he
     except Exception as e:
         error_details = traceback.format_exc()
@@ -805,6 +1952,7 @@ async def debug_test_analyze(
 
 
 if __name__ == "__main__":
+    # Один процесс - для разработки; в продакшене - python serve.py (несколько воркеров)
     import uvicorn
     port = int(os.getenv("PORT", 8000))
     host = os.getenv("HOST", "0.0.0.0")
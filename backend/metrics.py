@@ -0,0 +1,418 @@
+import os
+import json
+import asyncio
+import time
+import uuid
+import sqlite3
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional
+
+
+# Границы гистограмм длительности стадий (сек): от декодирования до ожидания NanoBanana
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 180)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return json.loads(json.dumps([[list(key), value] for key, value in self._values.items()]))
+
+    def merge(self, snapshots: List[list]) -> dict:
+        """
+        Сумма снимков нескольких процессов: {значения меток: значение}
+        """
+        merged: dict = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                key = tuple(key)
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self, values: Optional[dict] = None) -> list:
+        lines = self.header()
+        for key, value in sorted((self._values if values is None else values).items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    render = Counter.render
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: tuple = STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def merge(self, snapshots: List[list]) -> dict:
+        merged: dict = {}
+        for snapshot in snapshots:
+            for key, (counts, total, count) in snapshot:
+                state = merged.setdefault(tuple(key), [[0] * len(self.buckets), 0.0, 0])
+                state[0] = [left + right for left, right in zip(state[0], counts)]
+                state[1] += total
+                state[2] += count
+        return merged
+
+    def render(self, values: Optional[dict] = None) -> list:
+        lines = self.header()
+        for key, (counts, total, count) in sorted((self._values if values is None else values).items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            plain = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{plain} {_format_value(total)}")
+            lines.append(f"{self.name}_count{plain} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Набор метрик процесса в текстовом формате Prometheus (без внешних зависимостей)
+    """
+
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: list = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector) -> None:
+        """
+        collector() вызывается перед каждой выдачей /metrics - обновляет gauge из статистики модулей
+        """
+        self._collectors.append(collector)
+
+    def _collect(self) -> None:
+        for collector in self._collectors:
+            collector()
+
+    def snapshot(self) -> dict:
+        """
+        Значения всех метрик процесса (для SharedMetrics)
+        """
+        self._collect()
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def render(self, snapshots: Optional[list] = None) -> str:
+        """
+        snapshots - [(снимок, воркер жив)] всех воркеров из SharedMetrics.exchange(): метрики
+        суммируются по воркерам, gauge - только по живым. Без них - метрики этого процесса.
+        """
+        if snapshots is None:
+            self._collect()
+        lines = []
+        for metric in self._metrics:
+            if snapshots is None:
+                lines.extend(metric.render())
+                continue
+            parts = [data.get(metric.name, []) for data, alive in snapshots if alive or metric.kind != "gauge"]
+            lines.extend(metric.render(metric.merge(parts)))
+        return "\n".join(lines) + "\n"
+
+    def fold(self, snapshots: List[dict]) -> dict:
+        """
+        Один снимок из нескольких: сумма счетчиков и гистограмм, gauge отбрасываются
+        """
+        return {
+            metric.name: [[list(key), value] for key, value in metric.merge([data.get(metric.name, []) for data in snapshots]).items()]
+            for metric in self._metrics
+            if metric.kind != "gauge"
+        }
+
+
+class SharedMetrics:
+    """
+    Снимки метрик воркеров в SQLite: /metrics любого воркера отдает сумму по всем
+
+    При нескольких воркерах каждый хранит свои метрики в памяти, а запрос Prometheus
+    попадает в случайный воркер. Поэтому воркер сохраняет снимок раз в interval секунд
+    (и при каждом /metrics), а /metrics суммирует снимки всех воркеров. Gauge берутся
+    только у живых воркеров (снимок обновлялся за последние три интервала). Снимок
+    завершившегося воркера старше max_age сворачивается функцией fold в общую базу
+    (строка RETIRED), поэтому суммы счетчиков не уменьшаются при перезапуске воркеров.
+    """
+
+    RETIRED = "retired"
+
+    def __init__(
+        self,
+        path: str,
+        interval: float = 5.0,
+        max_age: float = 3600,
+        fold: Optional[Callable[[List[dict]], dict]] = None,
+    ):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.fold = fold
+        # id воркера выбирается в самом воркере: приложение импортируется до fork
+        self._pid = None
+        self._worker = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metric_snapshots (
+                    worker TEXT PRIMARY KEY,
+                    updated_at REAL NOT NULL,
+                    data TEXT NOT NULL
+                )
+            """)
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @property
+    def worker(self) -> str:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._worker = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+        return self._worker
+
+    def reset(self) -> None:
+        """
+        Удаляет снимки прошлого запуска сервера (вызывается главным процессом до запуска воркеров)
+        """
+        with self._db() as conn:
+            conn.execute("DELETE FROM metric_snapshots")
+
+    def publish(self, data: dict) -> None:
+        now = time.time()
+        cutoff = now - self.max_age
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO metric_snapshots (worker, updated_at, data) VALUES (?, ?, ?)",
+                (self.worker, now, json.dumps(data)),
+            )
+            expired = conn.execute(
+                "SELECT data FROM metric_snapshots WHERE updated_at < ? AND worker != ?", (cutoff, self.RETIRED)
+            ).fetchall()
+            if expired and self.fold:
+                base = conn.execute("SELECT data FROM metric_snapshots WHERE worker = ?", (self.RETIRED,)).fetchone()
+                parts = [json.loads(row[0]) for row in ([base] if base else []) + expired]
+                # updated_at = 0: база никогда не считается живым воркером
+                conn.execute(
+                    "INSERT OR REPLACE INTO metric_snapshots (worker, updated_at, data) VALUES (?, 0, ?)",
+                    (self.RETIRED, json.dumps(self.fold(parts))),
+                )
+            conn.execute(
+                "DELETE FROM metric_snapshots WHERE updated_at < ? AND worker != ?", (cutoff, self.RETIRED)
+            )
+
+    def exchange(self, data: dict) -> list:
+        """
+        Сохраняет снимок этого воркера и возвращает [(снимок, воркер жив)] всех воркеров
+        """
+        self.publish(data)
+        alive_after = time.time() - 3 * self.interval
+        with self._db() as conn:
+            rows = conn.execute("SELECT updated_at, data FROM metric_snapshots").fetchall()
+        return [(json.loads(data), updated_at >= alive_after) for updated_at, data in rows]
+
+    async def run(self, snapshot: Callable[[], dict]) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.publish, snapshot())
+            except sqlite3.Error:
+                pass
+            await asyncio.sleep(self.interval)
+
+
+def create_shared_metrics() -> Optional[SharedMetrics]:
+    """
+    Общие метрики воркеров в SHARED_STATE_PATH - только при нескольких воркерах (WEB_CONCURRENCY)
+    """
+    path = os.getenv("SHARED_STATE_PATH", "")
+    if not path or int(os.getenv("WEB_CONCURRENCY", 1)) < 2:
+        return None
+    return SharedMetrics(path, interval=float(os.getenv("METRICS_FLUSH_INTERVAL", 5)), fold=REGISTRY.fold)
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "odezda_stage_duration_seconds",
+    "Длительность стадий конвейера анализа",
+    ["stage"],
+))
+PROVIDER_REQUESTS = REGISTRY.register(Counter(
+    "odezda_provider_requests_total",
+    "Запросы к внешним провайдерам",
+    ["provider"],
+))
+PROVIDER_ERRORS = REGISTRY.register(Counter(
+    "odezda_provider_errors_total",
+    "Ошибки внешних провайдеров по статусу",
+    ["provider", "status"],
+))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "odezda_in_flight",
+    "Выполняющиеся сейчас анализы, фоновые задачи и задачи NanoBanana",
+    ["kind"],
+))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "odezda_provider_queue_depth",
+    "Запросы, ожидающие слота у провайдера",
+    ["provider"],
+))
+CACHE_EVENTS = REGISTRY.register(Counter(
+    "odezda_cache_events_total",
+    "События кэша результатов (memory_hits, disk_hits, misses, sets)",
+    ["event"],
+))
+VISION_IMAGE_TOKENS = REGISTRY.register(Counter(
+    "odezda_vision_image_tokens_total",
+    "Оценка входных токенов изображений в запросах к GPT-4o по уровню detail",
+    ["detail"],
+))
+HTTP_CONNECTIONS = REGISTRY.register(Counter(
+    "odezda_http_connections_total",
+    "Новые TCP-соединения к провайдерам (остальные запросы идут по соединениям из пула)",
+    ["provider"],
+))
+HTTP_HANDSHAKE_SECONDS = REGISTRY.register(Histogram(
+    "odezda_http_handshake_seconds",
+    "Длительность установки соединения с провайдером по фазам (tcp, tls)",
+    ["provider", "phase"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+))
+UPLOADS_USAGE = REGISTRY.register(Gauge(
+    "odezda_uploads",
+    "Текущий объем uploads (current_files, current_bytes)",
+    ["measure"],
+))
+UPLOADS_RECLAIMED = REGISTRY.register(Counter(
+    "odezda_uploads_reclaimed_total",
+    "Удаленные уборщиком файлы и освобожденные байты",
+    ["measure"],
+))
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def stage_timer(stage: str):
+    """
+    with stage_timer("openai"): ... - записывает длительность стадии в гистограмму
+    """
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def error_status(error: Optional[Exception] = None, status_code: Optional[int] = None) -> str:
+    """
+    Метка статуса ошибки: HTTP-код или имя класса исключения
+    """
+    if status_code is not None:
+        return str(status_code)
+    code = getattr(error, "status_code", None)
+    if code is None:
+        response = getattr(error, "response", None)
+        code = getattr(response, "status_code", None)
+    return str(code) if code is not None else type(error).__name__
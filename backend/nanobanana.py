@@ -0,0 +1,322 @@
+import os
+import hmac
+import json
+import time
+import hashlib
+import sqlite3
+import asyncio
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterable, Optional
+from urllib.parse import urlparse
+
+from logconfig import poll_log_sampler
+
+logger = logging.getLogger(__name__)
+
+
+# successFlag: 0-generating, 1-success, 2-create task failed, 3-generation failed
+FLAG_GENERATING = 0
+FLAG_SUCCESS = 1
+FLAG_FAILED = (2, 3)
+
+STATUS_TEXT = {
+    0: "GENERATING",
+    1: "SUCCESS",
+    2: "CREATE_TASK_FAILED",
+    3: "GENERATION_FAILED",
+}
+
+
+def parse_task_outcome(task_data: dict) -> Optional[dict]:
+    """
+    Разбирает данные задачи NanoBanana (record-info или callback)
+
+    Возвращает {"success": bool, "url": str | None, "error": str} для завершенной задачи
+    или None, если задача еще выполняется.
+    """
+    success_flag = task_data.get("successFlag")
+    response_obj = task_data.get("response") or task_data.get("info") or {}
+    if not isinstance(response_obj, dict):
+        response_obj = {}
+    result_url = response_obj.get("resultImageUrl") or response_obj.get("originImageUrl")
+
+    if success_flag == FLAG_SUCCESS or (success_flag is None and result_url):
+        if result_url:
+            return {"success": True, "url": result_url, "error": ""}
+        return {"success": False, "url": None, "error": "Задача завершена успешно, но URL изображения не найден"}
+    if success_flag in FLAG_FAILED:
+        error = task_data.get("errorMessage") or STATUS_TEXT.get(success_flag, "FAILED")
+        return {"success": False, "url": None, "error": error}
+    return None
+
+
+def derive_callback_token(api_key: str) -> str:
+    """
+    Токен вебхука из ключа API: одинаковый во всех воркерах и после перезапуска,
+    но не раскрывает сам ключ
+    """
+    return hmac.new(api_key.encode("utf-8"), b"nanobanana-callback", hashlib.sha256).hexdigest()[:32]
+
+
+def is_allowed_result_url(url: Optional[str], hosts: Iterable[str]) -> bool:
+    """
+    URL результата - https на одном из хостов провайдера (или их поддоменах)
+    """
+    if not isinstance(url, str):
+        return False
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    return parsed.scheme == "https" and any(host == allowed or host.endswith(f".{allowed}") for allowed in hosts)
+
+
+class SQLiteOutcomeMailbox:
+    """
+    Итоги задач из вебхука, который пришел в другой воркер
+
+    Вебхук попадает в любой процесс сервера, а задачу ждет тот, кто ее создал: если
+    ожидающего в процессе нет, итог кладется сюда, и опросчик нужного воркера забирает его.
+    """
+
+    # Итоги, которые никто не забрал (ожидание истекло), удаляются через час
+    max_age = 3600
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS nanobanana_outcomes (
+                    task_id TEXT PRIMARY KEY,
+                    outcome TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def put(self, task_id: str, outcome: dict) -> None:
+        now = time.time()
+        with self._db() as conn:
+            conn.execute("DELETE FROM nanobanana_outcomes WHERE created_at < ?", (now - self.max_age,))
+            conn.execute(
+                "INSERT OR REPLACE INTO nanobanana_outcomes (task_id, outcome, created_at) VALUES (?, ?, ?)",
+                (task_id, json.dumps(outcome), now),
+            )
+
+    def take(self, task_ids: list) -> dict:
+        """
+        Забирает (и удаляет) итоги указанных задач: {task_id: outcome}
+        """
+        if not task_ids:
+            return {}
+        placeholders = ",".join("?" * len(task_ids))
+        with self._db() as conn:
+            rows = conn.execute(
+                f"SELECT task_id, outcome FROM nanobanana_outcomes WHERE task_id IN ({placeholders})", task_ids,
+            ).fetchall()
+            if rows:
+                conn.executemany("DELETE FROM nanobanana_outcomes WHERE task_id = ?", [(row[0],) for row in rows])
+        return {task_id: json.loads(outcome) for task_id, outcome in rows}
+
+
+def create_outcome_mailbox() -> Optional[SQLiteOutcomeMailbox]:
+    """
+    Почтовый ящик итогов в SHARED_STATE_PATH (нужен только при нескольких воркерах)
+    """
+    path = os.getenv("SHARED_STATE_PATH", "")
+    return SQLiteOutcomeMailbox(path) if path else None
+
+
+class _PendingTask:
+    __slots__ = ("future", "next_check", "interval", "checks", "created_at")
+
+    def __init__(self, future: asyncio.Future, first_check: float, interval: float):
+        self.future = future
+        self.next_check = first_check
+        self.interval = interval
+        self.checks = 0
+        self.created_at = time.monotonic()
+
+
+class NanoBananaTaskTracker:
+    """
+    Ожидание результатов задач NanoBanana без отдельного цикла опроса на каждый запрос
+
+    Задачи завершаются вебхуком (complete) или общим фоновым опросчиком, который
+    проверяет все незавершенные задачи с адаптивно растущим интервалом. С mailbox
+    опросчик раз в mailbox_interval забирает итоги, принятые вебхуком в других воркерах.
+    """
+
+    def __init__(
+        self,
+        fetch_status: Callable[[str], Awaitable[Optional[dict]]],
+        initial_delay: float = 2.0,
+        min_interval: float = 2.0,
+        max_interval: float = 15.0,
+        backoff: float = 1.5,
+        max_concurrency: int = 8,
+        mailbox: Optional[SQLiteOutcomeMailbox] = None,
+        mailbox_interval: float = 1.0,
+    ):
+        self.fetch_status = fetch_status
+        self.mailbox = mailbox
+        self.mailbox_interval = mailbox_interval
+        self.initial_delay = initial_delay
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        self._pending: dict = {}
+        # Создается вместе с опросчиком: Event привязывается к event loop, а трекер
+        # переживает перезапуск приложения в новом цикле (тесты, повторный lifespan)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._poller: Optional[asyncio.Task] = None
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def register(self, task_id: str) -> asyncio.Future:
+        """
+        Регистрирует задачу и возвращает future с ее итогом
+        """
+        pending = self._pending.get(task_id)
+        if pending:
+            return pending.future
+        future = asyncio.get_running_loop().create_future()
+        self._pending[task_id] = _PendingTask(
+            future, time.monotonic() + self.initial_delay, self.min_interval
+        )
+        self._ensure_poller()
+        self._wakeup.set()
+        return future
+
+    def complete(self, task_id: str, outcome: dict) -> bool:
+        """
+        Завершает ожидающую задачу (из вебхука или опросчика)
+        """
+        pending = self._pending.pop(task_id, None)
+        if not pending:
+            return False
+        if not pending.future.done():
+            pending.future.set_result(outcome)
+        return True
+
+    def forget(self, task_id: str) -> None:
+        pending = self._pending.pop(task_id, None)
+        if pending and not pending.future.done():
+            pending.future.cancel()
+
+    async def wait(self, task_id: str, timeout: float) -> Optional[dict]:
+        """
+        Ждет итог задачи; при таймауте возвращает None и снимает задачу с опроса
+        """
+        future = self.register(task_id)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if not future.done():
+                self.forget(task_id)
+
+    def _ensure_poller(self) -> None:
+        if (
+            self._poller is None
+            or self._poller.done()
+            # Опросчик остался от прежнего event loop (приложение запущено заново без stop)
+            or self._poller.get_loop() is not asyncio.get_running_loop()
+        ):
+            self._wakeup = asyncio.Event()
+            # Общий опросчик не наследует контекст (trace id) запроса, который его запустил
+            self._poller = asyncio.create_task(self._poll_loop(), context=contextvars.Context())
+
+    async def stop(self) -> None:
+        if self._poller:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+            self._poller = None
+        self._wakeup = None
+        for task_id in list(self._pending):
+            self.forget(task_id)
+
+    async def _poll_loop(self) -> None:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if self.mailbox:
+                await self._check_mailbox()
+                if not self._pending:
+                    continue
+
+            now = time.monotonic()
+            due = [task_id for task_id, p in self._pending.items() if p.next_check <= now]
+            if not due:
+                delay = min(p.next_check for p in self._pending.values()) - now
+                if self.mailbox:
+                    delay = min(delay, self.mailbox_interval)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            async def check(task_id: str):
+                async with semaphore:
+                    await self._check_task(task_id)
+
+            await asyncio.gather(*(check(task_id) for task_id in due))
+
+    async def _check_mailbox(self) -> None:
+        try:
+            outcomes = await asyncio.to_thread(self.mailbox.take, list(self._pending))
+        except Exception as e:
+            if poll_log_sampler("nanobanana-mailbox-error"):
+                logger.warning("⚠️ Ошибка чтения итогов задач других воркеров: %s", e)
+            return
+        for task_id, outcome in outcomes.items():
+            logger.info("📬 Задача %s завершена (вебхук принят другим воркером)", task_id)
+            self.complete(task_id, outcome)
+
+    async def _check_task(self, task_id: str) -> None:
+        pending = self._pending.get(task_id)
+        if not pending:
+            return
+        pending.checks += 1
+        try:
+            task_data = await self.fetch_status(task_id)
+        except Exception as e:
+            if poll_log_sampler("nanobanana-poll-error"):
+                logger.warning("⚠️ Ошибка проверки статуса задачи %s: %s", task_id, e)
+            task_data = None
+
+        if task_data is not None:
+            outcome = parse_task_outcome(task_data)
+            if outcome is not None:
+                logger.info("📬 Задача %s завершена (опрос #%s)", task_id, pending.checks)
+                self.complete(task_id, outcome)
+                return
+
+        # Задача еще выполняется - увеличиваем интервал следующей проверки
+        pending.interval = min(pending.interval * self.backoff, self.max_interval)
+        pending.next_check = time.monotonic() + pending.interval
@@ -0,0 +1,146 @@
+"""
+Продакшен-запуск бэкенда: несколько процессов-воркеров
+
+    python serve.py [--workers 4] [--host 0.0.0.0] [--port 8000]
+
+Один процесс Python упирается в одно ядро на работе с Pillow, поэтому сервер
+запускается в WEB_CONCURRENCY воркерах (по умолчанию - по числу ядер) под gunicorn
+с воркерами uvicorn:
+- приложение импортируется один раз до запуска воркеров (preload): каталог и векторный
+  индекс загружаются в главном процессе и достаются воркерам без копирования;
+- kill -HUP <главный процесс> - плавный перезапуск: новые воркеры поднимаются с новым
+  кодом, старые дообрабатывают запросы (до GRACEFUL_TIMEOUT секунд);
+- kill -TERM - плавная остановка; упавший воркер перезапускается автоматически.
+
+Состояние, которое должно быть общим для воркеров, хранится в SQLite (WAL): при
+нескольких воркерах по умолчанию включаются JOB_STORE=sqlite (задачи и их события)
+и SHARED_STATE_PATH (лимиты частоты запросов к провайдерам, итоги вебхуков NanoBanana,
+снимки метрик воркеров для /metrics и аренда очистки uploads - ее выполняет один воркер);
+кэш результатов (CACHE_PATH), объединение одинаковых запросов (SINGLEFLIGHT_PATH)
+и история анализов (HISTORY_PATH) уже используют SQLite. Лимиты одновременных запросов делятся между воркерами.
+
+Без gunicorn (например, на Windows) используется uvicorn --workers - без предзагрузки
+и плавного перезапуска. Для разработки по-прежнему подходит python main.py.
+"""
+import os
+import sys
+import logging
+import argparse
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger("serve")
+
+
+def configure_shared_state(workers: int) -> None:
+    """
+    Переменные окружения для воркеров: их число и общие хранилища состояния
+    """
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    if workers < 2:
+        return
+    # Пул потоков Pillow в каждом воркере - чтобы вместе не больше потоков, чем ядер
+    os.environ.setdefault("IMAGE_WORKERS", str(max(1, (os.cpu_count() or workers) // workers)))
+    os.environ.setdefault("JOB_STORE", "sqlite")
+    os.environ.setdefault("SHARED_STATE_PATH", "data/shared.sqlite3")
+    if os.environ["JOB_STORE"].lower() == "memory":
+        logger.warning("⚠️ JOB_STORE=memory при %s воркерах: задача видна только создавшему ее воркеру", workers)
+    if not os.environ["SHARED_STATE_PATH"]:
+        logger.warning("⚠️ SHARED_STATE_PATH пуст: лимиты частоты и вебхуки NanoBanana не общие для воркеров")
+    if os.getenv("SINGLEFLIGHT_PATH", "data/singleflight.sqlite3") == "":
+        logger.warning("⚠️ SINGLEFLIGHT_PATH пуст: одинаковые запросы в разных воркерах не объединяются")
+
+
+def preload_app():
+    """
+    Импортирует приложение и загружает индексы каталога до запуска воркеров
+    """
+    import main
+
+    if main.catalog:
+        main.catalog.ensure_loaded()
+    if main.vector_index:
+        main.vector_index.ensure_loaded()
+    return main.app
+
+
+def run_gunicorn(workers: int, host: str, port: int) -> None:
+    from gunicorn.app.base import BaseApplication
+
+    class OdezdaApplication(BaseApplication):
+        def __init__(self, options: dict):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return preload_app()
+
+    OdezdaApplication({
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True,
+        # Анализ с генерацией изображения идет минуты - даем дообработать запросы
+        "graceful_timeout": int(os.getenv("GRACEFUL_TIMEOUT", 120)),
+        "timeout": int(os.getenv("WORKER_TIMEOUT", 120)),
+        "keepalive": int(os.getenv("KEEPALIVE_TIMEOUT", 5)),
+        # Периодический перезапуск воркеров (0 - отключен), со случайным разбросом
+        "max_requests": int(os.getenv("WORKER_MAX_REQUESTS", 0)),
+        "max_requests_jitter": int(os.getenv("WORKER_MAX_REQUESTS_JITTER", 100)),
+        "accesslog": "-" if os.getenv("ACCESS_LOG", "0") == "1" else None,
+    }).run()
+
+
+def run_uvicorn(workers: int, host: str, port: int) -> None:
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        workers=workers,
+        timeout_graceful_shutdown=int(os.getenv("GRACEFUL_TIMEOUT", 120)),
+    )
+
+
+def main(argv=None) -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY") or 0) or os.cpu_count() or 1)
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8000)))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    workers = max(1, args.workers)
+    configure_shared_state(workers)
+    # Запуск из любой папки: приложение использует относительные пути (uploads/, data/)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+
+    from metrics import create_shared_metrics
+
+    shared_metrics = create_shared_metrics()
+    if shared_metrics:
+        # Снимки метрик воркеров прошлого запуска не должны попасть в суммы
+        shared_metrics.reset()
+
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        logger.warning("⚠️ gunicorn не установлен - запуск uvicorn --workers (без предзагрузки и плавного перезапуска)")
+        logger.info("🚀 Бэкенд: %s воркеров на %s:%s", workers, args.host, args.port)
+        run_uvicorn(workers, args.host, args.port)
+        return 0
+
+    logger.info("🚀 Бэкенд: %s воркеров на %s:%s (gunicorn, preload)", workers, args.host, args.port)
+    run_gunicorn(workers, args.host, args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
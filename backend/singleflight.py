@@ -0,0 +1,205 @@
+import os
+import copy
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteLeases:
+    """
+    Аренды ключей в SQLite - общая блокировка для воркеров на одном хосте
+
+    Аренда истекает сама, если владелец упал, не освободив ее.
+    """
+
+    def __init__(self, path: str, lease_seconds: float):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._db() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS flights (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+
+    @contextmanager
+    def _db(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def acquire(self, key: str, owner: str) -> bool:
+        now = time.time()
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM flights WHERE key = ? AND expires_at < ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO flights (key, owner, expires_at) VALUES (?, ?, ?)",
+                (key, owner, now + self.lease_seconds),
+            )
+            return cursor.rowcount == 1
+
+    def hold(self, key: str, owner: str) -> bool:
+        """
+        Берет аренду или продлевает свою; False - ключ арендован другим владельцем
+        """
+        now = time.time()
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(
+                "INSERT INTO flights (key, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE flights.owner = excluded.owner OR flights.expires_at < ?",
+                (key, owner, now + self.lease_seconds, now),
+            )
+            return cursor.rowcount == 1
+
+    def is_held(self, key: str) -> bool:
+        with self._db() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM flights WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return row is not None
+
+    def release(self, key: str, owner: str) -> None:
+        with self._db() as conn:
+            conn.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (key, owner))
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых вычислений
+
+    Внутри процесса параллельные вызовы с одним ключом ждут одно вычисление.
+    Между воркерами (если задан leases) выполняет только владелец аренды,
+    остальные периодически проверяют lookup() - обычно общий дисковый кэш, -
+    и забирают готовый результат. Если аренда освободилась, а результата нет
+    (владелец упал или получил ошибку), вычисление запускается заново.
+
+    Вычисление отменяется, только когда его перестали ждать все вызывающие;
+    аренда освобождается в самой задаче вычисления. Пока вычисление идет, аренда
+    продлевается каждую треть срока: долгий запрос (очередь к провайдеру, ожидание
+    NanoBanana) не должен пережить ее и запуститься во втором воркере.
+    """
+
+    def __init__(self, leases: Optional[SQLiteLeases] = None, poll_interval: float = 0.5):
+        self.leases = leases
+        self.poll_interval = poll_interval
+        self._pid = None
+        self._owner = None
+        self._inflight: dict = {}
+        self.stats = {"leader": 0, "joined_local": 0, "joined_remote": 0}
+
+    async def do(
+        self,
+        key: str,
+        func: Callable[[], Awaitable],
+        lookup: Optional[Callable[[], Awaitable]] = None,
+    ):
+        flight = self._inflight.get(key)
+        if flight is None:
+            # Вычисление - отдельная задача: отмена запроса, который его начал, не отменяет
+            # его для остальных ожидающих
+            flight = _Flight(asyncio.create_task(self._run(key, func, lookup)))
+            self._inflight[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        else:
+            self.stats["joined_local"] += 1
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            # Ушел последний ожидающий - результат больше никому не нужен
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+        return copy.deepcopy(result)
+
+    @property
+    def owner(self) -> str:
+        # Объект создается до запуска воркеров (preload) - у каждого воркера свой владелец
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._owner = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+        return self._owner
+
+    def _forget(self, key: str, flight: "_Flight") -> None:
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+
+    async def _run(self, key: str, func, lookup):
+        if not self.leases:
+            self.stats["leader"] += 1
+            return await func()
+
+        while True:
+            acquired = await self._lease_call(self.leases.acquire, key, self.owner, default=True)
+            if acquired:
+                self.stats["leader"] += 1
+                heartbeat = asyncio.create_task(self._renew(key))
+                try:
+                    return await func()
+                finally:
+                    heartbeat.cancel()
+                    await self._lease_call(self.leases.release, key, self.owner)
+
+            # Ключ вычисляет другой воркер - ждем его результат
+            logger.info("⏳ Одинаковый запрос уже выполняется в другом процессе, ожидаю (%s...)", key[:24])
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                if lookup:
+                    result = await lookup()
+                    if result is not None:
+                        self.stats["joined_remote"] += 1
+                        return result
+                if not await self._lease_call(self.leases.is_held, key, default=False):
+                    break
+
+    async def _renew(self, key: str) -> None:
+        while True:
+            await asyncio.sleep(self.leases.lease_seconds / 3)
+            if not await self._lease_call(self.leases.hold, key, self.owner, default=True):
+                logger.warning("⚠️ Аренда single-flight перехвачена другим процессом (%s...)", key[:24])
+                return
+
+    async def _lease_call(self, func, *args, default=None):
+        try:
+            return await asyncio.to_thread(func, *args)
+        except sqlite3.Error as e:
+            # Без общей блокировки просто выполняем сами
+            logger.warning("⚠️ Ошибка блокировки single-flight: %s", e)
+            return default
+
+
+def create_single_flight() -> SingleFlight:
+    """
+    SINGLEFLIGHT_PATH - файл SQLite с арендами для воркеров одного хоста (пусто = только в процессе)
+    """
+    path = os.getenv("SINGLEFLIGHT_PATH", "data/singleflight.sqlite3")
+    leases = None
+    if path:
+        leases = SQLiteLeases(path, lease_seconds=float(os.getenv("SINGLEFLIGHT_LEASE_SECONDS", 300)))
+    return SingleFlight(leases)
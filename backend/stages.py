@@ -0,0 +1,99 @@
+"""
+Исполнитель стадий конвейера с зависимостями
+
+    async with StageGraph() as stages:
+        stages.add("analysis", analyze)
+        stages.add("upload", upload_photo, speculative=True)
+        stages.add("image", generate, "analysis", "upload")
+        result = await stages.result("image")
+
+Стадия запускается сразу, как только готовы ее зависимости, и получает их результаты
+аргументами - независимые сетевые стадии (анализ GPT-4o и загрузка фото) идут
+параллельно. Если зависимость упала, стадия падает с той же ошибкой, не запускаясь.
+При выходе из блока незавершенные стадии отменяются: при ошибке анализа спекулятивная
+загрузка не продолжается впустую.
+
+timeline - начало и конец каждой стадии от старта графа; critical_path() - цепочка
+стадий, которая определила общее время (ее и нужно сокращать).
+"""
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StageGraph:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timeline: Dict[str, list] = {}
+        self.deps: Dict[str, tuple] = {}
+        self.speculative: set = set()
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def _now(self) -> float:
+        return time.perf_counter() - self.started
+
+    def add(self, name: str, func: Callable[..., Awaitable], *deps: str, speculative: bool = False) -> asyncio.Task:
+        """
+        Запускает стадию func(*результаты deps); зависимости должны быть добавлены раньше
+        """
+        dep_tasks = [self._tasks[dep] for dep in deps]
+
+        async def run():
+            args = [await task for task in dep_tasks]
+            self.timeline[name] = [self._now(), None]
+            try:
+                return await func(*args)
+            finally:
+                self.timeline[name][1] = self._now()
+
+        task = asyncio.create_task(run(), name=f"stage:{name}")
+        self._tasks[name] = task
+        self.deps[name] = deps
+        if speculative:
+            self.speculative.add(name)
+        return task
+
+    async def result(self, name: str):
+        return await self._tasks[name]
+
+    async def aclose(self) -> None:
+        for name, task in self._tasks.items():
+            if not task.done():
+                if name in self.speculative:
+                    logger.info("✂️ Отмена спекулятивной стадии %s", name)
+                task.cancel()
+        # Забираем исключения всех стадий, чтобы asyncio не ругался на непрочитанные ошибки
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def __aenter__(self) -> "StageGraph":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.aclose()
+
+    def critical_path(self) -> List[str]:
+        """
+        От стадии, закончившейся последней, назад через зависимость, закончившуюся позже других
+        """
+        finished = {name: span for name, span in self.timeline.items() if span[1] is not None}
+        if not finished:
+            return []
+        path = [max(finished, key=lambda name: finished[name][1])]
+        while True:
+            deps = [dep for dep in self.deps[path[-1]] if dep in finished]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda dep: finished[dep][1]))
+        return path[::-1]
+
+    def summary(self) -> str:
+        spans = ", ".join(
+            f"{name} {start:.2f}–{end:.2f}с" if end is not None else f"{name} {start:.2f}с–…"
+            for name, (start, end) in sorted(self.timeline.items(), key=lambda item: item[1][0])
+        )
+        path = self.critical_path()
+        total: Optional[float] = self.timeline[path[-1]][1] if path else None
+        return f"{spans}; критический путь: {' → '.join(path)}" + (f" ({total:.2f}с)" if total is not None else "")
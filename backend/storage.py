@@ -0,0 +1,410 @@
+import os
+import hmac
+import time
+import base64
+import asyncio
+import tempfile
+import hashlib
+import logging
+from typing import Callable, Optional
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+import httpx
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, PlainTextResponse, Response
+
+from limits import ProviderBusy, raise_for_transient
+
+logger = logging.getLogger(__name__)
+
+
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/avif": "avif",
+}
+
+# Файлы с именем по содержимому не меняются - браузер и CDN могут кэшировать их навсегда
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def content_key(data: bytes) -> str:
+    """
+    Имя объекта по содержимому - одинаковые файлы не дублируются и не конфликтуют
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def sign_path(signing_key: str, path: str, expires: int) -> str:
+    message = f"{path}:{expires}".encode("utf-8")
+    return hmac.new(signing_key.encode("utf-8"), message, hashlib.sha256).hexdigest()[:32]
+
+
+def verify_signature(signing_key: str, path: str, expires: str, signature: str) -> bool:
+    try:
+        expires_at = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires_at < time.time():
+        return False
+    return hmac.compare_digest(sign_path(signing_key, path, expires_at), signature or "")
+
+
+class Storage:
+    """
+    Хранилище загруженных и сгенерированных изображений
+
+    save() возвращает публичный URL, доступный внешним сервисам (NanoBanana),
+    или None при ошибке. save_variant() сохраняет вариант сгенерированного изображения
+    (формат и ширина) под именем <sha256 исходного>-<ширина>; хранилища без
+    supports_variants получают только JPEG.
+
+    URL может истекать (подпись, presigned S3), поэтому для долгого хранения (история)
+    используется to_ref() - ссылка без срока, - а свежий URL по ней дает from_ref().
+    """
+
+    name = "base"
+    supports_variants = False
+
+    async def save(self, data: bytes, content_type: str = "image/jpeg", b64: Optional[str] = None) -> Optional[str]:
+        raise NotImplementedError
+
+    async def save_variant(self, name: str, data: bytes, content_type: str) -> Optional[str]:
+        return await self.save(data, content_type)
+
+    def to_ref(self, url: str) -> str:
+        """
+        Постоянная ссылка на файл по URL из save(); чужие URL возвращаются как есть
+        """
+        return url
+
+    def from_ref(self, ref: str) -> Optional[str]:
+        """
+        Свежий URL по ссылке из to_ref(); None - файла больше нет. Может обращаться к диску.
+        """
+        return ref
+
+
+class LocalStorage(Storage):
+    """
+    Локальная файловая система: имена по sha256, шардированные папки ab/cd/<hash>.jpg,
+    подписанные URL с истечением срока, отдаются через монтирование /uploads
+    """
+
+    name = "local"
+    supports_variants = True
+
+    def __init__(self, root: str, base_url: str, signing_key: Optional[str] = None, url_ttl: int = 86400):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        self.signing_key = signing_key
+        self.url_ttl = url_ttl
+
+    def relative_path(self, key: str, extension: str) -> str:
+        return f"{key[:2]}/{key[2:4]}/{key}.{extension}"
+
+    def _write(self, relative_path: str, data: bytes) -> None:
+        path = os.path.join(self.root, relative_path)
+        if os.path.exists(path):
+            # Тот же контент уже сохранен - только обновляем время доступа
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Свой временный файл на каждую запись: одинаковый контент может сохраняться
+        # одновременно из нескольких потоков (повторная отправка, загрузка фото и генерация)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def variant_path(self, name: str, content_type: str) -> str:
+        return f"variants/{name[:2]}/{name}.{EXTENSIONS.get(content_type, 'bin')}"
+
+    def _signature_query(self, path: str) -> str:
+        if not self.signing_key:
+            return ""
+        expires = int(time.time()) + self.url_ttl
+        return f"?expires={expires}&sig={sign_path(self.signing_key, path, expires)}"
+
+    def url_for(self, relative_path: str) -> str:
+        return f"{self.base_url}/uploads/{quote(relative_path)}{self._signature_query(relative_path)}"
+
+    def negotiated_url(self, name: str) -> str:
+        """
+        URL варианта без расширения: формат выбирает сервер по Accept (/api/images/<имя>)
+        """
+        return f"{self.base_url}/api/images/{name}{self._signature_query(f'images/{name}')}"
+
+    def verify(self, path: str, expires: Optional[str], signature: Optional[str]) -> bool:
+        return not self.signing_key or verify_signature(self.signing_key, path, expires, signature)
+
+    def to_ref(self, url: str) -> str:
+        # local:uploads/<путь> или local:api/images/<имя> - без адреса сервера и подписи
+        prefix = f"{self.base_url}/"
+        if not url.startswith(prefix):
+            return url
+        return "local:" + unquote(url[len(prefix):].split("?", 1)[0])
+
+    def from_ref(self, ref: str) -> Optional[str]:
+        if not ref.startswith("local:"):
+            return ref
+        path = ref[len("local:"):]
+        if path.startswith("uploads/"):
+            relative_path = path[len("uploads/"):]
+            exists = os.path.isfile(os.path.join(self.root, relative_path))
+            return self.url_for(relative_path) if exists else None
+        if path.startswith("api/images/"):
+            name = path[len("api/images/"):]
+            # JPEG-вариант есть всегда - по нему проверяем, не удалил ли файлы уборщик
+            exists = os.path.isfile(os.path.join(self.root, self.variant_path(name, "image/jpeg")))
+            return self.negotiated_url(name) if exists else None
+        return None
+
+    async def save(self, data: bytes, content_type: str = "image/jpeg", b64: Optional[str] = None) -> Optional[str]:
+        relative_path = self.relative_path(content_key(data), EXTENSIONS.get(content_type, "bin"))
+        try:
+            await asyncio.to_thread(self._write, relative_path, data)
+        except OSError as e:
+            logger.error("❌ Ошибка сохранения файла %s: %s", relative_path, e)
+            return None
+        logger.info("💾 Изображение сохранено локально: %s", relative_path)
+        return self.url_for(relative_path)
+
+    async def save_variant(self, name: str, data: bytes, content_type: str) -> Optional[str]:
+        relative_path = self.variant_path(name, content_type)
+        try:
+            await asyncio.to_thread(self._write, relative_path, data)
+        except OSError as e:
+            logger.error("❌ Ошибка сохранения файла %s: %s", relative_path, e)
+            return None
+        return self.url_for(relative_path)
+
+
+class S3Storage(Storage):
+    """
+    S3-совместимое хранилище (AWS S3, MinIO) с presigned URL
+
+    Требует пакет boto3 (необязательная зависимость).
+    """
+
+    name = "s3"
+    supports_variants = True
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, prefix: str = "", url_ttl: int = 86400, region: Optional[str] = None):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("Для STORAGE_BACKEND=s3 установите пакет boto3 (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.url_ttl = url_ttl
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+
+    def _presign(self, key: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=self.url_ttl
+        )
+
+    def _put(self, key: str, data: bytes, content_type: str) -> str:
+        self.client.put_object(
+            Bucket=self.bucket, Key=key, Body=data, ContentType=content_type,
+            CacheControl="public, max-age=31536000, immutable",
+        )
+        return self._presign(key)
+
+    async def save(self, data: bytes, content_type: str = "image/jpeg", b64: Optional[str] = None) -> Optional[str]:
+        digest = content_key(data)
+        key = f"{digest[:2]}/{digest}.{EXTENSIONS.get(content_type, 'bin')}"
+        if self.prefix:
+            key = f"{self.prefix}/{key}"
+        try:
+            url = await asyncio.to_thread(self._put, key, data, content_type)
+        except Exception as e:
+            logger.error("❌ Ошибка загрузки в S3 (%s): %s", key, e)
+            return None
+        logger.info("☁️ Изображение загружено в S3: %s", key)
+        return url
+
+    def to_ref(self, url: str) -> str:
+        parsed = urlparse(url)
+        if "Signature=" not in parsed.query:
+            return url
+        key = unquote(parsed.path).lstrip("/")
+        if not parsed.netloc.startswith(f"{self.bucket}."):
+            # path-style (MinIO, свой endpoint): /<bucket>/<key>
+            key = key.partition("/")[2]
+        return f"s3:{key}"
+
+    def from_ref(self, ref: str) -> Optional[str]:
+        return self._presign(ref[len("s3:"):]) if ref.startswith("s3:") else ref
+
+    async def save_variant(self, name: str, data: bytes, content_type: str) -> Optional[str]:
+        key = f"variants/{name[:2]}/{name}.{EXTENSIONS.get(content_type, 'bin')}"
+        if self.prefix:
+            key = f"{self.prefix}/{key}"
+        try:
+            return await asyncio.to_thread(self._put, key, data, content_type)
+        except Exception as e:
+            logger.error("❌ Ошибка загрузки в S3 (%s): %s", key, e)
+            return None
+
+
+class ImgurStorage(Storage):
+    """
+    Анонимная загрузка на Imgur (прежнее поведение, необязательный бэкенд)
+    """
+
+    name = "imgur"
+
+    def __init__(self, client_getter: Callable[[], httpx.AsyncClient], client_id: str, api_url: str = "https://api.imgur.com/3/image", limiter=None):
+        self.client_getter = client_getter
+        self.client_id = client_id
+        self.api_url = api_url
+        self.limiter = limiter
+
+    async def _post(self, headers: dict, payload: dict) -> httpx.Response:
+        async def send():
+            return raise_for_transient(
+                await self.client_getter().post(self.api_url, headers=headers, data=payload, timeout=30)
+            )
+        if self.limiter:
+            return await self.limiter.call(send)
+        return await send()
+
+    async def save(self, data: bytes, content_type: str = "image/jpeg", b64: Optional[str] = None) -> Optional[str]:
+        try:
+            headers = {"Authorization": f"Client-ID {self.client_id}"}
+            payload = {
+                # Конвертируем в base64 (если не посчитан заранее)
+                "image": b64 if b64 is not None else base64.b64encode(data).decode("utf-8"),
+                "type": "base64",
+            }
+            logger.info("📤 Загрузка изображения на Imgur...")
+            response = await self._post(headers, payload)
+
+            if response.status_code != 200:
+                logger.error("❌ Ошибка загрузки на Imgur: %s", response.status_code)
+                logger.error("📄 Ответ: %s", response.text)
+                return None
+
+            result = response.json()
+            if not result.get("success"):
+                logger.error("❌ Imgur вернул ошибку: %s", result)
+                return None
+
+            image_url = result["data"]["link"]
+            # ОБЯЗАТЕЛЬНО используем HTTPS для совместимости с мобильными браузерами!
+            if image_url.startswith("http://"):
+                image_url = image_url.replace("http://", "https://", 1)
+            logger.info("✅ Изображение загружено: %s...", image_url[:60])
+            return image_url
+
+        except ProviderBusy:
+            logger.error("❌ Imgur: очередь переполнена")
+            return None
+        except Exception as e:
+            logger.error("❌ Ошибка загрузки на Imgur: %s", e)
+            return None
+
+
+class SignedStaticFiles(StaticFiles):
+    """
+    StaticFiles, который при заданном ключе отдает файлы только по подписанным URL
+
+    Имена файлов - sha256 содержимого (или исходного изображения для вариантов), поэтому
+    ETag строгий (по имени, а не по времени изменения) и кэширование бессрочное.
+    """
+
+    def __init__(self, *args, signing_key: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.signing_key = signing_key
+
+    async def __call__(self, scope, receive, send):
+        if self.signing_key and scope["type"] == "http":
+            query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+            relative_path = self.get_path(scope)
+            if not verify_signature(
+                self.signing_key,
+                relative_path,
+                query.get("expires", [None])[0],
+                query.get("sig", [None])[0],
+            ):
+                response = PlainTextResponse("Ссылка недействительна или устарела", status_code=403)
+                await response(scope, receive, send)
+                return
+        await super().__call__(scope, receive, send)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        return immutable_file_response(full_path, scope, stat_result=stat_result, status_code=status_code)
+
+
+def immutable_file_response(full_path: str, scope, stat_result=None, status_code: int = 200, **kwargs) -> Response:
+    """
+    Файл с именем по содержимому: строгий ETag по имени, бессрочный Cache-Control, 304 по If-None-Match
+    """
+    headers = {
+        "ETag": f'"{os.path.basename(full_path)}"',
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        **kwargs.pop("headers", {}),
+    }
+    if_none_match = Headers(scope=scope).get("if-none-match", "")
+    if headers["ETag"] in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(
+        full_path, status_code=status_code, stat_result=stat_result, method=scope["method"], headers=headers, **kwargs
+    )
+
+
+def create_storage(client_getter: Callable[[], httpx.AsyncClient], root: str = "uploads", imgur_limiter=None) -> Storage:
+    """
+    Создает хранилище по STORAGE_BACKEND (local | s3 | imgur)
+
+    По умолчанию - local, если задан PUBLIC_BASE_URL (сервер доступен извне) или не задан
+    IMGUR_CLIENT_ID, иначе imgur. Imgur требует собственный IMGUR_CLIENT_ID.
+    """
+    public_base_url = os.getenv("PUBLIC_BASE_URL")
+    imgur_client_id = os.getenv("IMGUR_CLIENT_ID")
+    default_backend = "imgur" if imgur_client_id and not public_base_url else "local"
+    backend = (os.getenv("STORAGE_BACKEND") or default_backend).lower()
+    url_ttl = int(os.getenv("STORAGE_URL_TTL", 86400))
+
+    if backend not in ("local", "s3", "imgur"):
+        logger.warning("⚠️ Неизвестный STORAGE_BACKEND=%s, используется %s", backend, default_backend)
+        backend = default_backend
+
+    if backend == "local":
+        logger.info("🗄️ Хранилище изображений: локальное (%s)", root)
+        if not public_base_url:
+            logger.warning("⚠️ PUBLIC_BASE_URL не задан: NanoBanana не сможет скачать фото с localhost")
+        return LocalStorage(
+            root,
+            public_base_url or "http://localhost:8000",
+            signing_key=os.getenv("STORAGE_SIGNING_KEY") or None,
+            url_ttl=url_ttl,
+        )
+    if backend == "s3":
+        logger.info("🗄️ Хранилище изображений: S3 (%s)", os.getenv('S3_BUCKET'))
+        return S3Storage(
+            os.getenv("S3_BUCKET", "odezda"),
+            endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+            prefix=os.getenv("S3_PREFIX", ""),
+            url_ttl=url_ttl,
+            region=os.getenv("S3_REGION") or None,
+        )
+    if not imgur_client_id:
+        raise RuntimeError("Для STORAGE_BACKEND=imgur задайте IMGUR_CLIENT_ID (https://api.imgur.com/oauth2/addclient)")
+    logger.info("🗄️ Хранилище изображений: Imgur")
+    return ImgurStorage(
+        client_getter,
+        imgur_client_id,
+        api_url=os.getenv("IMGUR_API_URL") or "https://api.imgur.com/3/image",
+        limiter=imgur_limiter,
+    )
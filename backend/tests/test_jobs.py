@@ -0,0 +1,52 @@
+import time
+import asyncio
+
+from jobs import JOB_DONE, JOB_RUNNING, InMemoryJobStore, SQLiteJobStore, new_job
+
+
+def test_sqlite_store_prunes_old_jobs(tmp_path):
+    async def scenario():
+        store = SQLiteJobStore(str(tmp_path / "jobs.sqlite3"), max_age=60)
+        old = await store.create(new_job("casual"))
+        await store.add_event(old["id"], "analysis", {"analysis": "..."})
+        with store._db() as conn:
+            conn.execute("UPDATE jobs SET updated_at = ?", (time.time() - 120,))
+
+        fresh = await store.create(new_job("casual"))
+        assert await store.prune() == 1
+        assert await store.get(old["id"]) is None
+        assert await store.events_since(old["id"]) == []
+        assert await store.get(fresh["id"]) is not None
+
+    asyncio.run(scenario())
+
+
+def test_abandoned_job_detected_by_heartbeat_age():
+    store = InMemoryJobStore()
+    job = {**new_job("casual"), "status": JOB_RUNNING}
+    assert not store.is_abandoned(job)
+    job["updated_at"] -= 4 * store.heartbeat_interval
+    assert store.is_abandoned(job)
+    assert not store.is_abandoned({**job, "status": JOB_DONE})
+
+
+def test_waiters_removed_after_stream_stops():
+    async def scenario():
+        store = InMemoryJobStore()
+        store.poll_interval = 0.01
+        job = await store.create(new_job("casual"))
+
+        assert await store.next_events(job["id"]) == []
+        waiter = asyncio.create_task(store.next_events(job["id"]))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert store._waiters == {}
+
+        listener = asyncio.create_task(store.next_events(job["id"]))
+        await asyncio.sleep(0)
+        await store.add_event(job["id"], "done", {"status": JOB_DONE})
+        assert [event["type"] for event in await listener] == ["done"]
+        assert store._waiters == {}
+
+    asyncio.run(scenario())
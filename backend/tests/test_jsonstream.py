@@ -0,0 +1,59 @@
+import json
+
+from jsonstream import JsonFieldStream
+
+RESPONSE = {
+    "analysis": "Фото в полный рост, \"casual\" {не JSON}",
+    "person_description": "мужчина\nв очках",
+    "recommendations": [
+        {"item": "Кеды", "description": "белые, с [кожаным] верхом", "search_query": "кеды белые"},
+        {"item": "Джинсы", "description": "прямые", "tags": ["синие", {"fit": "regular"}]},
+    ],
+    "score": 8.5,
+    "extra": {"nested": [1, 2, {"x": "}"}]},
+}
+
+
+def parse(text: str, chunk_size: int) -> list:
+    parser = JsonFieldStream(item_arrays=("recommendations",))
+    events = []
+    for start in range(0, len(text), chunk_size):
+        events.extend(parser.feed(text[start:start + chunk_size]))
+    return events
+
+
+def test_events_do_not_depend_on_chunking():
+    text = json.dumps(RESPONSE, ensure_ascii=False, indent=2)
+    expected = parse(text, len(text))
+    for chunk_size in (1, 2, 7, 64):
+        assert parse(text, chunk_size) == expected
+
+
+def test_fields_and_items_are_emitted_in_order():
+    text = json.dumps(RESPONSE, ensure_ascii=False)
+    events = parse(text, 5)
+
+    items = [event for event in events if event[0] == "item"]
+    assert items == [
+        ("item", "recommendations", index, recommendation)
+        for index, recommendation in enumerate(RESPONSE["recommendations"])
+    ]
+    fields = [event for event in events if event[0] == "field"]
+    assert fields == [("field", key, value) for key, value in RESPONSE.items()]
+    # Каждая рекомендация приходит раньше, чем весь массив
+    assert events.index(items[-1]) < events.index(("field", "recommendations", RESPONSE["recommendations"]))
+
+
+def test_field_emitted_as_soon_as_it_is_complete():
+    parser = JsonFieldStream()
+    assert parser.feed('{"analysis": "гото') == []
+    assert parser.feed('во", "sco') == [("field", "analysis", "готово")]
+    assert parser.feed('re": 1}') == [("field", "score", 1)]
+
+
+def test_invalid_fragment_is_skipped():
+    parser = JsonFieldStream(item_arrays=("recommendations",))
+    events = parser.feed('{"recommendations": [{"item": "A"}, {oops}, {"item": "B"}], "analysis": "ok"}')
+    assert ("item", "recommendations", 0, {"item": "A"}) in events
+    assert ("item", "recommendations", 2, {"item": "B"}) in events
+    assert ("field", "analysis", "ok") in events
@@ -0,0 +1,133 @@
+import asyncio
+
+import httpx
+import pytest
+
+from limits import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    ProviderBusy,
+    ProviderLimiter,
+    TransientHTTPError,
+)
+
+
+def transient_error(status_code: int = 503) -> TransientHTTPError:
+    return TransientHTTPError(httpx.Response(status_code, request=httpx.Request("GET", "https://provider/")))
+
+
+def test_concurrency_limit():
+    async def scenario():
+        limiter = ProviderLimiter("test", max_concurrency=2)
+        running = 0
+        peak = 0
+
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(limiter.call(work) for _ in range(6)))
+        assert peak == 2
+        assert limiter.active == 0 and limiter.queued == 0
+
+    asyncio.run(scenario())
+
+
+def test_interactive_requests_go_before_background():
+    async def scenario():
+        limiter = ProviderLimiter("test", max_concurrency=1)
+        release = asyncio.Event()
+        order = []
+
+        async def blocker():
+            await release.wait()
+
+        async def work(name):
+            order.append(name)
+
+        first = asyncio.create_task(limiter.call(blocker))
+        await asyncio.sleep(0)
+        queued = [
+            asyncio.create_task(limiter.call(work, "background", priority=PRIORITY_BACKGROUND)),
+            asyncio.create_task(limiter.call(work, "interactive", priority=PRIORITY_INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *queued)
+        assert order == ["interactive", "background"]
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects_interactive_requests():
+    async def scenario():
+        limiter = ProviderLimiter("test", max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+
+        tasks = [asyncio.create_task(limiter.call(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(ProviderBusy) as error:
+            await limiter.call(release.wait)
+        assert error.value.status_code == 503
+        assert "Retry-After" in error.value.headers
+        assert limiter.stats["rejected"] == 1
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_transient_errors_are_retried():
+    async def scenario():
+        limiter = ProviderLimiter("test", base_delay=0.001, max_retries=3)
+        attempts = 0
+
+        async def flaky():
+            nonlocal attempts
+            attempts += 1
+            if attempts < 3:
+                raise transient_error()
+            return "ok"
+
+        assert await limiter.call(flaky) == "ok"
+        assert attempts == 3 and limiter.stats["retries"] == 2
+
+        async def broken():
+            raise ValueError("not transient")
+
+        with pytest.raises(ValueError):
+            await limiter.call(broken)
+        assert limiter.stats["retries"] == 2
+
+        async def always_busy():
+            raise transient_error(429)
+
+        with pytest.raises(TransientHTTPError):
+            await limiter.call(always_busy, max_retries=1)
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        limiter = ProviderLimiter("test", max_concurrency=1)
+        release = asyncio.Event()
+
+        holder = asyncio.create_task(limiter.call(release.wait))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(limiter.call(release.wait))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        release.set()
+        await holder
+        assert limiter.active == 0
+        assert await limiter.call(asyncio.sleep, 0) is None
+
+    asyncio.run(scenario())
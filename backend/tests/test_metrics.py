@@ -0,0 +1,96 @@
+import os
+import json
+import time
+
+from metrics import Counter, Gauge, Histogram, Registry, SharedMetrics
+from singleflight import SQLiteLeases
+
+
+def make_registry():
+    registry = Registry()
+    counter = registry.register(Counter("t_requests_total", "requests", ("provider",)))
+    gauge = registry.register(Gauge("t_in_flight", "in flight"))
+    histogram = registry.register(Histogram("t_seconds", "seconds", buckets=(1.0,)))
+    return registry, counter, gauge, histogram
+
+
+def test_render_sums_workers(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    first = SharedMetrics(path)
+    second = SharedMetrics(path)
+    # Снимок другого воркера: id с чужим pid не пересоздается в этом процессе
+    second._pid, second._worker = os.getpid(), "other-worker"
+
+    registry, counter, gauge, histogram = make_registry()
+    counter.inc(provider="openai")
+    gauge.set(2)
+    histogram.observe(0.5)
+    second.publish(registry.snapshot())
+
+    counter.inc(2, provider="openai")
+    gauge.set(3)
+    histogram.observe(5)
+    text = registry.render(first.exchange(registry.snapshot()))
+
+    assert 't_requests_total{provider="openai"} 4' in text
+    assert "t_in_flight 5" in text
+    assert 't_seconds_bucket{le="1"} 2' in text
+    assert "t_seconds_count 3" in text
+
+
+def test_render_skips_gauges_of_stopped_workers(tmp_path):
+    shared = SharedMetrics(str(tmp_path / "shared.sqlite3"), interval=1)
+    registry, counter, gauge, _ = make_registry()
+    counter.inc(provider="openai")
+    gauge.set(7)
+    snapshot = registry.snapshot()
+
+    with shared._db() as conn:
+        conn.execute(
+            "INSERT INTO metric_snapshots (worker, updated_at, data) VALUES (?, ?, ?)",
+            ("stopped-worker", time.time() - 10, json.dumps(snapshot)),
+        )
+    snapshots = shared.exchange(snapshot)
+    assert sorted(alive for _, alive in snapshots) == [False, True]
+
+    text = registry.render(snapshots)
+    assert 't_requests_total{provider="openai"} 2' in text
+    assert "t_in_flight 7" in text
+
+
+def test_hold_keeps_single_owner(tmp_path):
+    leases = SQLiteLeases(str(tmp_path / "shared.sqlite3"), lease_seconds=60)
+    assert leases.hold("janitor:uploads", "a")
+    assert leases.hold("janitor:uploads", "a")
+    assert not leases.hold("janitor:uploads", "b")
+    with leases._db() as conn:
+        conn.execute("UPDATE flights SET expires_at = ?", (time.time() - 1,))
+    assert leases.hold("janitor:uploads", "b")
+    assert not leases.hold("janitor:uploads", "a")
+
+
+def test_expired_worker_counters_fold_into_base(tmp_path):
+    registry, counter, gauge, histogram = make_registry()
+    shared = SharedMetrics(str(tmp_path / "shared.sqlite3"), max_age=60, fold=registry.fold)
+    counter.inc(5, provider="openai")
+    gauge.set(9)
+    histogram.observe(0.5)
+    with shared._db() as conn:
+        conn.execute(
+            "INSERT INTO metric_snapshots (worker, updated_at, data) VALUES (?, ?, ?)",
+            ("recycled-worker", time.time() - 120, json.dumps(registry.snapshot())),
+        )
+
+    # Новый воркер после перезапуска: свои метрики с нуля
+    fresh, fresh_counter, fresh_gauge, _ = make_registry()
+    fresh_counter.inc(1, provider="openai")
+    fresh_gauge.set(1)
+    snapshots = shared.exchange(fresh.snapshot())
+    text = fresh.render(snapshots)
+
+    assert 't_requests_total{provider="openai"} 6' in text
+    assert "t_seconds_count 1" in text
+    assert "t_in_flight 1" in text
+    with shared._db() as conn:
+        workers = {row[0] for row in conn.execute("SELECT worker FROM metric_snapshots")}
+    assert "recycled-worker" not in workers and SharedMetrics.RETIRED in workers
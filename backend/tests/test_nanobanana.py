@@ -0,0 +1,108 @@
+import os
+import asyncio
+
+import pytest
+
+from nanobanana import (
+    NanoBananaTaskTracker,
+    derive_callback_token,
+    is_allowed_result_url,
+    parse_task_outcome,
+)
+
+HOSTS = ("nanobananaapi.ai", "aiquickdraw.com")
+
+
+def test_parse_task_outcome():
+    assert parse_task_outcome({"successFlag": 0}) is None
+    assert parse_task_outcome({"successFlag": 1, "response": {"resultImageUrl": "https://a/x.jpg"}}) == {
+        "success": True, "url": "https://a/x.jpg", "error": "",
+    }
+    assert parse_task_outcome({"successFlag": 3, "errorMessage": "nsfw"})["error"] == "nsfw"
+    # Колбэк без successFlag, но с результатом
+    assert parse_task_outcome({"info": {"resultImageUrl": "https://a/y.jpg"}})["url"] == "https://a/y.jpg"
+
+
+def test_parse_task_outcome_tolerates_malformed_response():
+    assert parse_task_outcome({"successFlag": 0, "response": "oops"}) is None
+    outcome = parse_task_outcome({"successFlag": 1, "response": ["x"]})
+    assert outcome["success"] is False and outcome["url"] is None
+
+
+def test_callback_token_is_stable_and_hides_key():
+    token = derive_callback_token("secret-key")
+    assert token == derive_callback_token("secret-key")
+    assert token != derive_callback_token("other-key")
+    assert "secret-key" not in token
+
+
+def test_result_url_allowlist():
+    assert is_allowed_result_url("https://tempfile.aiquickdraw.com/r/x.jpg", HOSTS)
+    assert is_allowed_result_url("https://nanobananaapi.ai/x.jpg", HOSTS)
+    assert not is_allowed_result_url("http://nanobananaapi.ai/x.jpg", HOSTS)
+    assert not is_allowed_result_url("https://evil-nanobananaapi.ai/x.jpg", HOSTS)
+    assert not is_allowed_result_url("https://nanobananaapi.ai.evil.com/x.jpg", HOSTS)
+    assert not is_allowed_result_url("https://169.254.169.254/latest/meta-data", HOSTS)
+    assert not is_allowed_result_url(None, HOSTS)
+    assert not is_allowed_result_url(["https://nanobananaapi.ai/x.jpg"], HOSTS)
+
+
+def test_tracker_works_on_a_new_event_loop():
+    async def fetch_status(task_id):
+        return {"successFlag": 1, "response": {"resultImageUrl": f"https://nanobananaapi.ai/{task_id}.jpg"}}
+
+    tracker = NanoBananaTaskTracker(fetch_status, initial_delay=0, min_interval=0.01)
+
+    async def scenario(task_id):
+        outcome = await tracker.wait(task_id, timeout=1)
+        await tracker.stop()
+        return outcome
+
+    # Приложение запускается повторно в новом цикле (как TestClient в тестах)
+    assert asyncio.run(scenario("first"))["url"].endswith("/first.jpg")
+    assert asyncio.run(scenario("second"))["url"].endswith("/second.jpg")
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY") or "test")
+    monkeypatch.setenv("NANOBANANA_API_KEY", "test-key")
+    monkeypatch.delenv("NANOBANANA_CALLBACK_TOKEN", raising=False)
+    main = pytest.importorskip("main")
+    from fastapi.testclient import TestClient
+
+    client = TestClient(main.app)
+    token = derive_callback_token("test-key")
+
+    def post(payload, token=token):
+        return client.post("/api/callbacks/nanobanana", params={"token": token} if token else None, json=payload)
+
+    return post
+
+
+def callback(url="https://tempfile.aiquickdraw.com/r/x.jpg", task_id="task-1"):
+    return {"code": 200, "data": {"taskId": task_id, "successFlag": 1, "info": {"resultImageUrl": url}}}
+
+
+def test_webhook_rejects_missing_or_wrong_token(webhook):
+    assert webhook(callback(), token=None).status_code == 403
+    assert webhook(callback(), token="wrong").status_code == 403
+    assert webhook(callback(), token=derive_callback_token("other-key")).status_code == 403
+
+
+def test_webhook_rejects_disallowed_result_host(webhook):
+    assert webhook(callback("https://169.254.169.254/latest/meta-data")).status_code == 400
+    assert webhook(callback("http://tempfile.aiquickdraw.com/r/x.jpg")).status_code == 400
+
+
+def test_webhook_rejects_malformed_payload(webhook):
+    assert webhook(["not", "an", "object"]).status_code == 400
+    assert webhook({"code": 200, "data": "oops"}).status_code == 400
+    assert webhook({"code": 200, "data": {"taskId": 42}}).status_code == 400
+    assert webhook({"code": 200}).status_code == 400
+
+
+def test_webhook_accepts_valid_callback(webhook):
+    response = webhook(callback(task_id="unknown-task"))
+    assert response.status_code == 200
+    assert response.json()["success"] is True
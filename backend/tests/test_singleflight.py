@@ -0,0 +1,104 @@
+"""
+Запуск из папки backend: python -m pytest tests
+"""
+import os
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight, SQLiteLeases
+
+
+def test_leader_cancel_does_not_cancel_followers():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return {"value": 42}
+
+        leader = asyncio.create_task(flight.do("key", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await follower == {"value": 42}
+        assert calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_computation_cancelled_when_last_waiter_leaves():
+    async def scenario():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def compute():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do("key", compute)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        assert "key" not in flight._inflight
+
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_waiter():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(
+            *(flight.do("key", compute) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(scenario())
+
+
+def test_lease_renewed_while_leader_runs(tmp_path):
+    async def scenario():
+        leases = SQLiteLeases(str(tmp_path / "flights.sqlite3"), lease_seconds=0.3)
+        # Два воркера: у каждого свой SingleFlight и свой владелец аренды
+        first = SingleFlight(leases, poll_interval=0.05)
+        second = SingleFlight(leases, poll_interval=0.05)
+        second._pid, second._owner = os.getpid(), "other-worker"
+        runs = []
+        done = {}
+
+        async def compute():
+            runs.append("start")
+            await asyncio.sleep(1)
+            runs.append("end")
+            done["value"] = 42
+            return 42
+
+        async def lookup():
+            return done.get("value")
+
+        leader = asyncio.create_task(first.do("key", compute, lookup=lookup))
+        await asyncio.sleep(0.05)
+        assert await second.do("key", compute, lookup=lookup) == 42
+        assert await leader == 42
+        assert runs == ["start", "end"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,56 @@
+import re
+import uuid
+import logging
+from contextvars import ContextVar
+
+# id запроса для логов; фоновые задачи (asyncio.create_task) наследуют его из контекста
+trace_id_var: ContextVar[str] = ContextVar("trace_id", default="-")
+
+TRACE_HEADER = "x-request-id"
+_VALID_TRACE_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def current_trace_id() -> str:
+    return trace_id_var.get()
+
+
+class TraceIdFilter(logging.Filter):
+    """
+    Добавляет в каждую запись лога поле trace_id
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+class TraceIdMiddleware:
+    """
+    ASGI middleware: берет X-Request-ID из запроса (или создает новый),
+    кладет его в контекст логов и возвращает в заголовке ответа
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope.get("headers") or []).get(TRACE_HEADER.encode(), b"").decode("latin-1")
+        trace_id = incoming if _VALID_TRACE_ID.match(incoming) else uuid.uuid4().hex[:16]
+        token = trace_id_var.set(trace_id)
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers") or [])
+                headers.append((TRACE_HEADER.encode(), trace_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            trace_id_var.reset(token)
+
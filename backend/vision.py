@@ -0,0 +1,218 @@
+"""
+Подготовка фото для vision-запроса GPT-4o: разрешение, detail и кадрирование по человеку
+
+Стоимость и задержка vision-запроса зависят от числа тайлов: detail=low - фиксированные
+85 токенов за картинку 512px, detail=high - 85 + 170 токенов за каждый тайл 512px после
+масштабирования (короткая сторона до 768px). Политика VISION_DETAIL=auto выбирает уровень
+по размеру лица: если лица хватает на 512px, уходит low, иначе high в разрешении, при
+котором лицо различимо. Фото обрезается до человека (лицо + тело ниже), если найден
+детектор - OpenCV (необязательная зависимость opencv-python-headless<5), иначе кадр целиком.
+"""
+import io
+import os
+import math
+import logging
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+# Сторона картинки для detail=low (больше модель все равно не видит)
+LOW_DETAIL_SIDE = 512
+# Сторона, до которой уменьшается фото для поиска лица (детектору достаточно)
+DETECT_SIDE = 512
+# Обрезка имеет смысл, только если убирает заметную часть кадра
+MIN_CROP_SAVING = 0.15
+
+DETAIL_MODES = ("auto", "low", "high", "original")
+
+Box = Tuple[int, int, int, int]
+
+
+@dataclass
+class VisionPolicy:
+    """
+    detail - auto | low | high | original (как раньше: то же JPEG, что и для NanoBanana, без detail);
+    max_side - предел разрешения для detail=high;
+    quality - качество JPEG для vision-запроса;
+    min_face_px - высота лица в пикселях, при которой модель уверенно видит черты лица;
+    crop - обрезать ли фото до человека
+    """
+    detail: str = "auto"
+    max_side: int = 1024
+    quality: int = 85
+    min_face_px: int = 40
+    crop: bool = True
+
+
+@dataclass
+class VisionInput:
+    """
+    Изображение для GPT-4o: JPEG, уровень detail (None - поле не передается),
+    оценка входных токенов и найденные области (в координатах уменьшенного фото)
+    """
+    jpeg: bytes
+    width: int
+    height: int
+    detail: Optional[str]
+    tokens: int
+    face: Optional[Box] = None
+    crop: Optional[Box] = None
+
+
+def create_vision_policy() -> VisionPolicy:
+    """
+    Политика из переменных окружения VISION_*
+    """
+    detail = os.getenv("VISION_DETAIL", "auto").lower()
+    if detail not in DETAIL_MODES:
+        logger.warning("⚠️ Неизвестный VISION_DETAIL=%s, используется auto", detail)
+        detail = "auto"
+    return VisionPolicy(
+        detail=detail,
+        max_side=int(os.getenv("VISION_MAX_SIDE", 1024)),
+        quality=int(os.getenv("VISION_JPEG_QUALITY", 85)),
+        min_face_px=int(os.getenv("VISION_MIN_FACE_PX", 40)),
+        crop=os.getenv("VISION_CROP", "1") != "0",
+    )
+
+
+def estimate_image_tokens(width: int, height: int, detail: Optional[str]) -> int:
+    """
+    Входные токены картинки по правилам OpenAI (detail=None/auto для больших фото считается как high)
+    """
+    if detail == "low":
+        return 85
+    # Вписываем в 2048x2048, затем короткую сторону уменьшаем до 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+_face_cascade = None
+
+
+def detect_face(image: Image.Image) -> Optional[Box]:
+    """
+    Самое крупное лицо (left, top, right, bottom) или None; без OpenCV всегда None
+
+    Каскад Хаара на уменьшенном сером изображении - около 20 мс на CPU (в пуле потоков).
+    """
+    global _face_cascade
+    if cv2 is None or _face_cascade is False:
+        return None
+    if _face_cascade is None:
+        if not hasattr(cv2, "CascadeClassifier"):
+            # В OpenCV 5 каскады Хаара вынесены из основного пакета
+            logger.warning("⚠️ В OpenCV %s нет CascadeClassifier - фото не обрезается (нужен opencv-python-headless<5)", cv2.__version__)
+            _face_cascade = False
+            return None
+        _face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+
+    scale = min(1.0, DETECT_SIDE / max(image.size))
+    small = image.convert("L")
+    if scale < 1.0:
+        small = small.resize((round(image.width * scale), round(image.height * scale)), Image.Resampling.BILINEAR)
+    faces = _face_cascade.detectMultiScale(np.asarray(small), scaleFactor=1.1, minNeighbors=5, minSize=(20, 20))
+    if len(faces) == 0:
+        return None
+    x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+    return (
+        round(x / scale),
+        round(y / scale),
+        round((x + w) / scale),
+        round((y + h) / scale),
+    )
+
+
+def person_box(face: Box, size: Tuple[int, int]) -> Box:
+    """
+    Область человека по лицу: немного выше головы, по ширине - плечи и руки, вниз до края кадра
+    """
+    left, top, right, bottom = face
+    face_width = right - left
+    center = (left + right) / 2
+    return (
+        max(0, round(center - 2.5 * face_width)),
+        max(0, round(top - 0.6 * (bottom - top))),
+        min(size[0], round(center + 2.5 * face_width)),
+        size[1],
+    )
+
+
+def _encode(image: Image.Image, quality: int) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def build_vision_input(image: Image.Image, policy: VisionPolicy, original_jpeg: bytes) -> VisionInput:
+    """
+    Выбирает кадр, разрешение и detail для vision-запроса
+
+    image - уже повернутое и уменьшенное RGB-фото; original_jpeg - его JPEG
+    (отправляется как есть при detail=original).
+    """
+    if policy.detail == "original":
+        return VisionInput(
+            jpeg=original_jpeg,
+            width=image.width,
+            height=image.height,
+            detail=None,
+            tokens=estimate_image_tokens(image.width, image.height, None),
+        )
+
+    face = detect_face(image) if policy.crop or policy.detail == "auto" else None
+    crop = None
+    region = image
+    if face and policy.crop:
+        box = person_box(face, image.size)
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        if area <= (1 - MIN_CROP_SAVING) * image.width * image.height:
+            crop = box
+            region = image.crop(box)
+
+    detail = policy.detail
+    side = policy.max_side
+    if detail == "auto":
+        if face is None:
+            # Без лица не знаем, хватит ли low - оставляем high, как делал detail=auto у OpenAI
+            detail = "high"
+        else:
+            face_height = face[3] - face[1]
+            # Высота лица, если вписать область в 512px
+            low_face_px = face_height * LOW_DETAIL_SIDE / max(region.size)
+            if low_face_px >= policy.min_face_px:
+                detail = "low"
+            else:
+                detail = "high"
+                # Разрешение, при котором лицо не меньше min_face_px
+                side = math.ceil(policy.min_face_px * max(region.size) / face_height)
+    if detail == "low":
+        side = LOW_DETAIL_SIDE
+    side = max(LOW_DETAIL_SIDE, min(side, policy.max_side))
+
+    if max(region.size) > side:
+        region = region.copy() if region is image else region
+        region.thumbnail((side, side), Image.Resampling.LANCZOS)
+
+    return VisionInput(
+        jpeg=_encode(region, policy.quality),
+        width=region.width,
+        height=region.height,
+        detail=detail,
+        tokens=estimate_image_tokens(region.width, region.height, detail),
+        face=face,
+        crop=crop,
+    )
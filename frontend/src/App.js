@@ -6,12 +6,24 @@ import Results from './components/Results';
 function App() {
   const [results, setResults] = useState(null);
   const [loading, setLoading] = useState(false);
+  const [error, setError] = useState('');
+
+  // Частичный результат: показываем, пока анализ еще идет
+  const handleAnalysisProgress = (data) => {
+    setResults(data);
+  };
 
   const handleAnalysisComplete = (data) => {
     setResults(data);
     setLoading(false);
   };
 
+  const handleAnalysisError = (message) => {
+    setResults(null);
+    setError(message);
+    setLoading(false);
+  };
+
   const handleReset = () => {
     setResults(null);
   };
@@ -26,12 +38,16 @@ function App() {
       <main className="App-main">
         {!results ? (
           <UploadForm 
+            onAnalysisProgress={handleAnalysisProgress}
             onAnalysisComplete={handleAnalysisComplete}
+            onAnalysisError={handleAnalysisError}
             loading={loading}
             setLoading={setLoading}
+            error={error}
+            setError={setError}
           />
         ) : (
-          <Results data={results} onReset={handleReset} />
+          <Results data={results} loading={loading} onReset={handleReset} />
         )}
       </main>
 
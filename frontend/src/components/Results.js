@@ -1,19 +1,44 @@
 import React, { useState } from 'react';
 import './Results.css';
 
-function Results({ data, onReset }) {
-  const { analysis, recommendations, style_tips, generated_image } = data;
+// Цена товара из каталога: 4990 RUB -> "4 990 ₽"
+function formatPrice(price, currency) {
+  const code = (currency || 'RUB').toUpperCase();
+  try {
+    return new Intl.NumberFormat('ru-RU', { style: 'currency', currency: code, maximumFractionDigits: 0 }).format(price);
+  } catch (e) {
+    return `${price} ${code}`;
+  }
+}
+
+// Ширина изображения в макете: на телефоне - во всю ширину экрана
+const GENERATED_IMAGE_SIZES = '(max-width: 700px) 100vw, 600px';
+
+function Results({ data, loading, onReset }) {
+  const { analysis, recommendations, style_tips, generated_image, generated_image_variants: variants } = data;
   const [imageError, setImageError] = useState(false);
+  const [imageLoaded, setImageLoaded] = useState(false);
+  // Браузер выбирает первый поддерживаемый формат из <source>, JPEG - запасной в <img>
+  const sources = variants?.sources || [];
+  const jpegSource = sources.find((source) => source.type === 'image/jpeg');
 
   return (
     <div className="results-container">
       <div className="results-header">
         <h2>✨ Ваши персональные рекомендации</h2>
-        <button onClick={onReset} className="reset-button">
+        <button onClick={onReset} className="reset-button" disabled={loading}>
           🔄 Новый анализ
         </button>
       </div>
 
+      {/* Анализ еще идет: часть результатов уже пришла потоком */}
+      {loading && (
+        <div className="loading-note">
+          <span className="loading-spinner"></span>
+          {style_tips ? 'Создаю визуализацию образа...' : 'Подбираю образ...'}
+        </div>
+      )}
+
       {/* Сгенерированное изображение */}
       {generated_image && (
         <div className="generated-image-section">
@@ -21,15 +46,29 @@ function Results({ data, onReset }) {
           <div className="generated-image-wrapper">
             {!imageError ? (
               <>
-                <img 
-                  src={generated_image} 
-                  alt="Вы в новой одежде" 
-                  className="generated-image"
-                  onError={() => setImageError(true)}
-                  crossOrigin="anonymous"
-                />
+                {/* Размытый плейсхолдер из ответа виден сразу, пока грузится изображение */}
+                <picture>
+                  {sources
+                    .filter((source) => source !== jpegSource)
+                    .map((source) => (
+                      <source key={source.type} type={source.type} srcSet={source.srcset} sizes={GENERATED_IMAGE_SIZES} />
+                    ))}
+                  <img 
+                    src={generated_image} 
+                    srcSet={jpegSource?.srcset}
+                    sizes={jpegSource ? GENERATED_IMAGE_SIZES : undefined}
+                    width={variants?.width}
+                    height={variants?.height}
+                    alt="Вы в новой одежде" 
+                    className={`generated-image ${variants?.placeholder && !imageLoaded ? 'is-loading' : ''}`}
+                    style={variants?.placeholder && !imageLoaded ? { backgroundImage: `url(${variants.placeholder})` } : undefined}
+                    onLoad={() => setImageLoaded(true)}
+                    onError={() => setImageError(true)}
+                    crossOrigin="anonymous"
+                  />
+                </picture>
                 <a 
-                  href={generated_image} 
+                  href={variants?.src || generated_image} 
                   target="_blank" 
                   rel="noopener noreferrer"
                   className="image-direct-link"
@@ -107,9 +146,14 @@ function Results({ data, onReset }) {
                           href={link.url}
                           target="_blank"
                           rel="noopener noreferrer"
-                          className="shop-link"
+                          className={link.title ? 'shop-link product-link' : 'shop-link'}
+                          title={link.title}
                         >
-                          {link.name}
+                          {link.image && <img src={link.image} alt="" className="product-thumb" loading="lazy" />}
+                          <span>{link.name}</span>
+                          {link.price != null && (
+                            <span className="product-price">{formatPrice(link.price, link.currency)}</span>
+                          )}
                         </a>
                       ))}
                     </div>
@@ -121,7 +165,7 @@ function Results({ data, onReset }) {
         </div>
       )}
 
-      <button onClick={onReset} className="bottom-reset-button">
+      <button onClick={onReset} className="bottom-reset-button" disabled={loading}>
         🔄 Подобрать другой стиль
       </button>
     </div>
@@ -1,14 +1,58 @@
-import React, { useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import axios from 'axios';
+import { DEFAULT_UPLOAD_CONFIG, prepareUpload, uploadFileName } from '../prepareUpload';
 import './UploadForm.css';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
 
-function UploadForm({ onAnalysisComplete, loading, setLoading }) {
+// Текст ошибки из ответа сервера (при responseType 'text' тело приходит строкой)
+const errorDetail = (data) => {
+  if (typeof data !== 'string') {
+    return data?.detail;
+  }
+  try {
+    return JSON.parse(data).detail;
+  } catch (e) {
+    return null;
+  }
+};
+
+// Анонимный id браузера: с ним результаты попадают в историю (GET /api/history)
+const clientId = () => {
+  try {
+    let id = localStorage.getItem('odezda-client-id');
+    if (!id) {
+      id = window.crypto?.randomUUID ? window.crypto.randomUUID() : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+      localStorage.setItem('odezda-client-id', id);
+    }
+    return id;
+  } catch (e) {
+    return null;
+  }
+};
+
+const formatSize = (bytes) =>
+  bytes >= 1024 * 1024 ? `${(bytes / (1024 * 1024)).toFixed(1)} МБ` : `${Math.round(bytes / 1024)} КБ`;
+
+function UploadForm({ onAnalysisProgress, onAnalysisComplete, onAnalysisError, loading, setLoading, error, setError }) {
   const [photo, setPhoto] = useState(null);
   const [photoPreview, setPhotoPreview] = useState(null);
   const [style, setStyle] = useState('');
-  const [error, setError] = useState('');
+  // Фото уменьшается до размера, который использует сервер, сразу после выбора
+  const [uploadConfig, setUploadConfig] = useState(DEFAULT_UPLOAD_CONFIG);
+  const [upload, setUpload] = useState(null);
+  const [preparing, setPreparing] = useState(false);
+  const [uploadProgress, setUploadProgress] = useState(null);
+  const selection = useRef(0);
+
+  useEffect(() => {
+    axios
+      .get(`${API_URL}/api/upload-config`)
+      .then(({ data }) => setUploadConfig({ ...DEFAULT_UPLOAD_CONFIG, ...data }))
+      .catch((err) => console.warn('Upload config unavailable, using defaults:', err));
+  }, []);
+
+  useEffect(() => () => photoPreview && URL.revokeObjectURL(photoPreview), [photoPreview]);
 
   const styleOptions = [
     'Casual (повседневный)',
@@ -23,34 +67,41 @@ function UploadForm({ onAnalysisComplete, loading, setLoading }) {
     'Gothic (готический)',
   ];
 
-  const handlePhotoChange = (e) => {
+  const handlePhotoChange = async (e) => {
     const file = e.target.files[0];
     if (file) {
-      if (file.size > 10 * 1024 * 1024) {
-        setError('Файл слишком большой. Максимум 10MB.');
-        return;
-      }
-      
       if (!file.type.startsWith('image/')) {
         setError('Пожалуйста, выберите изображение.');
         return;
       }
 
+      // Если пользователь успел выбрать другое фото, результат прежнего не нужен
+      const current = ++selection.current;
       setPhoto(file);
+      setUpload(null);
       setError('');
-      
-      const reader = new FileReader();
-      reader.onloadend = () => {
-        setPhotoPreview(reader.result);
-      };
-      reader.readAsDataURL(file);
+      setPreparing(true);
+
+      const prepared = await prepareUpload(file, uploadConfig);
+      if (current !== selection.current) {
+        return;
+      }
+      setPreparing(false);
+      if (prepared.blob.size > uploadConfig.max_upload_bytes) {
+        setPhoto(null);
+        setPhotoPreview(null);
+        setError(`Файл слишком большой. Максимум ${formatSize(uploadConfig.max_upload_bytes)}.`);
+        return;
+      }
+      setUpload(prepared);
+      setPhotoPreview(URL.createObjectURL(prepared.blob));
     }
   };
 
   const handleSubmit = async (e) => {
     e.preventDefault();
     
-    if (!photo) {
+    if (!photo || !upload) {
       setError('Пожалуйста, загрузите фото.');
       return;
     }
@@ -64,26 +115,66 @@ function UploadForm({ onAnalysisComplete, loading, setLoading }) {
     setError('');
 
     const formData = new FormData();
-    formData.append('photo', photo);
+    formData.append('photo', upload.blob, uploadFileName(photo, upload.blob));
     formData.append('style', style);
 
+    // Результат приходит строками NDJSON: поля анализа и рекомендации показываем сразу,
+    // не дожидаясь конца генерации ответа и изображения
+    let partial = {};
+    let received = 0;
+    let finished = false;
+    let streamError = null;
+
+    const handleEvent = ({ event, data }) => {
+      if (event === 'recommendation') {
+        const recommendations = [...(partial.recommendations || [])];
+        recommendations[data.index] = data.recommendation;
+        partial = { ...partial, recommendations };
+      } else if (event === 'done') {
+        finished = true;
+        onAnalysisComplete(data);
+        return;
+      } else if (event === 'error') {
+        streamError = data.error;
+        return;
+      } else {
+        partial = { ...partial, ...data };
+      }
+      onAnalysisProgress(partial);
+    };
+
+    const readLines = (text) => {
+      let newline;
+      while (!finished && !streamError && (newline = text.indexOf('\n', received)) !== -1) {
+        const line = text.slice(received, newline);
+        received = newline + 1;
+        if (line.trim()) {
+          handleEvent(JSON.parse(line));
+        }
+      }
+    };
+
+    const client = clientId();
     try {
-      const response = await axios.post(`${API_URL}/api/analyze`, formData, {
+      const response = await axios.post(`${API_URL}/api/analyze/stream`, formData, {
         headers: {
           'Content-Type': 'multipart/form-data',
+          ...(client && { 'X-Client-Id': client }),
         },
+        responseType: 'text',
+        onUploadProgress: ({ loaded, total }) => setUploadProgress(total ? Math.round((loaded * 100) / total) : null),
+        onDownloadProgress: ({ event }) => readLines(event.target.responseText),
       });
+      readLines(response.data);
 
-      if (response.data.success) {
-        onAnalysisComplete(response.data.data);
-      } else {
-        setError('Ошибка при анализе. Попробуйте еще раз.');
-        setLoading(false);
+      if (!finished) {
+        onAnalysisError(streamError || 'Ошибка при анализе. Попробуйте еще раз.');
       }
     } catch (err) {
       console.error('Error:', err);
-      setError(err.response?.data?.detail || 'Ошибка соединения с сервером. Проверьте, что backend запущен.');
-      setLoading(false);
+      onAnalysisError(errorDetail(err.response?.data) || 'Ошибка соединения с сервером. Проверьте, что backend запущен.');
+    } finally {
+      setUploadProgress(null);
     }
   };
 
@@ -108,10 +199,16 @@ function UploadForm({ onAnalysisComplete, loading, setLoading }) {
                 <div className="upload-placeholder">
                   <span className="upload-icon">📷</span>
                   <span>Нажмите для выбора фото</span>
-                  <span className="upload-hint">JPG, PNG (макс. 10MB)</span>
+                  <span className="upload-hint">JPG, PNG, WebP - большие фото уменьшаются перед отправкой</span>
                 </div>
               )}
             </label>
+            {preparing && <div className="upload-info">Подготовка фото...</div>}
+            {upload?.resized && (
+              <div className="upload-info">
+                Фото уменьшено до {upload.width}×{upload.height}: {formatSize(upload.blob.size)} вместо {formatSize(photo.size)}
+              </div>
+            )}
           </div>
         </div>
 
@@ -156,12 +253,14 @@ function UploadForm({ onAnalysisComplete, loading, setLoading }) {
         <button 
           type="submit" 
           className="submit-button"
-          disabled={loading || !photo || !style}
+          disabled={loading || preparing || !upload || !style}
         >
           {loading ? (
             <>
               <span className="spinner"></span>
-              Анализирую и создаю изображение...
+              {uploadProgress !== null && uploadProgress < 100
+                ? `Загрузка фото ${uploadProgress}%...`
+                : 'Анализирую и создаю изображение...'}
             </>
           ) : (
             <>
@@ -0,0 +1,74 @@
+// Уменьшение фото перед загрузкой: общий код для Web Worker и основного потока.
+// Сервер все равно уменьшает фото до max_side (GET /api/upload-config), поэтому
+// отправлять с телефона полное разрешение - только лишние мегабайты.
+
+export const fitSize = (width, height, maxSide) => {
+  const scale = Math.min(1, maxSide / Math.max(width, height));
+  return { width: Math.round(width * scale), height: Math.round(height * scale) };
+};
+
+// Декодирование с поворотом по EXIF (как у <img>): createImageBitmap, а в браузерах
+// без него - через <img> (только в основном потоке)
+const decodeImage = async (file) => {
+  if (typeof createImageBitmap !== 'undefined') {
+    const bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' });
+    return { source: bitmap, width: bitmap.width, height: bitmap.height, close: () => bitmap.close() };
+  }
+  const url = URL.createObjectURL(file);
+  const image = new Image();
+  image.src = url;
+  try {
+    await image.decode();
+  } finally {
+    URL.revokeObjectURL(url);
+  }
+  return { source: image, width: image.naturalWidth, height: image.naturalHeight, close: () => {} };
+};
+
+const createCanvas = (width, height) => {
+  if (typeof OffscreenCanvas !== 'undefined') {
+    return new OffscreenCanvas(width, height);
+  }
+  const canvas = document.createElement('canvas');
+  canvas.width = width;
+  canvas.height = height;
+  return canvas;
+};
+
+const canvasToBlob = (canvas, type, quality) => {
+  if (canvas.convertToBlob) {
+    return canvas.convertToBlob({ type, quality });
+  }
+  return new Promise((resolve, reject) => {
+    canvas.toBlob((blob) => (blob ? resolve(blob) : reject(new Error('Не удалось закодировать изображение'))), type, quality);
+  });
+};
+
+// Возвращает { blob, width, height, resized }; если фото уже не больше max_side и в нужном
+// формате (или пережатое вышло тяжелее исходного) - исходный файл без изменений
+export async function downscaleImage(file, { max_side: maxSide, format, quality }) {
+  const image = await decodeImage(file);
+  try {
+    const size = fitSize(image.width, image.height, maxSide);
+    const resized = size.width !== image.width || size.height !== image.height;
+    if (!resized && file.type === format) {
+      return { blob: file, ...size, resized: false };
+    }
+
+    const canvas = createCanvas(size.width, size.height);
+    const context = canvas.getContext('2d');
+    context.imageSmoothingQuality = 'high';
+    // Прозрачный фон PNG - белый, как при обработке на сервере
+    context.fillStyle = '#fff';
+    context.fillRect(0, 0, size.width, size.height);
+    context.drawImage(image.source, 0, 0, size.width, size.height);
+    const blob = await canvasToBlob(canvas, format, quality);
+
+    if (!resized && blob.size >= file.size) {
+      return { blob: file, ...size, resized: false };
+    }
+    return { blob, ...size, resized };
+  } finally {
+    image.close();
+  }
+}
@@ -0,0 +1,12 @@
+/* eslint-disable no-restricted-globals */
+// Web Worker: декодирование и пережатие фото не блокируют интерфейс
+import { downscaleImage } from './downscale';
+
+self.onmessage = async ({ data: { id, file, config } }) => {
+  try {
+    const result = await downscaleImage(file, config);
+    self.postMessage({ id, ...result });
+  } catch (error) {
+    self.postMessage({ id, error: error?.message || String(error) });
+  }
+};
@@ -0,0 +1,74 @@
+import { downscaleImage } from './downscale';
+
+// Значения на случай, если /api/upload-config недоступен (совпадают с настройками сервера по умолчанию)
+export const DEFAULT_UPLOAD_CONFIG = {
+  max_side: 1024,
+  format: 'image/jpeg',
+  quality: 0.92,
+  max_upload_bytes: 10 * 1024 * 1024,
+  accepted_types: ['image/jpeg', 'image/png', 'image/webp', 'image/gif', 'image/bmp'],
+};
+
+let worker = null;
+let nextId = 0;
+const pending = new Map();
+
+// В воркере нужен OffscreenCanvas с 2d-контекстом (Chrome, Firefox, Safari 16.4+)
+const canUseWorker = () =>
+  typeof Worker !== 'undefined' && typeof OffscreenCanvas !== 'undefined' && typeof createImageBitmap !== 'undefined';
+
+const getWorker = () => {
+  if (!worker) {
+    worker = new Worker(new URL('./downscale.worker.js', import.meta.url));
+    worker.onmessage = ({ data }) => {
+      const request = pending.get(data.id);
+      pending.delete(data.id);
+      if (data.error) {
+        request.reject(new Error(data.error));
+      } else {
+        request.resolve(data);
+      }
+    };
+    worker.onerror = (event) => {
+      pending.forEach((request) => request.reject(new Error(event.message)));
+      pending.clear();
+      worker.terminate();
+      worker = null;
+    };
+  }
+  return worker;
+};
+
+const downscaleInWorker = (file, config) =>
+  new Promise((resolve, reject) => {
+    const id = ++nextId;
+    pending.set(id, { resolve, reject });
+    getWorker().postMessage({ id, file, config });
+  });
+
+// Фото для отправки: уменьшенное в воркере, иначе в основном потоке, а если браузер
+// не смог его декодировать - исходный файл (сервер обработает его сам)
+export async function prepareUpload(file, config = DEFAULT_UPLOAD_CONFIG) {
+  if (canUseWorker()) {
+    try {
+      return await downscaleInWorker(file, config);
+    } catch (err) {
+      console.warn('Downscale in worker failed:', err);
+    }
+  }
+  try {
+    return await downscaleImage(file, config);
+  } catch (err) {
+    console.warn('Downscale failed, uploading original:', err);
+    return { blob: file, resized: false };
+  }
+}
+
+// Имя файла для формы: расширение по формату пережатого фото
+export const uploadFileName = (file, blob) => {
+  if (blob === file) {
+    return file.name;
+  }
+  const extension = blob.type.split('/')[1] === 'jpeg' ? 'jpg' : blob.type.split('/')[1];
+  return `${file.name.replace(/\.[^.]+$/, '') || 'photo'}.${extension}`;
+};
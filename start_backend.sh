@@ -28,8 +28,8 @@ if [ ! -f ".env" ]; then
     echo ""
 fi
 
-# Запуск сервера
+# Запуск сервера: по воркеру на ядро (WEB_CONCURRENCY), для разработки - python main.py
 echo "✅ Запускаю сервер на http://localhost:8000"
-python main.py
+python serve.py
 
 